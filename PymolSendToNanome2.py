@@ -2,15 +2,27 @@
 # executed on PyMOL's startup. Only import such modules inside functions.
 
 import os
-from pymol.Qt import QtCore
 from pymol import cmd
+try:
+    from pymol.Qt import QtCore
+except ImportError:
+    # Headless Pymol without Qt bindings, e.g. for the batch converter
+    QtCore = None
 import json
-import shutil
+import contextlib
 from math import floor
 
 loading_gif_url = "https://upload.wikimedia.org/wikipedia/commons/b/b1/Loading_icon.gif"
 nanome_logo_url = "https://pbs.twimg.com/profile_images/988544354162651137/HQ7nVOtg_400x400.jpg"
 
+# Dialog images are downloaded once, in the background, to this versioned
+# cache. Bump the version when the URLs change.
+resource_cache_version = 1
+resources = {
+    "loading.gif": loading_gif_url,
+    "nanome_logo.jpg": nanome_logo_url,
+}
+
 
 def __init_plugin__(app=None):
     '''
@@ -18,22 +30,29 @@ def __init_plugin__(app=None):
     '''
     from pymol.plugins import addmenuitemqt
     addmenuitemqt('View in Nanome 2', run_plugin_gui)
+    cmd.extend('nanome_profile', nanome_profile)
+    cmd.extend('nanome_send', nanome_send)
+    cmd.extend('nanome_live', nanome_live)
+    cmd.extend('nanome_queue', nanome_queue)
 
 
 # global reference to avoid garbage collection of our dialog
 dialog = None
 login_dialog = None
 workspace_api = None
-nanome_logo_path = None
-sending_thread = None
-sending_worker = None
+send_queue = None
+resource_loader = None
 
 
 def run_plugin_gui():
     global dialog
     global login_dialog
+    global workspace_api
+
+    load_resources()
 
-    dialog = make_dialog()
+    if dialog is None:
+        dialog = make_dialog()
 
     if login_dialog is None:
         login_dialog = make_login_dialog()
@@ -41,12 +60,38 @@ def run_plugin_gui():
     if login_dialog is None:
         return
 
-    if workspace_api is None or workspace_api.token is None:
+    if workspace_api is None:
+        # Picks up the token stored by a previous Pymol session
+        workspace_api = WorkspaceAPI()
+
+    if not workspace_api.has_token():
         login_dialog.show()
     else:
         dialog.show()
 
 
+def config_dir():
+    return os.path.join(os.path.expanduser("~"), ".pymol", "nanome")
+
+
+def resource_dir():
+    return os.path.join(config_dir(), "resources-v%d" % resource_cache_version)
+
+
+def cached_resource(name):
+    # Path of a downloaded resource, None until it is in the cache
+    path = os.path.join(resource_dir(), name)
+    return path if os.path.isfile(path) else None
+
+
+def load_resources():
+    global resource_loader
+    if resource_loader is None and any(
+            cached_resource(name) is None for name in resources):
+        resource_loader = ResourceLoader()
+        resource_loader.start()
+
+
 def make_login_dialog():
     from pymol.Qt import QtWidgets, QtGui
 
@@ -59,7 +104,15 @@ def make_login_dialog():
     login_dialog = QtWidgets.QDialog()
     login_dialog.setWindowTitle("Nanome Login Credentials")
     login_dialog.setFixedWidth(350)
-    login_dialog.setWindowIcon(QtGui.QIcon(nanome_logo_path))
+
+    def apply_resources():
+        if cached_resource("nanome_logo.jpg") is not None:
+            login_dialog.setWindowIcon(
+                QtGui.QIcon(cached_resource("nanome_logo.jpg")))
+
+    apply_resources()
+    if resource_loader is not None:
+        resource_loader.loaded.connect(apply_resources)
 
     textName = QtWidgets.QLineEdit(login_dialog)
     textName.setPlaceholderText("Login or email address")
@@ -67,6 +120,8 @@ def make_login_dialog():
     textPass.setPlaceholderText("Password")
     textPass.setEchoMode(QtWidgets.QLineEdit.Password)
 
+    login_task = LoginTask()
+
     def handle_login():
         global workspace_api
         if len(textPass.text()) == 0 or len(textName.text()) == 0:
@@ -74,20 +129,30 @@ def make_login_dialog():
             QtWidgets.QMessageBox.warning(None, "Warning", msg)
             return
 
-        # Get Nanome credential token here !
-        workspace_api = WorkspaceAPI(textName.text(), textPass.text())
-        reason = workspace_api.get_nanome_token()
+        # Get Nanome credential token here, off the GUI thread !
+        if workspace_api is None:
+            workspace_api = WorkspaceAPI()
+        workspace_api.set_credentials(textName.text(), textPass.text())
+        buttonLogin.setEnabled(False)
+        login_task.start(workspace_api)
 
+    def login_done(reason):
+        buttonLogin.setEnabled(True)
         if reason is not None:
             msg = "Failed to login: " + reason
             QtWidgets.QMessageBox.warning(None, "Error", msg)
             return
 
+        if send_queue is not None:
+            send_queue.retry_now()
         dialog.show()
         login_dialog.close()
 
     buttonLogin = QtWidgets.QPushButton('Login', login_dialog)
     buttonLogin.clicked.connect(handle_login)
+    login_task.done.connect(login_done)
+    # keep a reference for the lifetime of the dialog
+    login_dialog.login_task = login_task
     layout = QtWidgets.QVBoxLayout(login_dialog)
     layout.addWidget(textName)
     layout.addWidget(textPass)
@@ -97,160 +162,2576 @@ def make_login_dialog():
 
 def make_dialog():
     # entry point to PyMOL's API
-    import tempfile
-    import requests
     from pymol.Qt import QtGui, QtWidgets
-    global nanome_logo_path
-
-    loading_gif = requests.get(loading_gif_url)
-    gif_temp = tempfile.NamedTemporaryFile(suffix=".gif", delete=False)
-    with open(gif_temp.name, "wb") as f:
-        f.write(loading_gif.content)
-
-    nanome_jpg = requests.get(nanome_logo_url)
-    local_nanome_logo = tempfile.NamedTemporaryFile(
-        suffix=".jpg", delete=False)
-    nanome_logo_path = local_nanome_logo.name
-    with open(nanome_logo_path, "wb") as f:
-        f.write(nanome_jpg.content)
 
     # create a new Window
     dialog = QtWidgets.QDialog()
 
-    dialog.setWindowIcon(QtGui.QIcon(nanome_logo_path))
     dialog.setWindowTitle("Send session to Nanome")
     dialog.setWindowModality(False)
-    dialog.setFixedSize(305, 200)
+    dialog.setFixedSize(305, 380)
     dialog.setWindowFlags(QtCore.Qt.WindowStaysOnTopHint)
 
     layout = QtWidgets.QVBoxLayout(dialog)
 
+    # Text logo and progress bar until the images are in the cache
     label = QtWidgets.QLabel()
-    gif = QtGui.QMovie(gif_temp.name)
-    gif.setScaledSize(QtCore.QSize(305, 200))
-    label.setMovie(gif)
     label.hide()
+    busy = QtWidgets.QProgressBar()
+    busy.setRange(0, 0)
+    busy.setTextVisible(False)
+    busy.hide()
 
-    label_logo = QtWidgets.QLabel()
-    pixmap = QtGui.QPixmap(nanome_logo_path).scaled(
-        325, 325, QtCore.Qt.KeepAspectRatio, transformMode=QtCore.Qt.SmoothTransformation)
-    label_logo.setPixmap(pixmap)
+    label_logo = QtWidgets.QLabel("Nanome")
+    label_logo.setAlignment(QtCore.Qt.AlignCenter)
     label_logo.show()
 
+    gif = QtGui.QMovie()
+    gif.setScaledSize(QtCore.QSize(305, 200))
+
+    def apply_resources():
+        logo_path = cached_resource("nanome_logo.jpg")
+        if logo_path is not None:
+            dialog.setWindowIcon(QtGui.QIcon(logo_path))
+            pixmap = QtGui.QPixmap(logo_path).scaled(
+                325, 325, QtCore.Qt.KeepAspectRatio, transformMode=QtCore.Qt.SmoothTransformation)
+            label_logo.setPixmap(pixmap)
+        gif_path = cached_resource("loading.gif")
+        if gif_path is not None and not gif.fileName():
+            gif.setFileName(gif_path)
+            label.setMovie(gif)
+
+    def start_animation():
+        if gif.fileName():
+            gif.start()
+            label.show()
+        else:
+            busy.show()
+        label_logo.hide()
+
+    def stop_animation():
+        gif.stop()
+        label.hide()
+        busy.hide()
+        label_logo.show()
+
+    apply_resources()
+    if resource_loader is not None:
+        resource_loader.loaded.connect(apply_resources)
+
+    label_progress = QtWidgets.QLabel()
+    label_progress.setAlignment(QtCore.Qt.AlignCenter)
+    label_progress.hide()
+    # Depth and throughput of the send queue
+    label_queue = QtWidgets.QLabel()
+    label_queue.setAlignment(QtCore.Qt.AlignCenter)
+    label_queue.hide()
+
+    stage_names = {
+        "snapshot": "Reading session",
+        "extract": "Extracting representations",
+        "serialize": "Writing structures",
+        "mesh": "Exporting surfaces",
+        "archive": "Writing archive",
+        "upload": "Uploading",
+    }
+
     def close_dialog():
         dialog.close()
-        gif.stop()
+        stop_animation()
+        label_progress.hide()
+        buttonCancel.hide()
+
+    def show_stage(stage, done, total):
+        text = stage_names.get(stage, stage)
+        if total > 1:
+            text += " %d / %d" % (done, total)
+        label_progress.setText(text)
+        label_progress.show()
+
+    def show_progress(sent, total, rate):
+        mb = 1024.0 * 1024.0
+        label_progress.setText("Uploading %.1f / %.1f MB (%.1f MB/s)" % (
+            sent / mb, total / mb, rate / mb))
+        label_progress.show()
 
     def send_to_nanome():
-        import tempfile
-        global sending_thread, sending_worker
-        gif.start()
-        label.show()
-        label_logo.hide()
-
+        from pymol import CmdException
         try:
-            pse_file = tempfile.NamedTemporaryFile(
-                delete=False, suffix=".pse", prefix="Pymol_").name
-            cmd.save(pse_file)
-            temp_session = PymolToMolz(pse_file).export_to_molz()
-            os.remove(pse_file)
-        except Exception as e:
-            print(f"Could not convert current session to molz file: {e}")
+            frames = parse_frames(text_frames.text())
+            objects = scoped_objects(text_selection.text(),
+                                     check_visible.isChecked(),
+                                     check_in_view.isChecked())
+        except (CmdException, ValueError) as e:
+            label_progress.setText(str(e).strip())
+            label_progress.show()
             return
-
-        print("Sending current session file to Nanome")
-        gif.start()
-
-        sending_thread = QtCore.QThread()
-        sending_worker = Worker()
-        sending_worker.session_path = temp_session
-        sending_worker.moveToThread(sending_thread)
-        sending_thread.started.connect(sending_worker.run)
-        sending_worker.finished.connect(sending_thread.quit)
-        sending_worker.finished.connect(sending_worker.deleteLater)
-        sending_thread.finished.connect(sending_thread.deleteLater)
-        sending_thread.finished.connect(close_dialog)
-        sending_thread.start()
+        if objects is not None and not objects:
+            label_progress.setText("No object to send")
+            label_progress.show()
+            return
+        start_animation()
+        buttonCancel.show()
+        # Sending again before the export started sends once
+        job = get_send_queue().submit(SendJob(
+            objects, frames, stage=send_signals.stage.emit,
+            progress=send_signals.progress.emit,
+            login_required=send_signals.login_required.emit,
+            done=send_signals.finished.emit, meshes=check_meshes.isChecked()))
+        if job not in sending_jobs:
+            sending_jobs.append(job)
+
+    def send_finished(reason):
+        sending_jobs[:] = [job for job in sending_jobs if not job.finished()]
+        if not sending_jobs:
+            close_dialog()
+
+    def login_again():
+        if login_dialog is not None:
+            login_dialog.show()
+
+    def cancel_send():
+        for job in sending_jobs:
+            job.cancel()
+
+    def show_queue_status(stats):
+        label_queue.setText("Queue: " + format_queue_stats(stats))
+        label_queue.show()
+
+    # Sends of the dialog not finished yet
+    sending_jobs = []
+    send_signals = SendSignals(dialog)
+    send_signals.stage.connect(show_stage)
+    send_signals.progress.connect(show_progress)
+    send_signals.login_required.connect(login_again)
+    send_signals.finished.connect(send_finished)
+    queue_status = StatusRelay(dialog)
+    queue_status.changed.connect(show_queue_status)
+    get_send_queue().on_status = queue_status.changed.emit
+
+    def toggle_live_sync(checked):
+        global live_sync
+        from pymol import CmdException
+        if live_sync is not None:
+            live_sync.stop()
+            live_sync = None
+        if not checked:
+            label_progress.hide()
+            return
+        try:
+            frames = parse_frames(text_frames.text())
+            scoped_objects(text_selection.text(), check_visible.isChecked())
+        except (CmdException, ValueError) as e:
+            label_progress.setText(str(e).strip())
+            label_progress.show()
+            check_live.setChecked(False)
+            return
+        live_sync = LiveSync(get_send_queue(), text_selection.text(),
+                             check_visible.isChecked(), frames,
+                             on_status=live_status.changed.emit)
+        live_sync.start()
+        label_progress.setText("Live sync: sending the session")
+        label_progress.show()
+
+    def show_live_status(stats):
+        label_progress.setText("Live: " + format_live_stats(stats))
+        label_progress.show()
+        if live_sync is None or not live_sync.running():
+            # Stopped, e.g. when the login expired
+            check_live.setChecked(False)
+
+    live_status = StatusRelay(dialog)
+    live_status.changed.connect(show_live_status)
+
+    # Objects and states of multi-state objects to send
+    text_selection = QtWidgets.QLineEdit(dialog)
+    text_selection.setPlaceholderText("Objects in selection: all")
+    check_visible = QtWidgets.QCheckBox("Enabled objects only", dialog)
+    check_in_view = QtWidgets.QCheckBox("Objects in view only", dialog)
+    text_frames = QtWidgets.QLineEdit(dialog)
+    text_frames.setPlaceholderText("Frames: all, or first:last:stride")
+    # Surfaces as Pymol computed them
+    check_meshes = QtWidgets.QCheckBox("Send surface meshes", dialog)
+    # Sends the session again after each change
+    check_live = QtWidgets.QCheckBox("Live sync", dialog)
+    check_live.toggled.connect(toggle_live_sync)
 
     buttonSend = QtWidgets.QPushButton('Send session to Nanome', dialog)
     buttonSend.clicked.connect(send_to_nanome)
+    buttonCancel = QtWidgets.QPushButton('Cancel', dialog)
+    buttonCancel.clicked.connect(cancel_send)
+    buttonCancel.hide()
     layout.addWidget(label)
+    layout.addWidget(busy)
     layout.addWidget(label_logo)
+    layout.addWidget(label_progress)
+    layout.addWidget(label_queue)
     layout.addStretch()
+    layout.addWidget(text_selection)
+    layout.addWidget(check_visible)
+    layout.addWidget(check_in_view)
+    layout.addWidget(text_frames)
+    layout.addWidget(check_meshes)
+    layout.addWidget(check_live)
     layout.addWidget(buttonSend)
+    layout.addWidget(buttonCancel)
 
     return dialog
 
 
-class Worker(QtCore.QObject):
-    finished = QtCore.pyqtSignal()
-    session_path = ""
+# Qt objects of the plugin's dialogs, not available in a headless Pymol
+# without Qt bindings
+if QtCore is not None:
+    class ResourceLoader(QtCore.QObject):
+        # Downloads the missing resources in a background thread, then emits
+        # loaded in the GUI thread
+        loaded = QtCore.pyqtSignal()
+
+        def start(self):
+            import threading
+            threading.Thread(target=self.download, daemon=True).start()
+
+        def download(self):
+            import requests
+            os.makedirs(resource_dir(), exist_ok=True)
+            for name, url in resources.items():
+                if cached_resource(name) is not None:
+                    continue
+                path = os.path.join(resource_dir(), name)
+                try:
+                    r = requests.get(url, timeout=10.0)
+                    r.raise_for_status()
+                    with open(path + ".part", "wb") as f:
+                        f.write(r.content)
+                    os.replace(path + ".part", path)
+                except Exception as e:
+                    print(f"Could not download {url}: {e}")
+            self.loaded.emit()
+
+
+    class LoginTask(QtCore.QObject):
+        # Logs in from a background thread, done is emitted in the GUI thread
+        # with None or the reason of the failure
+        done = QtCore.pyqtSignal(object)
+
+        def start(self, api):
+            import threading
+            def login():
+                try:
+                    reason = api.get_nanome_token()
+                except Exception as e:
+                    print("Error getting Nanome login token:", e)
+                    reason = str(e) or "login failed"
+                self.done.emit(reason)
+            threading.Thread(target=login, daemon=True).start()
+
+
+    class StatusRelay(QtCore.QObject):
+        # Stats of the send queue and of the live sync, emitted in the GUI
+        # thread
+        changed = QtCore.pyqtSignal(object)
+
+
+    class SendSignals(QtCore.QObject):
+        # Callbacks of the sends of the dialog, emitted in the GUI thread
+        # stage name, done, total
+        stage = QtCore.pyqtSignal(str, int, int)
+        # bytes sent, total bytes, throughput in bytes/s
+        progress = QtCore.pyqtSignal(int, int, float)
+        # the stored token expired and could not be renewed
+        login_required = QtCore.pyqtSignal()
+        # None once sent, or the reason of the failure
+        finished = QtCore.pyqtSignal(object)
+
+
+class SendJob():
+    # One send of the queue: the export of the objects (all of them when
+    # None) to the spool directory, then its upload. The callbacks are those
+    # of PymolToMolz and WorkspaceAPI.send_file, login_required() is called
+    # when the stored token expired and could not be renewed, done(reason)
+    # once sent (None) or failed. Failed uploads are retried later, unless
+    # retry is off.
+    def __init__(self, objects=None, frames=None, name=None,
+                 memory_limit=None, stage=None, progress=None,
+                 login_required=None, done=None, cancelled=None, retry=True,
+                 meshes=False, workers=None):
+        import threading
+        import uuid
+        self.objects = objects
+        self.frames = frames
+        self.memory_limit = memory_limit
+        self.meshes = meshes
+        self.workers = workers
+        self.name = name or "Pymol_" + uuid.uuid4().hex[:8]
+        # Queued sends with the same key are exported once
+        self.key = (None if objects is None else tuple(objects), frames,
+                    memory_limit, meshes, workers, name)
+        self.stage = stage
+        self.progress = progress
+        self.login_required = login_required
+        self.done = [done] if done is not None else []
+        self.retry = retry
+        self._cancelled = threading.Event()
+        self._external_cancelled = cancelled
+        self._finished = threading.Event()
+        self.reason = None
+        self.profile = None
+        # Spooled archive, attempts and time (epoch s) of the next upload,
+        # and the account it is sent to
+        self.path = None
+        self.attempts = 0
+        self.due = None
+        self.account = None
+
+    def cancel(self):
+        # Can be called from any thread
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set() or (
+            self._external_cancelled is not None and self._external_cancelled())
+
+    def finish(self, reason):
+        # Later retries are not reported
+        self.reason = reason
+        done, self.done = self.done, []
+        self.stage = self.progress = self.login_required = None
+        self._finished.set()
+        for callback in done:
+            callback(reason)
+
+    def finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        # Reason of the failure, None once sent
+        self._finished.wait(timeout)
+        return self.reason
+
+
+class SendQueue():
+    # Sends of the plugin: the sessions are exported one at a time in a
+    # background thread while up to max_uploads earlier ones upload. The
+    # archives are exported to a spool directory, the uploads that fail are
+    # kept there and retried with a doubling delay, also after Pymol
+    # restarts, only once logged in to the account they were exported for.
+    # They are dropped after max_attempts or max_age seconds.
+    # on_status(stats) is called from the queue threads when a send starts
+    # or ends.
+    def __init__(self, api, max_uploads=2, spool_dir=None, retry_delay=30.0,
+                 max_retry_delay=3600.0, max_attempts=8, max_age=7 * 24 * 3600.0,
+                 on_status=None):
+        import collections
+        import threading
+        self.api = api
+        self.max_uploads = max_uploads
+        self.spool_dir = spool_dir or os.path.join(config_dir(), "spool")
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.max_age = max_age
+        self.on_status = on_status
+        self._cond = threading.Condition()
+        self._exports = collections.deque()
+        self._uploads = collections.deque()
+        self._retries = []
+        self._exporting = None
+        self._uploading = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.sent_bytes = 0
+        self.upload_seconds = 0.0
+        self.load_spool()
+        threads = [self.export_loop] + [self.upload_loop] * max_uploads
+        for target in threads:
+            threading.Thread(target=target, daemon=True).start()
+
+    def load_spool(self):
+        # Archives left by a previous Pymol session: failed uploads, and the
+        # ones that were not sent yet. Those of no known account (from an
+        # older version of the plugin), too old or failed too many times
+        # are dropped.
+        import glob
+        import time
+        for part in glob.glob(os.path.join(self.spool_dir, "*.part")):
+            os.remove(part)
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.molz"))):
+            meta = {}
+            try:
+                with open(path[:-len(".molz")] + ".json") as f:
+                    meta = json.load(f)
+                age = time.time() - os.path.getmtime(path)
+            except (OSError, ValueError):
+                age = None
+            job = SendJob(name=meta.get("name"))
+            job.path = path
+            job.attempts = meta.get("attempts", 0)
+            job.due = meta.get("due") or 0.0
+            job.account = meta.get("account")
+            if (job.account is None or age is None or age > self.max_age
+                    or job.attempts >= self.max_attempts):
+                self.remove_spooled(job)
+                continue
+            self._retries.append(job)
+
+    def sendable(self, job):
+        # Retries wait for a login to the account of their archive
+        return job.account is not None and job.account == self.api.account \
+            and self.api.has_token()
+
+    def save_meta(self, job):
+        # Without it, the archive is dropped in the next Pymol session
+        try:
+            with open(job.path[:-len(".molz")] + ".json", "w") as f:
+                json.dump({"name": job.name, "attempts": job.attempts,
+                           "due": job.due, "account": job.account}, f)
+        except OSError as e:
+            print(f"Could not save the retry state of {job.name}: {e}")
+
+    def remove_spooled(self, job):
+        for path in (job.path, job.path[:-len(".molz")] + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not remove {path}: {e}")
+
+    def submit(self, job):
+        # Returns the job that will send the session: job, or a queued one
+        # with the same key that was not exported yet
+        with self._cond:
+            for queued in self._exports:
+                if queued.key == job.key and not queued.cancelled():
+                    queued.done += job.done
+                    self.coalesced += 1
+                    return queued
+            self._exports.append(job)
+            self._cond.notify_all()
+        self.report()
+        return job
+
+    def retry_now(self):
+        # Retries the spooled uploads without waiting, e.g. after a login
+        with self._cond:
+            for job in self._retries:
+                job.due = 0.0
+            self._cond.notify_all()
+
+    def clear(self):
+        # Forgets the spooled uploads, and their archives
+        with self._cond:
+            retries, self._retries = self._retries, []
+        for job in retries:
+            self.remove_spooled(job)
+        self.report()
+        return len(retries)
+
+    def export_loop(self):
+        while True:
+            with self._cond:
+                # Runs ahead of the uploads by max_uploads archives at most
+                while not self._exports or len(self._uploads) >= self.max_uploads:
+                    self._cond.wait()
+                job = self._exports.popleft()
+                self._exporting = job
+            self.report()
+            self.export(job)
+            with self._cond:
+                self._exporting = None
+                if not job.finished():
+                    self._uploads.append(job)
+                self._cond.notify_all()
+            self.report()
+
+    def export(self, job):
+        # Snapshot and conversion of the session to the spool directory
+        import uuid
+        profile = SendProfile(job.name, cprofile=profile_exports)
+        record_profile(profile)
+        job.profile = profile
+        try:
+            # Validated (and renewed if needed) once per send
+            reason = self.api.ensure_token(profile)
+            if reason is not None:
+                print(f"Could not send the session to Nanome: {reason}")
+                profile.status = reason
+                if job.login_required is not None:
+                    job.login_required()
+                job.finish(reason)
+                return
+            job.account = self.api.account
+            os.makedirs(self.spool_dir, exist_ok=True)
+            molz = PymolToMolz(name=job.name, progress=job.stage,
+                               cancelled=job.cancelled, profile=profile,
+                               frames=job.frames, objects=job.objects,
+                               memory_limit=job.memory_limit,
+                               meshes=job.meshes, workers=job.workers)
+            job.path = molz.export_to_molz(molz_path=os.path.join(
+                self.spool_dir, uuid.uuid4().hex + ".molz"))
+            if job.retry:
+                self.save_meta(job)
+        except ExportCancelled:
+            profile.status = "cancelled"
+            print("Sending the session to Nanome was cancelled")
+            job.finish(profile.status)
+        except Exception as e:
+            profile.status = f"failed: {e}"
+            print(f"Could not convert current session to molz file: {e}")
+            job.finish(profile.status)
+
+    def upload_loop(self):
+        import time
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    retries = [j for j in self._retries if self.sendable(j)]
+                    for job in [j for j in retries if j.due <= now]:
+                        self._retries.remove(job)
+                        self._uploads.append(job)
+                    if self._uploads:
+                        break
+                    # Until retry_now() when logged out
+                    due = min((j.due for j in retries if j.due > now),
+                              default=None)
+                    self._cond.wait(None if due is None else due - now)
+                job = self._uploads.popleft()
+                self._uploading += 1
+                self._cond.notify_all()
+            self.report()
+            try:
+                self.upload(job)
+            finally:
+                with self._cond:
+                    self._uploading -= 1
+                    self._cond.notify_all()
+            self.report()
+
+    def upload(self, job):
+        # Never raises: the job is always finished, sent or failed
+        try:
+            self.try_upload(job)
+        except Exception as e:
+            print(f"Could not send the session file to Nanome: {e}")
+            self.upload_failed(job, f"failed: {e}")
+
+    def try_upload(self, job):
+        import time
+        if job.cancelled():
+            self.remove_spooled(job)
+            job.finish("cancelled")
+            return
+        profile = job.profile or SendProfile(job.name)
+        if job.profile is None:
+            record_profile(profile)
+        print("Sending current session file to Nanome")
+        if job.stage is not None:
+            job.stage("upload", 0, 1)
+        size = os.path.getsize(job.path)
+        start = time.perf_counter()
+        # The archive is removed once sent
+        reason = self.api.send_file(job.path, job.name, progress=job.progress,
+                                    profile=profile)
+        job.profile = None
+        if reason is None:
+            with self._cond:
+                self.sent += 1
+                self.sent_bytes += size
+                self.upload_seconds += time.perf_counter() - start
+            self.remove_spooled(job)
+            job.finish(None)
+            return
+        if not self.api.has_token() and job.login_required is not None:
+            job.login_required()
+        self.upload_failed(job, reason)
+
+    def upload_failed(self, job, reason):
+        # Spools the job for a later retry, or gives up. The job is finished
+        # either way. Failures for want of a login are not counted, the job
+        # is retried after the next one.
+        import time
+        try:
+            job.profile = None
+            if self.api.has_token():
+                job.attempts += 1
+            spooled = job.path is not None and os.path.exists(job.path)
+            if not job.retry or not spooled:
+                if job.path is not None:
+                    self.remove_spooled(job)
+                with self._cond:
+                    self.failed += 1
+            elif job.attempts >= self.max_attempts:
+                print(f"Giving up sending {job.name} to Nanome after "
+                      f"{job.attempts} attempts")
+                self.remove_spooled(job)
+                with self._cond:
+                    self.failed += 1
+            else:
+                delay = min(self.retry_delay * 2 ** max(job.attempts - 1, 0),
+                            self.max_retry_delay)
+                print(f"Sending {job.name} to Nanome again in {delay:.0f}s")
+                job.due = time.time() + delay
+                self.save_meta(job)
+                with self._cond:
+                    self._retries.append(job)
+                    self._cond.notify_all()
+        finally:
+            job.finish(reason)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._exports),
+                "exporting": int(self._exporting is not None),
+                "waiting": len(self._uploads),
+                "uploading": self._uploading,
+                "retrying": len(self._retries),
+                "depth": len(self._exports) + len(self._uploads)
+                + len(self._retries) + self._uploading
+                + int(self._exporting is not None),
+                "sent": self.sent, "failed": self.failed,
+                "coalesced": self.coalesced, "sent_bytes": self.sent_bytes,
+                "bytes_per_second": self.sent_bytes / self.upload_seconds
+                if self.upload_seconds else None,
+            }
+
+    def report(self):
+        if self.on_status is not None:
+            self.on_status(self.stats())
+
+
+def format_queue_stats(stats):
+    parts = ["%d %s" % (stats[key], label) for key, label in (
+        ("queued", "queued"), ("exporting", "exporting"),
+        ("waiting", "to upload"), ("uploading", "uploading"),
+        ("retrying", "to retry")) if stats[key]]
+    text = ", ".join(parts or ["empty"])
+    text += ", %d sent" % stats["sent"]
+    if stats["bytes_per_second"] is not None:
+        text += " at %.1f MB/s" % (stats["bytes_per_second"] / 1024.0 / 1024.0)
+    if stats["failed"]:
+        text += ", %d failed" % stats["failed"]
+    return text
+
+
+def get_send_queue():
+    # The send queue of the plugin, started on first use
+    global send_queue, workspace_api
+    if workspace_api is None:
+        workspace_api = WorkspaceAPI()
+    if send_queue is None:
+        send_queue = SendQueue(workspace_api)
+    return send_queue
+
+
+def nanome_queue(action="status"):
+    '''
+DESCRIPTION
+
+    Prints the sends waiting in the plugin's queue, with the upload
+    throughput, or retries now or forgets the uploads that failed.
+
+USAGE
+
+    nanome_queue [ action ]
+
+ARGUMENTS
+
+    action = status, retry or clear {default: status}
+
+EXAMPLE
+
+    nanome_queue retry
+    '''
+    queue = get_send_queue()
+    if action == "retry":
+        queue.retry_now()
+    elif action == "clear":
+        print("%d failed sends forgotten" % queue.clear())
+    elif action != "status":
+        print("Queue action must be status, retry or clear")
+        return
+    print("Nanome send queue: " + format_queue_stats(queue.stats()))
+
+
+def nanome_send(selection="", visible_only=0, in_view=0, frames="", wait=0,
+                memory_limit=0, meshes=0, workers=0):
+    '''
+DESCRIPTION
+
+    Sends the molecular objects to Nanome: all of them, those with atoms in
+    a selection, the enabled ones or those in the current view. Log in once
+    from the plugin's dialog, the token is kept for the next sends.
+
+USAGE
+
+    nanome_send [ selection [, visible_only [, in_view [, frames [, wait
+        [, memory_limit [, meshes [, workers ]]]]]]]]
+
+ARGUMENTS
+
+    selection = str: only the objects with atoms in this selection
+    {default: all}
+
+    visible_only = 0/1: only the enabled objects {default: 0}
+
+    in_view = 0/1: only the enabled objects in the current view
+    {default: 0}
+
+    frames = str: first:last:stride states of the multi-state objects
+    {default: all}
+
+    wait = 0/1: return once sent instead of sending in the background
+    {default: 0}
+
+    memory_limit = int: extract one object at a time and stop the export
+    when Pymol's resident memory, the session included, goes over this
+    many MB (of 1024 * 1024 bytes) {default: 0, no limit}
+
+    meshes = 0/1: also send the surfaces Pymol computed, as meshes
+    {default: 0}
+
+    workers = int: build the representations of the objects in this many
+    processes {default: 0, in Pymol}
+
+EXAMPLE
+
+    nanome_send sele, visible_only=1
+    '''
+    from pymol import CmdException
+    try:
+        objects = scoped_objects(selection, as_bool(visible_only),
+                                 as_bool(in_view))
+        frames = parse_frames(frames)
+        memory_limit = int(memory_limit) * 1024 * 1024 or None
+        workers = int(workers) or None
+    except (CmdException, ValueError) as e:
+        print(f"Could not send to Nanome: {e}")
+        return
+    if objects is not None and not objects:
+        print("No object to send to Nanome")
+        return
+    queue = get_send_queue()
+    if not queue.api.has_token():
+        print("Log in to Nanome first from Plugin > View in Nanome 2")
+        return
+
+    def login_required():
+        print("Log in to Nanome again from Plugin > View in Nanome 2")
+
+    job = queue.submit(SendJob(objects, frames, memory_limit=memory_limit,
+                               login_required=login_required,
+                               meshes=as_bool(meshes), workers=workers))
+    if as_bool(wait):
+        with api_lock_released():
+            return job.wait()
+
+
+@contextlib.contextmanager
+def api_lock_released():
+    # Pymol runs commands and scripts with its API lock held by the calling
+    # thread, the export thread needs it while a command waits for a send
+    released = 0
+    try:
+        while True:
+            cmd.lock_api.release()
+            released += 1
+    except RuntimeError:
+        # Not (or no longer) held by this thread
+        pass
+    try:
+        yield
+    finally:
+        for _ in range(released):
+            cmd.lock_api.acquire()
+
+
+# Representations whose atom counts are polled by live sync
+live_sync_reps = ["lines", "sticks", "spheres", "surface", "mesh", "cartoon",
+                  "ribbon", "labels", "nb_spheres", "dots"]
+
+
+class LiveSync():
+    # Sends the session to Nanome again whenever it changes. Pymol has no
+    # change notifications, so cheap counters of the session (objects, atom
+    # counts per representation and color, states, object matrices and color
+    # settings) are polled every interval seconds. Rapid edits are coalesced:
+    # a push starts once nothing changed for debounce seconds. At most one
+    # push is in flight, an export made stale by a newer change is cancelled
+    # and the latest session is pushed next.
+    # Moving atoms within the bounds of the session, per atom settings and
+    # label texts are not seen by the counters, push() sends them.
+    def __init__(self, queue, selection=None, visible_only=False, frames=None,
+                 interval=0.5, debounce=1.0, on_status=None, max_colors=32):
+        import threading
+        import uuid
+        # Pushes go through the send queue, and are not retried
+        self.queue = queue
+        self.selection = selection
+        self.visible_only = visible_only
+        self.frames = frames
+        self.interval = interval
+        self.debounce = debounce
+        # on_status(stats) is called from the sync threads after each push
+        self.on_status = on_status
+        # Atom counts of this many colors are polled, the most common ones
+        self.max_colors = max_colors
+        # The same name for every push
+        self.name = "Pymol_live_" + uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._superseded = threading.Event()
+        self._thread = None
+        self._push_thread = None
+        self._colors = []
+        self._signature = None
+        # Unpushed changes: count, time of the first and of the last one
+        self._changes = 0
+        self._first_change = None
+        self._last_change = None
+        self.pushes = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.latencies = []
+        self.poll_seconds = 0.0
+        self.polls = 0
+        self._last_poll = 0.0
+        self.last_error = None
+
+    def start(self):
+        import threading
+        # The current session is the first push
+        scope = self.scope()
+        self._colors = self.color_counts(scope[1])
+        self._signature = self.signature(scope)
+        self.mark_changed()
+        self._last_change -= self.debounce
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._superseded.set()
+
+    def running(self):
+        return self._thread is not None and not self._stopped.is_set()
 
     def run(self):
-        global workspace_api
-        # Send
-        workspace_api.send_file(self.session_path)
-        self.finished.emit()
+        # Polls at most a tenth of the time in large sessions
+        while not self._stopped.wait(max(self.interval, 10 * self._last_poll)):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Live sync to Nanome: {e}")
+
+    def scope(self):
+        # Molecular objects of the sync, and a selection of their atoms
+        objects = scoped_objects(self.selection, self.visible_only)
+        if objects is None:
+            return molecule_objects(), "all"
+        return objects, " or ".join(f"%{name}" for name in objects)
+
+    def color_counts(self, selection="all"):
+        # Most common atom colors of the objects of the sync
+        counts = {}
+        if selection:
+            cmd.iterate(selection, "counts[color] = counts.get(color, 0) + 1",
+                        space={"counts": counts})
+        return sorted(counts, key=counts.get, reverse=True)[:self.max_colors]
+
+    def signature(self, scope=None):
+        # Change counters of the objects of the sync, compared between polls
+        objects, selection = scope or self.scope()
+        signature = [cmd.get_names("objects"),
+                     cmd.get_names("objects", enabled_only=1),
+                     objects]
+        signature += [cmd.get(setting) for setting in rep_settings]
+        if not objects:
+            return signature
+        signature += [cmd.count_atoms(selection), cmd.get_extent(selection)]
+        signature += [cmd.count_atoms(f"({selection}) and rep {r}")
+                      for r in live_sync_reps]
+        signature += [cmd.count_atoms(f"({selection}) and color {c}")
+                      for c in self._colors]
+        for name in objects:
+            signature.append((cmd.count_states(f"%{name}"),
+                              cmd.get_object_state(name),
+                              cmd.get_object_matrix(name),
+                              cmd.get_object_settings(name)))
+        return signature
+
+    def mark_changed(self):
+        import time
+        with self._lock:
+            now = time.perf_counter()
+            self._changes += 1
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+
+    def poll(self):
+        # Looks for changes, then starts a push when due. Called by the
+        # polling thread, public to drive the sync without it.
+        import time
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        scope = self.scope()
+        signature = self.signature(scope)
+        if signature != self._signature:
+            # The colors may have changed too
+            self._colors = self.color_counts(scope[1])
+            self._signature = self.signature(scope)
+            self.mark_changed()
+            if self.pushing():
+                self._superseded.set()
+        # CPU time of the poll, not slowed down by a running export
+        self._last_poll = time.thread_time() - cpu_start
+        self.poll_seconds += time.perf_counter() - start
+        self.polls += 1
+        with self._lock:
+            due = (self._changes and not self.pushing()
+                   and time.perf_counter() - self._last_change >= self.debounce)
+        if due:
+            self.start_push()
+
+    def pushing(self):
+        return self._push_thread is not None and self._push_thread.is_alive()
+
+    def push(self):
+        # Sends the session now, whatever changed
+        self.mark_changed()
+        with self._lock:
+            self._last_change -= self.debounce
+        if not self._stopped.is_set() and not self.start_push():
+            # The running push is cancelled, the next poll pushes again
+            self._superseded.set()
+
+    def start_push(self):
+        # Starts a push of the pending changes, unless one is in flight.
+        # Called by push() from the GUI thread and by poll(), returns whether
+        # it started.
+        import threading
+        with self._lock:
+            if self.pushing():
+                return False
+            changes, first_change = self._changes, self._first_change
+            self._changes, self._first_change = 0, None
+            self._superseded.clear()
+            self._push_thread = threading.Thread(
+                target=self.send, args=(changes, first_change), daemon=True)
+            self._push_thread.start()
+        return True
+
+    def send(self, changes, first_change):
+        import time
+        try:
+            objects = scoped_objects(self.selection, self.visible_only)
+            if objects is not None and not objects:
+                reason = "no object to send"
+            else:
+                job = self.queue.submit(SendJob(
+                    objects, self.frames, name=self.name,
+                    cancelled=self._superseded.is_set,
+                    login_required=self.stop, retry=False))
+                reason = job.wait()
+        except Exception as e:
+            reason = str(e)
+        with self._lock:
+            if reason is None:
+                self.pushes += 1
+                self.coalesced += changes - 1
+                self.latencies.append(time.perf_counter() - first_change)
+                self.last_error = None
+            elif reason == "cancelled" and not self._stopped.is_set():
+                # Pushed again with the newer changes
+                self.dropped += 1
+                self._changes += changes
+                self._first_change = min(first_change,
+                                         self._first_change or first_change)
+            elif reason != "cancelled":
+                # Pushed again on the next change
+                self.failed += 1
+                self.last_error = reason
+        if self.on_status is not None:
+            self.on_status(self.stats())
+
+    def stats(self):
+        latencies = self.latencies
+        return {
+            "pushes": self.pushes, "failed": self.failed,
+            "coalesced": self.coalesced, "dropped": self.dropped,
+            "running": self.running(), "pushing": self.pushing(),
+            "pending": self._changes,
+            "last_latency": latencies[-1] if latencies else None,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            "max_latency": max(latencies) if latencies else None,
+            "mean_poll": self.poll_seconds / self.polls if self.polls else None,
+            "last_error": self.last_error,
+        }
 
 
-class PymolToMolz():
-    def __init__(self, pse_path):
-        import pickle
-
-        self._pse_path = pse_path
-        self._basedir = os.path.dirname(pse_path)
-        self._sdf_max_size = 150  # atoms
-        
-        # Remove atoms that are added by Pymol for missing residues
-        cmd.remove("not present and name CA and elem C")
-
-        modified_pse_path = os.path.join(self._basedir, "modified_session.pse")
-        cmd.save(modified_pse_path)
-
-        with open(modified_pse_path, "rb") as f:
-            self._pse_data = pickle.loads(f.read())
-
-
-        self._custom_colors = {}
-        for i in self._pse_data.get("colors", []):
-            self._custom_colors[i[1]] = i[2]
-
-        self._unique_settings = {}
-        for i in self._pse_data["unique_settings"]:
-            self._unique_settings[i[0]] = i[1]
-
-        self._workspace_settings_colors = {
-            'surface': None,
-            'mesh': None,
-            'cartoon': None,
-            'ribbon': None,
-            'line': None,
-            'sphere': None,
-            'ball-and-stick': None,
-            'stick': None,
-            'label': None,
+def format_live_stats(stats):
+    text = "%d pushes" % stats["pushes"]
+    if stats["last_latency"] is not None:
+        text += ", last %.1f s (mean %.1f, max %.1f)" % (
+            stats["last_latency"], stats["mean_latency"], stats["max_latency"])
+    text += ", %d coalesced, %d dropped" % (stats["coalesced"], stats["dropped"])
+    if stats["failed"]:
+        text += ", %d failed (%s)" % (stats["failed"], stats["last_error"])
+    return text
+
+
+# Live sync of the dialog and of nanome_live
+live_sync = None
+
+
+def nanome_live(action="on", selection="", visible_only=0, frames="",
+                interval=0.5, debounce=1.0):
+    '''
+DESCRIPTION
+
+    Keeps Nanome in sync with the session: the molecular objects are sent
+    again a moment after each change. Log in once from the plugin's dialog.
+
+USAGE
+
+    nanome_live [ action [, selection [, visible_only [, frames
+        [, interval [, debounce ]]]]]]
+
+ARGUMENTS
+
+    action = on, off, status or push: start or stop the sync, print its
+    push latency and coalesced updates, or send the session now
+    {default: on}
+
+    selection = str: only the objects with atoms in this selection
+    {default: all}
+
+    visible_only = 0/1: only the enabled objects {default: 0}
+
+    frames = str: first:last:stride states of the multi-state objects
+    {default: all}
+
+    interval = float: seconds between two looks for changes {default: 0.5}
+
+    debounce = float: seconds without change before sending {default: 1.0}
+
+EXAMPLE
+
+    nanome_live on, chain A, debounce=2
+    nanome_live status
+    '''
+    global live_sync
+    if action == "off":
+        if live_sync is not None:
+            live_sync.stop()
+            print("Live sync to Nanome stopped: "
+                  + format_live_stats(live_sync.stats()))
+        return
+    if action in ("status", "push"):
+        if live_sync is None or not live_sync.running():
+            print("Live sync to Nanome is off")
+        elif action == "push":
+            live_sync.push()
+        else:
+            print("Live sync to Nanome: " + format_live_stats(live_sync.stats()))
+        return
+    if action != "on":
+        print("Live sync action must be on, off, status or push")
+        return
+    try:
+        frames = parse_frames(frames)
+    except ValueError as e:
+        print(f"Could not start the live sync: {e}")
+        return
+    queue = get_send_queue()
+    if not queue.api.has_token():
+        print("Log in to Nanome first from Plugin > View in Nanome 2")
+        return
+    if live_sync is not None:
+        live_sync.stop()
+    live_sync = LiveSync(queue, selection, as_bool(visible_only),
+                         frames, float(interval), float(debounce))
+    live_sync.start()
+    print("Live sync to Nanome started")
+
+
+class MultipartUpload():
+    # multipart/form-data body read in chunks by requests, so the archive is
+    # never loaded in memory at once. Renders parts the way requests'
+    # files= encoding does.
+    def __init__(self, fields, file_name, fileobj, progress=None):
+        import uuid
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        head = b""
+        for name, value in fields.items():
+            head += (f'--{boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                     f'{value}\r\n').encode("utf-8")
+        head += (f'--{boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{file_name}"; '
+                 f'filename="{file_name}"\r\n\r\n').encode("utf-8")
+        self._head = head
+        self._tail = f'\r\n--{boundary}--\r\n'.encode("utf-8")
+        self._file = fileobj
+        self._file_start = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        self._file_size = fileobj.tell() - self._file_start
+        self._progress = progress
+        self.rewind()
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def rewind(self):
+        import time
+        self._file.seek(self._file_start)
+        self._position = 0
+        self._started = time.monotonic()
+        self._last_report = 0.0
+
+    def read(self, size=-1):
+        import time
+        if size is None or size < 0:
+            size = len(self)
+        head_size = len(self._head)
+        body_end = head_size + self._file_size
+        chunk = b""
+        if self._position < head_size:
+            chunk = self._head[self._position:self._position + size]
+        if self._position + len(chunk) >= head_size and len(chunk) < size:
+            if self._position + len(chunk) < body_end:
+                chunk += self._file.read(size - len(chunk))
+            if self._position + len(chunk) >= body_end:
+                offset = self._position + len(chunk) - body_end
+                chunk += self._tail[offset:offset + size - len(chunk)]
+        self._position += len(chunk)
+
+        if self._progress is not None:
+            now = time.monotonic()
+            if now - self._last_report >= 0.1 or self._position == len(self):
+                self._last_report = now
+                elapsed = max(now - self._started, 1e-6)
+                self._progress(self._position, len(self), self._position / elapsed)
+        return chunk
+
+
+# Private ZipFile attributes MolzWriter.write_entry() writes compressed data
+# with, checked first as they may change between Python versions
+zip_internals = ("_lock", "_writecheck", "_didModify", "start_dir", "fp",
+                 "filelist", "NameToInfo")
+
+
+class MolzWriter():
+    # Streams the assets and state.json of a .molz straight into the zip
+    # archive, written to molz_path or to a spooled buffer (kept in memory
+    # up to spool_size bytes) when molz_path is None.
+    # compresslevel 0 stores the entries, 1-9 deflates them.
+    def __init__(self, molz_path=None, compresslevel=6, spool_size=64 * 1024 * 1024):
+        import tempfile
+        import zipfile
+        self.molz_path = molz_path
+        if molz_path is None:
+            self._file = tempfile.SpooledTemporaryFile(
+                max_size=spool_size, suffix=".molz")
+        else:
+            self._file = open(molz_path, "wb")
+        if compresslevel == 0:
+            self._zip = zipfile.ZipFile(self._file, "w", zipfile.ZIP_STORED)
+        else:
+            self._zip = zipfile.ZipFile(
+                self._file, "w", zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self._zip.writestr("assets/", b"")
+        self.compression = self._zip.compression
+        self.archive = None
+        self.size = None  # of the archive, once closed
+        self.state_size = None
+
+    def write_asset(self, name, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._zip.writestr("assets/" + name, data)
+
+    def compress_asset(self, name, data):
+        # Encodes and compresses an asset without touching the archive, so
+        # it can run in a worker thread. Add the result with write_entry().
+        import time
+        import zipfile
+        import zlib
+        # Returns (ZipInfo, compressed data, seconds spent)
+        start = time.perf_counter()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        zinfo = zipfile.ZipInfo("assets/" + name, time.localtime()[:6])
+        zinfo.external_attr = 0o600 << 16
+        zinfo.compress_type = self._zip.compression
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data)
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            level = self._zip.compresslevel
+            compressor = zlib.compressobj(
+                -1 if level is None else level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        zinfo.compress_size = len(data)
+        return zinfo, data, time.perf_counter() - start
+
+    def copy_info(self, zinfo):
+        # Fresh header of an entry from another archive (an ExportCache
+        # entry), to add its data again with write_entry()
+        import zipfile
+        copy = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+        for attr in ("external_attr", "compress_type", "file_size",
+                     "CRC", "compress_size"):
+            setattr(copy, attr, getattr(zinfo, attr))
+        return copy
+
+    def write_entry(self, zinfo, data):
+        # zipfile has no API to add already compressed data: write the local
+        # header and the data the way ZipFile.open(..., "w") does. Without
+        # the internals of zipfile it relies on, the data is decompressed
+        # and added with writestr instead.
+        import zipfile
+        import zlib
+        zf = self._zip
+        if not hasattr(zinfo, "FileHeader") or not all(
+                hasattr(zf, name) for name in zip_internals):
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                data = zlib.decompress(data, -15)
+            zf.writestr(zinfo, data, compresslevel=zf.compresslevel)
+            return
+        zip64 = max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT
+        with zf._lock:
+            zf.fp.seek(zf.start_dir)
+            zinfo.header_offset = zf.fp.tell()
+            zf._writecheck(zinfo)
+            zf._didModify = True
+            zf.fp.write(zinfo.FileHeader(zip64))
+            zf.fp.write(data)
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+
+    @contextlib.contextmanager
+    def state_file(self, structures, compact=False, spool=False):
+        # Streams state.json into the archive: yields write(components),
+        # called with the components of each object as soon as they are
+        # extracted. Values are encoded by the C json encoder, and the lists
+        # and dicts shared by the components of an object (same selection or
+        # representation in several states) are encoded once. compact drops
+        # the spaces after the separators. Sets state_size once closed.
+        # With spool, the components go to a temporary file and state.json is
+        # added once complete: other entries can be added in the meantime,
+        # and structures is only read then.
+        import io
+        import shutil
+        import tempfile
+        separators = (",", ":") if compact else (", ", ": ")
+        item_sep, key_sep = separators
+        encoded = {}
+
+        def encode(value, memo=True):
+            if memo and id(value) in encoded:
+                return encoded[id(value)]
+            if isinstance(value, dict):
+                text = "{" + item_sep.join(
+                    json.dumps(k) + key_sep + encode(v) for k, v in value.items()) + "}"
+            elif isinstance(value, list) and value and isinstance(value[0], dict):
+                text = "[" + item_sep.join(encode(v) for v in value) + "]"
+                memo = False
+            elif isinstance(value, list):
+                text = json.dumps(value, separators=separators)
+            else:
+                return json.dumps(value)
+            if memo:
+                encoded[id(value)] = text
+            return text
+
+        def write(components):
+            for component in components:
+                if write.count:
+                    f.write(item_sep)
+                f.write(encode(component, memo=False))
+                write.count += 1
+            # The components of an object share nothing with the next ones
+            encoded.clear()
+        write.count = 0
+
+        def head():
+            return "{" + item_sep.join([
+                '"Version"' + key_sep + '"0.0.1"',
+                '"Structures"' + key_sep + encode(structures, memo=False),
+                '"Components"' + key_sep + "["])
+
+        def open_state():
+            return io.TextIOWrapper(self._zip.open("state.json", "w"),
+                                    encoding="utf-8")
+
+        if spool:
+            with io.TextIOWrapper(tempfile.TemporaryFile(), encoding="utf-8") as f:
+                yield write
+                f.seek(0)
+                with open_state() as state:
+                    state.write(head())
+                    shutil.copyfileobj(f, state, 1024 * 1024)
+                    state.write("]}")
+        else:
+            with open_state() as f:
+                f.write(head())
+                yield write
+                f.write("]}")
+        self.state_size = self._zip.getinfo("state.json").file_size
+
+    def close(self):
+        if self.archive is not None:
+            return self.archive
+        self._zip.close()
+        self.size = self._file.tell()
+        if self.molz_path is None:
+            self._file.seek(0)
+            self.archive = self._file
+        else:
+            self._file.close()
+            self.archive = self.molz_path
+        return self.archive
+
+    def discard(self):
+        # Drop a partially written archive, without writing its central
+        # directory first
+        self._zip.fp = None
+        self._file.close()
+        if self.molz_path is not None and os.path.exists(self.molz_path):
+            os.remove(self.molz_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class ExportCache():
+    # Size-bounded LRU cache of exported structure entries and components,
+    # keyed by object fingerprints (see PymolToMolz.object_fingerprint), so
+    # unchanged objects are not exported again on the next send
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        if key not in self._entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][1]
+
+    def put(self, key, value, size):
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[0]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (size, value)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._size -= self._entries.popitem(last=False)[1][0]
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self._size,
+                "max_bytes": self.max_bytes, "hits": self.hits,
+                "misses": self.misses}
+
+
+# Export cache shared by the sends of this Pymol session
+export_cache = ExportCache()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+def current_rss():
+    # Resident memory of the process in bytes, None when unknown
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class MemoryMonitor():
+    # Peak resident memory of the process during an export, sampled in a
+    # background thread while entered, and the limit (bytes) it must stay
+    # under. The limit is on the whole process, the session and whatever
+    # Pymol used before the export included (start_rss).
+    # The export calls check() between objects: it raises
+    # MemoryLimitExceeded once the limit was crossed. The peak is added to
+    # the "memory" counters of profile on exit.
+    def __init__(self, limit=None, profile=None, interval=0.02):
+        import threading
+        self.limit = limit
+        self.profile = profile
+        self.interval = interval
+        self.start_rss = self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return rss
+
+    def near_limit(self, fraction=0.8):
+        rss = self.sample()
+        return self.limit is not None and rss is not None and rss > fraction * self.limit
+
+    def check(self):
+        self.sample()
+        if self.limit is not None and self.peak is not None and self.peak > self.limit:
+            raise MemoryLimitExceeded(
+                f"the export went over the memory limit of "
+                f"{self.limit / 1024 / 1024:.0f} MB "
+                f"({self.peak / 1024 / 1024:.0f} MB)")
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        import threading
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        if self.profile is not None:
+            if self.peak is not None:
+                self.profile.count("memory", "peak_rss", self.peak)
+                self.profile.count("memory", "start_rss", self.start_rss)
+            if self.limit is not None:
+                self.profile.count("memory", "limit", self.limit)
+
+
+class SendProfile():
+    # Timers and counters of the stages of one send: the export_to_molz
+    # stages (snapshot, extract, serialize, archive), login and upload.
+    # With cprofile set, the export is also run under cProfile.
+    def __init__(self, name=None, cprofile=False):
+        import time
+        self.name = name
+        self.started = time.time()
+        self.stages = {}
+        self.status = None
+        self.cprofile = cprofile
+        self.cprofile_stats = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Adds the time spent in the with block to the stage
+        import time
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name, "seconds", time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def capture(self):
+        # Runs the with block under cProfile when cprofile is set. Only the
+        # calling thread is profiled.
+        if not self.cprofile:
+            yield
+            return
+        import cProfile
+        import io
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(25)
+            self.cprofile_stats = out.getvalue()
+
+    def count(self, stage, counter, value=1):
+        counters = self.stages.setdefault(stage, {"seconds": 0.0})
+        counters[counter] = counters.get(counter, 0) + value
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "seconds": sum(s["seconds"] for s in self.stages.values()),
+            "status": self.status,
+            "stages": self.stages,
+            "cprofile": self.cprofile_stats,
         }
 
-        for setting in self._pse_data["settings"]:
-            if setting[0] == 144 and setting[2] >= 0:
-                self._workspace_settings_colors["surface"] = setting[2]
-            elif setting[0] == 236 and setting[2] >= 0:
-                self._workspace_settings_colors["cartoon"] = setting[2]
-            elif setting[0] == 235 and setting[2] >= 0:
-                self._workspace_settings_colors["ribbon"] = setting[2]
-            elif setting[0] == 526 and setting[2] >= 0:
-                self._workspace_settings_colors["line"] = setting[2]
-            elif setting[0] == 146 and setting[2] >= 0:
-                self._workspace_settings_colors["mesh"] = setting[2]
-            elif setting[0] == 173 and setting[2] >= 0:
-                self._workspace_settings_colors["sphere"] = setting[2]
-            elif setting[0] == 376 and setting[2] >= 0:
-                self._workspace_settings_colors["ball-and-stick"] = setting[2]
+
+# Profiles of the last sends, most recent last, see nanome_profile
+send_profiles = []
+max_send_profiles = 50
+# Capture a cProfile of the export of the next sends
+profile_exports = False
+
+
+def record_profile(profile):
+    send_profiles.append(profile)
+    del send_profiles[:-max_send_profiles]
+
+
+def as_bool(value):
+    # Boolean argument of a Pymol command
+    return str(value).lower() in ("1", "on", "true", "yes")
+
+
+def nanome_profile(count=5, cprofile=None, json_path=None):
+    '''
+DESCRIPTION
+
+    Prints the time spent in each stage of the last sends to Nanome, with
+    their atom and byte counters.
+
+USAGE
+
+    nanome_profile [ count [, cprofile [, json_path ]]]
+
+ARGUMENTS
+
+    count = int: number of sends to print {default: 5}
+
+    cprofile = on/off: profile the export of the next sends with cProfile,
+    the top functions are printed with their breakdown {default: unchanged}
+
+    json_path = str: also write the report of these sends to this file
+    '''
+    import time
+    global profile_exports
+    if cprofile is not None:
+        profile_exports = as_bool(cprofile)
+        print(f"cProfile of the exports {'on' if profile_exports else 'off'}")
+    count = int(count)
+    profiles = [p.as_dict() for p in send_profiles[-count:]] if count > 0 else []
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(profiles, f, indent=2)
+    if not send_profiles:
+        print("No send to Nanome yet")
+    for p in profiles:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(p["started"]))
+        print(f"{p['name']} at {started}: {p['seconds']:.3f} s, {p['status']}")
+        for stage, counters in p["stages"].items():
+            others = ", ".join(
+                f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in counters.items() if k != "seconds")
+            print(f"  {stage:<10} {counters['seconds']:8.3f} s  {others}")
+        if p["cprofile"]:
+            print(p["cprofile"])
+    return profiles
+
+
+# Pymol settings used by the representations:
+# setting id: (value, representations it applies to in the unique settings
+# of atoms and bonds, representation it applies to in the object and global
+# settings)
+# https://github.com/schrodinger/pymol-open-source/blob/abd9579a97b9864c6a40ba7b91dd330ef64d14a5/layer1/SettingInfo.h
+rep_settings = {
+    144: ("color", ("surface",), "surface"),  # surface_color
+    146: ("color", ("mesh",), "mesh"),  # mesh_color
+    173: ("color", ("ball-and-stick",), "sphere"),  # sphere_color
+    235: ("color", ("ribbon",), "ribbon"),  # ribbon_color
+    236: ("color", ("cartoon",), "cartoon"),  # cartoon_color
+    376: ("color", ("stick", "ball-and-stick"), "ball-and-stick"),  # stick_color
+    526: ("color", ("line",), "line"),  # line_color
+}
+rep_kinds = ['surface', 'mesh', 'cartoon', 'ribbon', 'line', 'sphere',
+             'ball-and-stick', 'stick', 'label']
+
+
+class SettingsResolver():
+    # rep_settings values of a session, compiled once per export into
+    # lookup tables indexed by unique setting id, and the RGBA of its colors
+    def __init__(self, session):
+        self.custom_colors = {}
+        for i in session.get("colors", []):
+            self.custom_colors[i[1]] = i[2]
+        self.unique_settings = {}
+        for i in session["unique_settings"]:
+            self.unique_settings[i[0]] = i[1]
+        self._tables = {}
+        self._rgba = {}
+        self._palette = {}
+
+    def take_colors(self):
+        # RGB of Pymol's named colors, read with the snapshot (with the API
+        # lock held) so that colors changed during the export don't apply
+        for name, index in cmd.get_color_indices(1):
+            if index not in self.custom_colors:
+                self._palette[index] = cmd.get_color_tuple(index)
+
+    def add_unique_settings(self, unique_settings):
+        # Unique settings of another snapshot of the same session, the
+        # tables are compiled again when there are new ones
+        for i in unique_settings:
+            if i[0] not in self.unique_settings:
+                self.unique_settings[i[0]] = i[1]
+                self._tables = {}
+
+    def object_values(self, settings, value="color"):
+        # Per representation value of object or global settings, None when
+        # not set. Negative values are ignored, the last setting wins.
+        values = dict.fromkeys(rep_kinds)
+        for setting in settings or []:
+            entry = rep_settings.get(setting[0])
+            if entry is not None and entry[0] == value and setting[2] >= 0:
+                values[entry[2]] = setting[2]
+        return values
+
+    def tables(self, value="color"):
+        # For each representation, the value of every unique setting id
+        # (-1 when not set), from the first of its settings that applies
+        import numpy as np
+        if value not in self._tables:
+            size = max(self.unique_settings, default=-1) + 1
+            tables = {}
+            for setting_id, settings in self.unique_settings.items():
+                resolved = set()
+                for s in settings:
+                    entry = rep_settings.get(s[0])
+                    if entry is None or entry[0] != value:
+                        continue
+                    for rep_name in entry[1]:
+                        if rep_name in resolved:
+                            continue
+                        resolved.add(rep_name)
+                        if rep_name not in tables:
+                            tables[rep_name] = np.full(size, -1, dtype=np.int64)
+                        tables[rep_name][setting_id] = s[2]
+            self._tables[value] = tables
+        return self._tables[value]
+
+    def unique_values(self, setting_ids, rep_name, value="color"):
+        # Value of rep_name for each unique setting id, -1 when not set
+        import numpy as np
+        setting_ids = np.asarray(setting_ids, dtype=np.int64)
+        values = np.full(len(setting_ids), -1, dtype=np.int64)
+        table = self.tables(value).get(rep_name)
+        if table is not None:
+            valid = (setting_ids >= 0) & (setting_ids < len(table))
+            values[valid] = table[setting_ids[valid]]
+        return values
+
+    def rgba(self, color):
+        # [r, g, b, a] (0-255) of a color index, custom colors first, then
+        # the named colors of take_colors(). Others, like the 0x40rrggbb
+        # colors, are read from Pymol.
+        if color not in self._rgba:
+            if color in self.custom_colors:
+                rgb = self.custom_colors[color]
+            elif color in self._palette:
+                rgb = self._palette[color]
+            else:
+                with cmd.lockcm:
+                    rgb = cmd.get_color_tuple(color)
+            self._rgba[color] = [floor(c * 255) for c in rgb] + [255]
+        return list(self._rgba[color])
+
+
+class ObjectColors():
+    # The colors the components of one object can use, resolved up front so
+    # that they can be built in a worker process without Pymol: the values
+    # of the color unique settings of the setting ids it uses, and the RGBA
+    # of every color they and its atoms give
+    def __init__(self, settings, columns, bond_settings, options):
+        import numpy as np
+        setting_ids = np.concatenate([columns[:, 3], bond_settings])
+        self.setting_ids = np.unique(setting_ids[setting_ids >= 0])
+        self.values = {}
+        colors = set(np.unique(columns[:, 2]).tolist())
+        for rep_name in settings.tables():
+            values = settings.unique_values(self.setting_ids, rep_name)
+            self.values[rep_name] = values
+            colors.update(values[values >= 0].tolist())
+        for values in (options["complex_colors"], options["workspace_colors"]):
+            colors.update(c for c in values.values() if c)
+        self.rgba = {}
+        for color in colors:
+            try:
+                self.rgba[color] = settings.rgba(color)
+            except Exception:
+                # Like in this process, only an error if the color is used
+                pass
+        self._libraries = {}
+
+    def unique_values(self, setting_ids, rep_name):
+        # See SettingsResolver.unique_values()
+        import numpy as np
+        values = np.full(len(setting_ids), -1, dtype=np.int64)
+        table = self.values.get(rep_name)
+        if table is not None and len(self.setting_ids):
+            index = np.searchsorted(self.setting_ids, setting_ids)
+            index = np.minimum(index, len(self.setting_ids) - 1)
+            found = self.setting_ids[index] == setting_ids
+            values[found] = table[index[found]]
+        return values
+
+    def color_library(self, color_set):
+        # See PymolToMolz.color_library()
+        key = tuple(color_set)
+        if key not in self._libraries:
+            self._libraries[key] = [list(self.rgba[c]) for c in color_set]
+        return self._libraries[key]
+
+
+def msgpack_dumps(value):
+    # MessagePack encoding of None, bools, ints, floats, strings, bytes,
+    # lists and dicts, enough for BinaryCIF without the msgpack package
+    import struct
+    out = []
+
+    def header(size, fix, fix_max, codes):
+        if size <= fix_max and fix is not None:
+            out.append(bytes([fix | size]))
+        elif size < 0x100 and codes[0] is not None:
+            out.append(struct.pack(">BB", codes[0], size))
+        elif size < 0x10000:
+            out.append(struct.pack(">BH", codes[1], size))
+        else:
+            out.append(struct.pack(">BI", codes[2], size))
+
+    def pack(v):
+        if v is None:
+            out.append(b"\xc0")
+        elif v is True or v is False:
+            out.append(b"\xc3" if v else b"\xc2")
+        elif isinstance(v, int):
+            if 0 <= v < 0x80:
+                out.append(bytes([v]))
+            elif -32 <= v < 0:
+                out.append(struct.pack(">b", v))
+            elif v >= 0:
+                for code, fmt, limit in ((0xcc, ">BB", 8), (0xcd, ">BH", 16),
+                                         (0xce, ">BI", 32), (0xcf, ">BQ", 64)):
+                    if v < 1 << limit:
+                        out.append(struct.pack(fmt, code, v))
+                        break
+            else:
+                for code, fmt, limit in ((0xd0, ">Bb", 7), (0xd1, ">Bh", 15),
+                                         (0xd2, ">Bi", 31), (0xd3, ">Bq", 63)):
+                    if v >= -(1 << limit):
+                        out.append(struct.pack(fmt, code, v))
+                        break
+        elif isinstance(v, float):
+            out.append(struct.pack(">Bd", 0xcb, v))
+        elif isinstance(v, str):
+            data = v.encode("utf-8")
+            header(len(data), 0xa0, 31, (0xd9, 0xda, 0xdb))
+            out.append(data)
+        elif isinstance(v, (bytes, bytearray)):
+            header(len(v), None, -1, (0xc4, 0xc5, 0xc6))
+            out.append(bytes(v))
+        elif isinstance(v, (list, tuple)):
+            header(len(v), 0x90, 15, (None, 0xdc, 0xdd))
+            for item in v:
+                pack(item)
+        elif isinstance(v, dict):
+            header(len(v), 0x80, 15, (None, 0xde, 0xdf))
+            for key, item in v.items():
+                pack(key)
+                pack(item)
+        else:
+            raise TypeError(f"cannot encode {type(v).__name__} in msgpack")
+
+    pack(value)
+    return b"".join(out)
+
+
+# BinaryCIF data types
+# https://github.com/molstar/BinaryCIF/blob/master/encoding.md
+bcif_types = {"i1": 1, "i2": 2, "i4": 3, "u1": 4, "u2": 5, "u4": 6,
+              "f4": 32, "f8": 33}
+
+
+def bcif_packing_limits(values, byte_count):
+    # (unsigned, upper, lower) limits of the integer type values are packed
+    # in, and the number of packed integers for each value
+    import numpy as np
+    if not len(values) or values.min() >= 0:
+        upper = (0xff, 0xffff)[byte_count - 1]
+        return True, upper, None, values // upper + 1
+    upper, lower = (0x7f, 0x7fff)[byte_count - 1], (-0x80, -0x8000)[byte_count - 1]
+    counts = np.where(values >= 0, values // upper, values // lower) + 1
+    return False, upper, lower, counts
+
+
+def bcif_packed_size(values):
+    # Smallest size in bytes of the values packed as 1 or 2 byte integers,
+    # or as Int32, and the byte count (4 for no packing)
+    best = (4 * len(values), 4)
+    for byte_count in (1, 2):
+        counts = bcif_packing_limits(values, byte_count)[3]
+        size = int(counts.sum()) * byte_count
+        if size < best[0]:
+            best = (size, byte_count)
+    return best
+
+
+def bcif_integer_packing(values, byte_count):
+    # Values as 1 or 2 byte integers, values out of range are split in runs
+    # of the type's limit. Returns (encoding, packed).
+    import numpy as np
+    unsigned, upper, lower, counts = bcif_packing_limits(values, byte_count)
+    fill = upper if unsigned else np.where(values >= 0, upper, lower)
+    packed = np.repeat(np.broadcast_to(fill, values.shape), counts)
+    packed[np.cumsum(counts) - 1] = values - (counts - 1) * fill
+    dtype = ("<u" if unsigned else "<i") + str(byte_count)
+    encoding = {"kind": "IntegerPacking", "byteCount": byte_count,
+                "isUnsigned": unsigned, "srcSize": len(values)}
+    return encoding, packed.astype(dtype)
+
+
+def bcif_encode_ints(values):
+    # Integer column as (data, encodings): with or without delta and run
+    # length encodings, whichever packs smallest
+    import numpy as np
+    values = np.asarray(values, dtype=np.int64)
+    candidates = []
+    for delta in (False, True):
+        encodings = []
+        data = values
+        if delta:
+            if not len(data):
+                continue
+            encodings.append({"kind": "Delta", "origin": int(data[0]),
+                              "srcType": bcif_types["i4"]})
+            data = np.diff(data, prepend=data[0])
+        candidates.append((bcif_packed_size(data), data, encodings))
+        starts = np.flatnonzero(np.diff(data, prepend=data[0] - 1)) if len(data) else []
+        # Run length encoding doubles the size without repeated values
+        if 0 < len(starts) < len(data) / 2:
+            counts = np.diff(np.append(starts, len(data)))
+            runs = np.column_stack((data[starts], counts)).ravel()
+            candidates.append((bcif_packed_size(runs), runs, encodings + [
+                {"kind": "RunLength", "srcType": bcif_types["i4"],
+                 "srcSize": len(data)}]))
+    (_, byte_count), data, encodings = min(candidates, key=lambda c: c[0][0])
+    if byte_count == 4:
+        data = data.astype("<i4")
+    else:
+        packing, data = bcif_integer_packing(data, byte_count)
+        encodings = encodings + [packing]
+    encodings = encodings + [{"kind": "ByteArray",
+                              "type": bcif_types[data.dtype.str[1:]]}]
+    return data.tobytes(), encodings
+
+
+# Numeric items of the mmCIF written by Pymol, by their type in the mmCIF
+# dictionary (as read by Mol*). The other items are strings, even when
+# their values look like numbers (chain "1", segment "007").
+bcif_item_types = {
+    "_atom_site.id": "int",
+    "_atom_site.label_seq_id": "int",
+    "_atom_site.auth_seq_id": "int",
+    "_atom_site.pdbx_formal_charge": "int",
+    "_atom_site.pdbx_PDB_model_num": "int",
+    "_atom_site.Cartn_x": "float",
+    "_atom_site.Cartn_y": "float",
+    "_atom_site.Cartn_z": "float",
+    "_atom_site.occupancy": "float",
+    "_atom_site.B_iso_or_equiv": "float",
+    "_atom_site.U_iso_or_equiv": "float",
+    "_atom_site.fract_x": "float",
+    "_atom_site.fract_y": "float",
+    "_atom_site.fract_z": "float",
+    "_cell.length_a": "float",
+    "_cell.length_b": "float",
+    "_cell.length_c": "float",
+    "_cell.angle_alpha": "float",
+    "_cell.angle_beta": "float",
+    "_cell.angle_gamma": "float",
+    "_cell.Z_PDB": "int",
+    "_struct_conn.ptnr1_label_seq_id": "int",
+    "_struct_conn.ptnr2_label_seq_id": "int",
+    "_struct_conn.ptnr1_auth_seq_id": "int",
+    "_struct_conn.ptnr2_auth_seq_id": "int",
+    "_pymol_bond.atom_site_id_1": "int",
+    "_pymol_bond.atom_site_id_2": "int",
+    "_pymol_bond.order": "int",
+}
+
+
+def bcif_column(name, tokens, kind="str"):
+    # BinaryCIF column of an array of CIF tokens (bytes) of an item of kind
+    # "int", "float" or "str" (see bcif_item_types): integers, fixed point
+    # decimals or strings, with a mask for the "." (not present) and "?"
+    # (unknown) ones. Numeric items with other values are written as strings.
+    import numpy as np
+    tokens = np.array(tokens, dtype=bytes)
+    # Characters of the tokens, zero padded
+    chars = tokens.view(np.uint8).reshape(len(tokens), tokens.dtype.itemsize)
+    quoted = np.isin(chars[:, 0], (ord("'"), ord('"')))
+    if quoted.any():
+        tokens[quoted] = [t[1:-1] for t in tokens[quoted].tolist()]
+    mask = np.zeros(len(tokens), dtype=np.int64)
+    mask[tokens == b"."] = 1
+    mask[tokens == b"?"] = 2
+    mask[quoted] = 0
+    column = {"name": name, "mask": None}
+    present = mask == 0
+    if not present.all():
+        data, encodings = bcif_encode_ints(mask)
+        column["mask"] = {"data": data, "encoding": encodings}
+        chars = chars[present]
+        numbers = np.where(present, tokens, b"0")
+    else:
+        numbers = tokens
+    # Only digits, signs and decimal points: no exponents, inf or nan
+    number_chars = np.zeros(256, dtype=bool)
+    number_chars[list(b"0123456789+-.\0")] = True
+    numeric = (kind != "str" and len(chars) and not quoted.any()
+               and number_chars[chars].all())
+    dots = chars == ord(".") if numeric else None
+
+    try:
+        if not numeric or kind != "int" or dots.any():
+            raise ValueError()
+        data, encodings = bcif_encode_ints(numbers.astype(np.int64))
+    except (ValueError, OverflowError):
+        try:
+            if not numeric or kind != "float":
+                raise ValueError()
+            values = numbers.astype(np.float64)
+            # Most digits after the decimal point
+            lengths = (chars != 0).sum(axis=1)
+            digits = np.where(dots.any(axis=1), lengths - dots.argmax(axis=1) - 1, 0)
+            factor = 10 ** min(int(digits.max()), 6)
+            data, encodings = bcif_encode_ints(np.round(values * factor))
+            encodings.insert(0, {"kind": "FixedPoint", "factor": factor,
+                                 "srcType": bcif_types["f8"]})
+        except ValueError:
+            strings, indices = np.unique(np.where(present, tokens, b""),
+                                         return_inverse=True)
+            strings = [s.decode("utf-8") for s in strings.tolist()]
+            offsets = np.cumsum([0] + [len(s) for s in strings])
+            data, data_encodings = bcif_encode_ints(indices)
+            offset_data, offset_encodings = bcif_encode_ints(offsets)
+            encodings = [{"kind": "StringArray",
+                          "dataEncoding": data_encodings,
+                          "stringData": "".join(strings),
+                          "offsetEncoding": offset_encodings,
+                          "offsets": offset_data}]
+    column["data"] = {"data": data, "encoding": encodings}
+    return column
+
+
+def cif_to_bcif(text, chunk_rows=50000):
+    # BinaryCIF of the mmCIF written by Pymol: each data block, single
+    # values and loops become categories of encoded columns. Loop rows are
+    # split chunk_rows at a time into arrays of bytes, much smaller than as
+    # many Python strings.
+    import re
+    import numpy as np
+    token = re.compile(rb"'[^']*'(?=\s|$)|\"[^\"]*\"(?=\s|$)|\S+")
+    has_quotes = re.compile(rb"(?:^|\s)['\"]")
+
+    def split(chunk):
+        # Quoted values may hold spaces
+        if (b"'" in chunk or b'"' in chunk) and has_quotes.search(chunk):
+            return token.findall(chunk)
+        return chunk.split()
+
+    blocks = []
+    categories = None
+    lines = text.encode("utf-8").split(b"\n")
+    i = 0
+
+    def add_category(names, columns):
+        category = names[0].split(".")[0]
+        rows = len(columns[0])
+        columns = [bcif_column(name.split(".", 1)[1], values,
+                               bcif_item_types.get(name, "str"))
+                   for name, values in zip(names, columns)]
+        for existing in categories:
+            if existing["name"] == category:
+                existing["columns"].extend(columns)
+                return
+        categories.append({"name": category, "columns": columns,
+                           "rowCount": rows})
+
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if not line or line.startswith(b"#"):
+            continue
+        if line.startswith(b"data_"):
+            categories = []
+            blocks.append({"header": line[5:].decode("utf-8"),
+                           "categories": categories})
+        elif line == b"loop_":
+            names = []
+            while i < len(lines) and lines[i].lstrip().startswith(b"_"):
+                names.append(lines[i].strip().decode("utf-8"))
+                i += 1
+            parts = [[] for _ in names]
+            rest = []
+            while i < len(lines) and not lines[i].lstrip().startswith(
+                    (b"#", b"loop_", b"_", b"data_")):
+                end = i
+                while end < min(i + chunk_rows, len(lines)) and not lines[
+                        end].lstrip().startswith((b"#", b"loop_", b"_", b"data_")):
+                    end += 1
+                tokens = rest + split(b"\n".join(lines[i:end]))
+                i = end
+                # Values of a row can go on the next lines
+                complete = len(tokens) - len(tokens) % len(names)
+                rest = tokens[complete:]
+                rows = np.array(tokens[:complete], dtype=bytes).reshape(
+                    -1, len(names))
+                for c, column in enumerate(parts):
+                    column.append(rows[:, c])
+            add_category(names, [np.concatenate(c) if c else np.array([], dtype=bytes)
+                                 for c in parts])
+        elif line.startswith(b"_"):
+            values = split(line)
+            if len(values) == 1 and i < len(lines):
+                values += split(lines[i])
+                i += 1
+            add_category([values[0].decode("utf-8")],
+                         [np.array(values[1:2], dtype=bytes)])
+    return msgpack_dumps({"version": "0.3.0", "encoder": "PymolSendToNanome2",
+                          "dataBlocks": blocks})
+
+
+# Format of the structure file of an object by its number of atoms: the first
+# (atoms, format) entry the object has less atoms than is used, None for no
+# limit. BinaryCIF is only written when asked for, see format_policy().
+structure_format_policy = [(150, "sdf"), (None, "cif")]
+
+# Pymol format written for each structure format, and the function that
+# converts it (in the serialization thread pool) or None
+structure_writers = {
+    "sdf": ("sdf", None),
+    "cif": ("cif", None),
+    "bcif": ("cif", cif_to_bcif),
+}
+
+
+def format_policy(bcif_atoms=None):
+    # The default policy, with BinaryCIF for the objects of at least
+    # bcif_atoms atoms
+    if bcif_atoms is None:
+        return list(structure_format_policy)
+    sdf_atoms = structure_format_policy[0][0]
+    return [(sdf_atoms, "sdf"), (bcif_atoms, "cif"), (None, "bcif")]
+
+
+def parse_frames(text):
+    # "first:last:stride" states of multi-state objects, 1-based and
+    # inclusive, every part optional ("::10" is every tenth state, "5" is
+    # the fifth state only). Returns (first, last, stride), or None for all
+    # of the states.
+    text = (text or "").strip()
+    if text.lower() in ("", "all"):
+        return None
+    parts = [p.strip() for p in text.split(":")]
+    if len(parts) > 3:
+        raise ValueError(f"invalid frames {text!r}, use first:last:stride")
+    try:
+        values = [int(p) if p else None for p in parts]
+    except ValueError:
+        raise ValueError(f"invalid frames {text!r}, use first:last:stride")
+    if len(values) == 1:
+        values.append(values[0])
+    first, last, stride = (values + [None])[:3]
+    first = 1 if first is None else first
+    stride = 1 if stride is None else stride
+    if first < 1 or stride < 1 or (last is not None and last < first):
+        raise ValueError(f"invalid frames {text!r}, use first:last:stride")
+    return first, last, stride
+
+
+def molecule_objects():
+    return [n for n in cmd.get_names("objects")
+            if cmd.get_type(n) == "object:molecule"]
+
+
+def visible_objects():
+    # Enabled molecular objects, not in a disabled group
+    enabled = set(cmd.get_names("objects", enabled_only=1))
+    hidden = set()
+    for group in cmd.get_names_of_type("object:group") or []:
+        if group not in enabled:
+            hidden.update(cmd.get_object_list(f"({group})") or [])
+    return [n for n in molecule_objects() if n in enabled and n not in hidden]
+
+
+def objects_in_view(names):
+    # The objects of names whose bounding box is (at least partly) in the
+    # camera's view, between the clipping planes
+    import numpy as np
+    from math import radians, tan
+    view = cmd.get_view()
+    rotation = np.array(view[:9]).reshape(3, 3)
+    camera, origin = np.array(view[9:12]), np.array(view[12:15])
+    front, back = view[15], view[16]
+    fov = abs(view[17]) or float(cmd.get("field_of_view"))
+    width, height = cmd.get_viewport()
+    half_height = tan(radians(fov) / 2)
+    half_width = half_height * width / max(height, 1)
+    in_view = []
+    for name in names:
+        extent = cmd.get_extent(name)
+        if not extent:
+            continue
+        corners = np.array([[x, y, z] for x in (extent[0][0], extent[1][0])
+                            for y in (extent[0][1], extent[1][1])
+                            for z in (extent[0][2], extent[1][2])])
+        # Camera space, looking down -z
+        x, y, z = ((corners - origin) @ rotation + camera).T
+        # Distance of the visible area's edges to the axis at each depth
+        scale = -camera[2] if view[17] > 0 else -z
+        # Out of view when all the corners are beyond the same plane
+        if ((z > -front).all() or (z < -back).all()
+                or (x > half_width * scale).all() or (x < -half_width * scale).all()
+                or (y > half_height * scale).all() or (y < -half_height * scale).all()):
+            continue
+        in_view.append(name)
+    return in_view
+
+
+def scoped_objects(selection=None, visible_only=False, in_view=False):
+    # Molecular objects to send: those with atoms in the selection, the
+    # visible ones and/or those in the current view. None for all of them.
+    every = not selection or selection.strip() in ("all", "*")
+    if every and not visible_only and not in_view:
+        return None
+    names = molecule_objects()
+    if not every:
+        selected = set(cmd.get_object_list(f"({selection})") or [])
+        names = [n for n in names if n in selected]
+    if visible_only or in_view:
+        visible = set(visible_objects())
+        names = [n for n in names if n in visible]
+    if in_view:
+        names = objects_in_view(names)
+    return names
+
+
+# Global settings the surface of an object depends on
+mesh_settings = ["surface_quality", "surface_mode", "surface_type",
+                 "surface_solvent", "surface_proximity", "solvent_radius",
+                 "surface_color", "transparency"]
+
+
+def collada_triangles(text):
+    # Triangles of the geometries of a COLLADA scene written by Pymol:
+    # (positions, normals, RGB colors) float32 arrays of 3 rows per
+    # triangle, None when there is none
+    import numpy as np
+    import xml.etree.ElementTree as ET
+    ns = {"c": "http://www.collada.org/2005/11/COLLADASchema"}
+
+    def numbers(element, dtype):
+        return np.fromstring(element.text or "", dtype=dtype, sep=" ")
+
+    parts = []
+    for mesh in ET.fromstring(text).iterfind(".//c:geometry/c:mesh", ns):
+        sources = {}
+        for source in mesh.iterfind("c:source", ns):
+            stride = int(source.find(".//c:accessor", ns).get("stride"))
+            sources["#" + source.get("id")] = numbers(
+                source.find("c:float_array", ns), np.float32).reshape(-1, stride)
+        for vertices in mesh.iterfind("c:vertices", ns):
+            position = vertices.find("c:input[@semantic='POSITION']", ns)
+            sources["#" + vertices.get("id")] = sources[position.get("source")]
+        for primitives in mesh.findall("c:polylist", ns) + mesh.findall("c:triangles", ns):
+            vcount = primitives.find("c:vcount", ns)
+            if vcount is not None and not (numbers(vcount, np.int64) == 3).all():
+                continue
+            inputs = {i.get("semantic"): (int(i.get("offset")), i.get("source"))
+                      for i in primitives.iterfind("c:input", ns)}
+            if "VERTEX" not in inputs or "NORMAL" not in inputs:
+                continue
+            stride = max(offset for offset, _ in inputs.values()) + 1
+            p = numbers(primitives.find("c:p", ns), np.int64).reshape(-1, stride)
+            columns = {}
+            for semantic, (offset, source) in inputs.items():
+                columns[semantic] = sources[source][p[:, offset], :3]
+            colors = columns.get("COLOR")
+            if colors is None:
+                colors = np.ones((len(p), 3), dtype=np.float32)
+            parts.append((columns["VERTEX"], columns["NORMAL"], colors))
+    if not parts:
+        return None
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def surface_triangles(name):
+    # Triangles of the surface Pymol shows for an object, in its current
+    # state, see collada_triangles(). The scene is exported with only a
+    # temporary copy of the object showing only its surface, its surface is
+    # computed again. The session is left as it was: the enabled objects
+    # are disabled during the export only, all under the API lock so that
+    # the viewer never draws the scene in between.
+    with cmd.lockcm:
+        enabled = cmd.get_names("public_nongroup_objects", enabled_only=1)
+        copy = cmd.get_unused_name("_nanome_mesh")
+        try:
+            cmd.copy(copy, name, zoom=0)
+            cmd.hide("everything", f"%{copy} and not rep surface")
+            cmd.show_as("surface", f"%{copy} and rep surface")
+            for other in enabled:
+                cmd.disable(f"%{other}")
+            text = cmd.get_collada()
+        finally:
+            cmd.delete(copy)
+            for other in enabled:
+                cmd.enable(f"%{other}")
+    return collada_triangles(text)
+
+
+def encode_mesh(positions, normals, colors, alpha=1.0):
+    # Indexed binary mesh of triangles (3 rows per triangle), little-endian:
+    # "NMSH", version (u2), size of the indices in bytes (u2), vertex and
+    # index counts (u4), bounds min and max (3 f4 each), then the positions
+    # quantized within the bounds (3 u2 per vertex), the normals (3 i1,
+    # times 127), the RGBA colors (4 u1) and the indices of the triangles.
+    # Identical vertices are shared, in the order they first appear.
+    import struct
+    import numpy as np
+    low = positions.min(axis=0)
+    high = positions.max(axis=0)
+    scale = np.where(high > low, 65535.0 / np.maximum(high - low, 1e-30), 0.0)
+    quantized = np.round((positions - low) * scale).astype("<u2")
+    records = np.empty((len(positions), 13), dtype=np.uint8)
+    records[:, :6] = quantized.view(np.uint8).reshape(-1, 6)
+    records[:, 6:9] = np.clip(np.round(normals * 127.0), -127, 127).astype(
+        np.int8).view(np.uint8)
+    records[:, 9:12] = np.clip(np.round(colors * 255.0), 0, 255)
+    records[:, 12] = int(round(min(max(alpha, 0.0), 1.0) * 255))
+
+    keys = records.view(np.dtype((np.void, 13))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    indices = rank[inverse.ravel()]
+    vertices = records[first[order]]
+    index_type = np.dtype("<u2") if len(vertices) <= 65536 else np.dtype("<u4")
+
+    header = struct.pack("<4sHHII6f", b"NMSH", 1, index_type.itemsize,
+                         len(vertices), len(indices), *low.tolist(),
+                         *high.tolist())
+    return b"".join([header, vertices[:, :6].tobytes(),
+                     vertices[:, 6:9].tobytes(), vertices[:, 9:].tobytes(),
+                     indices.astype(index_type).tobytes()])
+
+
+# Worker processes of parallel extraction, (workers, ProcessPoolExecutor)
+extract_pool = None
+
+
+def python_executable():
+    # Python interpreter the worker processes are started with. Pymol's
+    # bundled builds run in their own executable, the interpreter is then
+    # looked for in their installation. None when there is none.
+    import sys
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    for path in (os.path.join(sys.exec_prefix, "python.exe"),
+                 os.path.join(sys.exec_prefix, "bin", "python3"),
+                 os.path.join(sys.exec_prefix, "bin", "python")):
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def get_extract_pool(workers):
+    # Started on first use and kept for the next exports, started again
+    # when the number of workers changes or after discard_extract_pool().
+    # None when no Python interpreter is found for the workers, or before
+    # Python 3.9: the objects are then extracted in Pymol.
+    global extract_pool
+    import concurrent.futures
+    import multiprocessing
+    import multiprocessing.spawn
+    import sys
+    if sys.version_info < (3, 9):
+        # Shared memory needs 3.8, cancelling the pending objects of a
+        # discarded pool 3.9
+        print("Worker processes need Python 3.9 or later, the objects are "
+              "extracted in Pymol")
+        return None
+    if extract_pool is not None and extract_pool[0] != workers:
+        discard_extract_pool()
+    if extract_pool is None:
+        executable = python_executable()
+        if executable is None:
+            print("No Python interpreter found for the worker processes, "
+                  "the objects are extracted in Pymol")
+            return None
+        # The interpreter of the spawned processes is set for the whole
+        # Pymol process, not only this pool. It only changes in bundled
+        # builds, whose own executable cannot start them anyway.
+        if os.fsdecode(multiprocessing.spawn.get_executable()) != executable:
+            multiprocessing.spawn.set_executable(executable)
+        context = multiprocessing.get_context("spawn")
+        extract_pool = (workers, concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=context))
+    return extract_pool[1]
+
+
+def discard_extract_pool():
+    # Stops the worker processes, e.g. once one of them died
+    global extract_pool
+    if extract_pool is not None:
+        extract_pool[1].shutdown(wait=False, cancel_futures=True)
+        extract_pool = None
+
+
+def extract_components(shm_name, atom_count, bond_count, options, colors,
+                       rep_table):
+    # Worker process side of PymolToMolz.submit_representations(): the
+    # components of an object from its atom columns and bond settings in
+    # shared memory.
+    import numpy as np
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(shm_name)
+    try:
+        columns = np.ndarray((atom_count, 4), np.int64, shm.buf)
+        bond_settings = np.ndarray(bond_count, np.int64, shm.buf,
+                                   columns.nbytes)
+        components = PymolToMolz.build_components(
+            columns, bond_settings, options, colors.unique_values,
+            colors.color_library, rep_table)
+        del columns, bond_settings
+    finally:
+        shm.close()
+    return components
+
+
+class PymolToMolz():
+    # Shared rep bitmask lookup table, see rep_table()
+    _rep_names = None
+    _rep_mask = None
+    _rep_columns = None
+
+    def __init__(self, session=None, name=None, cache=export_cache,
+                 progress=None, cancelled=None, profile=None, frames=None,
+                 formats=None, objects=None, per_object=None, memory_limit=None,
+                 meshes=False, workers=None):
+        import uuid
+
+        # progress(stage, done, total) is called as the export goes through
+        # its stages, cancelled() is polled to abort it
+        self.progress = progress
+        self.cancelled = cancelled
+        # (first, last, stride) of the states of multi-state objects to
+        # export, see parse_frames(). All of them when None.
+        self.frames = frames
+        # (atoms, format) policy of the structure files, see
+        # structure_format_policy
+        self.formats = formats or structure_format_policy
+        # Surfaces are also sent as the triangles Pymol computed, see
+        # mesh_asset()
+        self.meshes = meshes
+        # Worker processes building the components of the objects, see
+        # submit_representations(). In this process when None or 0.
+        self.workers = workers
+        self._name = name or "Pymol_" + uuid.uuid4().hex[:8]
+        # Timers and counters of the export stages
+        self.profile = profile or SendProfile(self._name)
+        if self.profile.name is None:
+            self.profile.name = self._name
+
+        # Peak memory of the export, which is stopped when the process goes
+        # over memory_limit (bytes)
+        self.memory = MemoryMonitor(memory_limit, self.profile)
+        # Object at a time extraction: only one object's data is read from
+        # Pymol and kept at a time, see load_object(). The default when
+        # there is a memory limit.
+        if per_object is None:
+            per_object = memory_limit is not None
+        self.per_object = per_object and session is None
+
+        # In-memory snapshot of the session, the live session is never
+        # modified nor saved to disk. The structure files and the colors of
+        # Pymol's palette are read along with it, with the API lock held, so
+        # that they match it even if the session is edited during the
+        # export (see take_structures()). The rest of the export can run in
+        # any thread. When given the names of the objects to send, the
+        # others are left out of it.
+        if objects is not None and not objects:
+            raise ValueError("no object to send")
+        # Per structure timings (s) and sizes of the last save_structures
+        self.structure_timings = {}
+        self._structure_atoms = {}
+        # structure_formats() and the text (or cached entry) of each
+        # structure file, see take_structure()
+        self._structures = None
+        self._structure_texts = {}
+        # Meshes of take_mesh(), when sent
+        self._meshes = {}
+        self._cache = cache
+        self._fingerprints = {}
+        self._frame_states = {}
+        self._object_atoms = {}
+        if session is None:
+            self.report_progress("snapshot", 0, 1)
+            with self.profile.stage("snapshot"), cmd.lockcm:
+                # The objects deleted since the send was asked for are left
+                # out, Pymol would read the whole session for a missing name
+                existing = molecule_objects()
+                if objects is not None:
+                    objects = [name for name in objects if name in existing]
+                    if not objects:
+                        raise ValueError("the objects to send were deleted")
+                elif self.per_object:
+                    objects = existing
+                if self.per_object:
+                    # The settings and colors, with the first object
+                    session = cmd.get_session(" ".join(objects[:1]))
+                else:
+                    session = cmd.get_session(" ".join(objects or []))
+                self.read_session(session, objects)
+                self.settings.take_colors()
+                self.take_structures()
+            self.report_progress("snapshot", 1, 1)
+            self.memory.sample()
+        else:
+            self.read_session(session, objects)
+
+    def read_session(self, session, objects):
+        # The settings, colors and molecule objects of a snapshot
+        self._pse_data = session
+
+        # Colors of the unique, object and global settings, resolved once
+        self.settings = SettingsResolver(self._pse_data)
+        self._custom_colors = self.settings.custom_colors
+        self._unique_settings = self.settings.unique_settings
+        self._workspace_settings_colors = self.settings.object_values(
+            self._pse_data["settings"])
+        self._color_libraries = {}
 
         self._pse_molecules = {}
-        for d in self._pse_data["names"][1:]:
-            if d[4] == 1:
+        if self.per_object:
+            # Not read yet
+            self._pse_molecules = dict.fromkeys(objects)
+        # The first entry is None in a full session
+        for d in self._pse_data["names"]:
+            if d is not None and d[4] == 1 and (objects is None or d[0] in objects):
                 self._pse_molecules[d[0]] = d
+        if self.per_object:
+            # Only kept for the settings and colors
+            self._pse_data = dict(self._pse_data, names=[])
+
+    def take_structures(self):
+        # Formats of the structure files and the text (and mesh, see
+        # take_mesh()) of those of the objects in the snapshot, with the API
+        # lock held along with it. In object at a time extraction, the others
+        # are read with their object (see load_object()) and added to the
+        # archive right away. Otherwise the texts of all the objects wait in
+        # memory for save_structures().
+        self._structures = self.structure_formats()
+        for structure in self._structures[0]:
+            if self._pse_molecules[structure["Name"]] is not None:
+                self.check_cancelled()
+                self.take_structure(structure)
+                if self.meshes:
+                    self.take_mesh(structure["Name"])
+
+    def take_structure(self, structure):
+        # Text of a structure file, or its cached (ZipInfo, data) when the
+        # object did not change. cmd.get_str reads the live session: the API
+        # lock must be held since the object's snapshot.
+        import time
+        mol_name = structure["Name"]
+        timings = {"format": structure["Extension"],
+                   "atoms": self._structure_atoms.get(mol_name, 0)}
+        if self._cache is not None:
+            cached = self._cache.get(
+                ("structure", self.object_fingerprint(mol_name),
+                 "assets/" + structure["Identifier"]))
+            if cached is not None:
+                self.structure_timings[mol_name] = dict(
+                    timings, serialize=0.0, cached=True)
+                self._structure_texts[mol_name] = cached
+                return
+        pymol_format = structure_writers[structure["Extension"]][0]
+        start = time.perf_counter()
+        states = self.frame_states(mol_name)
+        if states is None:
+            text = cmd.get_str(pymol_format, mol_name, state=0)
+        else:
+            text = self.frames_str(pymol_format, mol_name, states)
+            self.profile.count("serialize", "frames", len(states))
+        self.structure_timings[mol_name] = dict(
+            timings, serialize=time.perf_counter() - start)
+        self._structure_texts[mol_name] = text
+
+    def load_object(self, mol_name):
+        # Reads the data of an object, in object at a time extraction. The
+        # partial session Pymol returns still holds the unique (atom and
+        # bond level) settings of the whole session. Returns False when the
+        # object was deleted since the first snapshot.
+        if not self.per_object or self._pse_molecules.get(mol_name) is not None:
+            return True
+        with self.profile.stage("snapshot"), cmd.lockcm:
+            if mol_name not in cmd.get_names("objects") or \
+                    cmd.get_type(mol_name) != "object:molecule":
+                del self._pse_molecules[mol_name]
+                return False
+            session = cmd.get_session(mol_name, partial=1)
+            self.settings.add_unique_settings(session["unique_settings"])
+            for d in session["names"]:
+                if d is not None and d[0] == mol_name and d[4] == 1:
+                    self._pse_molecules[mol_name] = d
+            # Its structure file, from the same state of the session
+            self.take_structure(next(s for s in self._structures[0]
+                                     if s["Name"] == mol_name))
+            if self.meshes:
+                self.take_mesh(mol_name)
+        self.profile.count("snapshot", "objects")
+        return True
+
+    def unload_object(self, mol_name):
+        # Frees the data of an object once exported, in object at a time
+        # extraction
+        if self.per_object:
+            self.frame_states(mol_name)
+            self._pse_molecules[mol_name] = None
+            self._object_atoms.pop(mol_name, None)
 
     def int2reps(self, rep):
         reps = set()
@@ -282,278 +2763,1272 @@ class PymolToMolz():
         return list(reps)
 
     def color_to_rgb(self, id):
-        if id in self._custom_colors:
-            return [floor(color * 255) for color in self._custom_colors[id]] + [255]
-        c = cmd.get_color_tuple(id)
-        return [floor(color * 255) for color in c] + [255]
-
-    def save_structures(self, assets_dir):
+        return self.settings.rgba(id)
+
+    def object_atoms(self, mol_name):
+        # Atom and bond records of an object (see extract_atoms()) and its
+        # atom columns, extracted once for its fingerprint and components
+        if mol_name not in self._object_atoms:
+            atom_data, bond_data = self.extract_atoms(self._pse_molecules[mol_name])
+            self._object_atoms[mol_name] = (
+                atom_data, bond_data, self.atom_columns(atom_data))
+        return self._object_atoms[mol_name]
+
+    def object_fingerprint(self, mol_name):
+        # Digest of everything an object's exported structure and components
+        # depend on: its atom columns and coordinates as arrays, the rest of
+        # its atoms, bonds, coordinate sets and object settings, the unique
+        # settings it uses and the workspace colors. Marshal version 2 writes
+        # no references, so equal records always give the same bytes.
+        import hashlib
+        import marshal
+        import numpy as np
+        if mol_name not in self._fingerprints:
+            pse_data = self._pse_molecules[mol_name]
+            atom_data, bond_data, columns = self.object_atoms(mol_name)
+            digest = hashlib.sha256()
+            digest.update(np.ascontiguousarray(columns).tobytes())
+            # Hashed at once: each update releases the GIL
+            coord_data = []
+            for coord_set in pse_data[5][4] or []:
+                if coord_set is None:
+                    coord_data.append(b"\0")
+                    continue
+                # Coordinates (Pymol keeps them in single precision) and
+                # the atom of each; atm_to_idx is only the reverse lookup
+                coords, idx_to_atm = coord_set[2], coord_set[3]
+                if not isinstance(coords, bytes):
+                    coords = np.asarray(coords, dtype=np.float32).tobytes()
+                if not isinstance(idx_to_atm, bytes):
+                    idx_to_atm = np.asarray(idx_to_atm, dtype=np.int32).tobytes()
+                coord_data += [coords, idx_to_atm,
+                               marshal.dumps(coord_set[:2] + coord_set[5:], 2)]
+            digest.update(b"".join(coord_data))
+            del coord_data
+            obj = list(pse_data[5])
+            obj[4] = obj[6] = obj[7] = None
+            digest.update(marshal.dumps(
+                (pse_data[:5] + pse_data[6:], obj, atom_data, bond_data), 2))
+
+            setting_ids = set(np.unique(columns[:, 3]).tolist()) - {-1}
+            setting_ids.update(b[5] for b in bond_data if b[6] == 1)
+            unique_settings = [(i, self._unique_settings.get(i))
+                               for i in sorted(setting_ids)]
+            context = (self.formats, self._workspace_settings_colors,
+                       sorted(self._custom_colors.items()),
+                       self.frame_states(mol_name))
+            digest.update(marshal.dumps((unique_settings, context), 2))
+            self._fingerprints[mol_name] = digest.hexdigest()
+        return self._fingerprints[mol_name]
+
+    def frame_states(self, mol_name):
+        # States of a multi-state object picked by self.frames, None for all
+        # of them
+        if mol_name not in self._frame_states:
+            self._frame_states[mol_name] = self.pick_frames(mol_name)
+        return self._frame_states[mol_name]
+
+    def pick_frames(self, mol_name):
+        coord_sets = self._pse_molecules[mol_name][5][4] or []
+        if self.frames is None or len(coord_sets) < 2:
+            return None
+        first, last, stride = self.frames
+        last = len(coord_sets) if last is None else min(last, len(coord_sets))
+        states = [s for s in range(max(first, 1), last + 1, max(stride, 1))
+                  if coord_sets[s - 1]]
+        if len(states) == len(coord_sets):
+            return None
+        # At least one frame, the first one
+        return states or [1]
+
+    def frames_str(self, extension, mol_name, states):
+        # The given states of an object as one multi-model file, like
+        # cmd.get_str(extension, mol_name, state=0) writes all of them
+        texts = [cmd.get_str(extension, mol_name, state=s) for s in states]
+        if extension != "cif":
+            return "".join(texts)
+        # A single data block: the header and the trailing loops of the first
+        # model, and the atom_site rows of every model
+        rows = []
+        for text in texts:
+            lines = text.splitlines(True)
+            span = self.atom_site_rows(lines)
+            if span is None:
+                continue
+            start, end = span
+            if not rows:
+                head = "".join(lines[:start])
+                tail = "".join(lines[end:])
+            rows.append("".join(lines[start:end]))
+        if not rows:
+            return texts[0]
+        return head + "".join(rows) + tail
+
+    @staticmethod
+    def atom_site_rows(lines):
+        # (start, end) line indices of the rows of the atom_site loop of an
+        # mmCIF file, None when it has none: the lines after its items, up
+        # to the next comment, loop, item, data block or blank line
+        for i, line in enumerate(lines):
+            if not line.startswith("loop_"):
+                continue
+            start = i + 1
+            while start < len(lines) and lines[start].startswith("_atom_site."):
+                start += 1
+            if start == i + 1:
+                continue
+            end = start
+            while end < len(lines) and lines[end].strip() and \
+                    not lines[end].startswith(("#", "loop_", "_", "data_")):
+                end += 1
+            return (start, end) if end > start else None
+        return None
+
+    def count_present_atoms(self, mol_name):
+        # Same as cmd.count_atoms(mol_name + " and present"), the atoms with
+        # coordinates in the object's current state, read from the snapshot
+        try:
+            state = cmd.get_object_state(mol_name)
+        except Exception:
+            return 0
+        if self._pse_molecules[mol_name] is None:
+            # Not read yet, in object at a time extraction
+            return cmd.count_atoms(f"%{mol_name} and present", state=state)
+        coord_sets = self._pse_molecules[mol_name][5][4] or []
+        if 0 < state <= len(coord_sets) and coord_sets[state - 1]:
+            return coord_sets[state - 1][0]
+        return 0
+
+    def structure_format(self, atoms):
+        for max_atoms, extension in self.formats:
+            if max_atoms is None or atoms < max_atoms:
+                return extension
+        return self.formats[-1][1]
+
+    def structure_formats(self):
         structures = []
         name_map = {}
-        for mol_name in cmd.get_names_of_type('object:molecule'):
-            if cmd.count_atoms(mol_name + " and present") < self._sdf_max_size:
-                output_sdf = os.path.join(
-                    assets_dir, mol_name.replace(' ', '_') + ".sdf")
-                cmd.save(output_sdf, mol_name, state=0)
-                basename = os.path.basename(output_sdf)
-                name_map[mol_name] = basename
-                structures.append({
-                    "Name": mol_name,
-                    "Extension": "sdf",
-                    "Identifier": name_map[mol_name]
-                })
-            else:
-                output_cif = os.path.join(
-                    assets_dir, mol_name.replace(' ', '_') + ".cif")
-                cmd.save(output_cif, mol_name, state=0)
-                basename = os.path.basename(output_cif)
-                name_map[mol_name] = basename
-                structures.append({
-                    "Name": mol_name,
-                    "Extension": "cif",
-                    "Identifier": name_map[mol_name]
-                })
+        for mol_name in self._pse_molecules:
+            atoms = self.count_present_atoms(mol_name)
+            self._structure_atoms[mol_name] = atoms
+            extension = self.structure_format(atoms)
+            name_map[mol_name] = mol_name.replace(' ', '_') + "." + extension
+            structures.append({
+                "Name": mol_name,
+                "Extension": extension,
+                "Identifier": name_map[mol_name]
+            })
         return structures, name_map
 
-    def get_setting_color(self, settings, rep_name):
-        # https://github.com/schrodinger/pymol-open-source/blob/abd9579a97b9864c6a40ba7b91dd330ef64d14a5/layer1/SettingInfo.h
-        for s in settings:
-            if s[0] == 236 and rep_name == "cartoon":
-                return s[2]
-            if s[0] == 235 and rep_name == "ribbon":
-                return s[2]
-            if s[0] == 526 and rep_name == "line":
-                return s[2]
-            if s[0] == 144 and rep_name == "surface":
-                return s[2]
-            if s[0] == 146 and rep_name == "mesh":
-                return s[2]
-            if s[0] == 173 and rep_name == "ball-and-stick":
-                return s[2]
-            # stick color in bond
-            if s[0] == 376 and "stick" in rep_name:
-                return s[2]
+    def encode_structure(self, writer, converter, basename, text):
+        # Conversion and compression of a structure file, in a worker thread.
+        # Returns (ZipInfo, compressed data, seconds compressing, seconds
+        # converting).
+        import time
+        encode_time = 0.0
+        if converter is not None:
+            start = time.perf_counter()
+            text = converter(text)
+            encode_time = time.perf_counter() - start
+        return writer.compress_asset(basename, text) + (encode_time,)
+
+    def submit_structure(self, writer, structure, pool=None):
+        # Future of the (ZipInfo, data, seconds compressing, seconds
+        # converting) of a structure file read by take_structure(), encoded
+        # and compressed in pool, or right away when None. Its text is
+        # dropped.
+        import zipfile
+        import zlib
+        from concurrent.futures import Future
+        mol_name = structure["Name"]
+        extension = structure["Extension"]
+        basename = structure["Identifier"]
+        if mol_name not in self._structure_texts:
+            # Given a session, there was no snapshot to read it with
+            with cmd.lockcm:
+                self.take_structure(structure)
+        text = self._structure_texts.pop(mol_name)
+        timings = self.structure_timings[mol_name]
+        converter = structure_writers[extension][1]
+        if timings.get("cached") and \
+                text[0].compress_type != writer.compression:
+            # Cached with the other compression: compressed again, it is
+            # already encoded
+            del timings["cached"]
+            zinfo, text = text
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                text = zlib.decompress(text, -15)
+            converter = None
+        if timings.get("cached"):
+            future = Future()
+            future.set_result(text + (0.0, 0.0))
+        elif pool is None:
+            future = Future()
+            future.set_result(self.encode_structure(
+                writer, converter, basename, text))
+        else:
+            future = pool.submit(
+                self.encode_structure, writer, converter, basename, text)
+        return future
+
+    def write_structure(self, writer, mol_name, future):
+        # Adds a structure file from submit_structure() to the archive
+        import time
+        zinfo, data, compress_time, encode_time = future.result()
+        timings = self.structure_timings[mol_name]
+        if self._cache is not None and not timings.get("cached"):
+            key = ("structure", self.object_fingerprint(mol_name),
+                   zinfo.filename)
+            self._cache.put(key, (zinfo, data), len(data))
+        if timings.get("cached"):
+            zinfo = writer.copy_info(zinfo)
+        start = time.perf_counter()
+        writer.write_entry(zinfo, data)
+        timings["encode"] = encode_time
+        timings["compress"] = compress_time
+        timings["archive"] = time.perf_counter() - start
+        timings["bytes"] = zinfo.file_size
+        timings["compressed_bytes"] = zinfo.compress_size
+        self.profile.count("serialize", "structures")
+        self.profile.count("serialize", "compress_seconds", compress_time)
+        self.profile.count("serialize", "bytes", zinfo.file_size)
+        self.profile.count("serialize", "compressed_bytes", zinfo.compress_size)
+        if timings.get("cached"):
+            self.profile.count("serialize", "cached")
+        else:
+            self.profile.count("serialize", "pymol_seconds", timings["serialize"])
+        if encode_time:
+            self.profile.count("serialize", "encode_seconds", encode_time)
+        # Per format, for the write time, size and atoms/s of each
+        extension = timings["format"]
+        self.profile.count("serialize", extension + "_structures")
+        self.profile.count("serialize", extension + "_atoms", timings["atoms"])
+        self.profile.count("serialize", extension + "_seconds",
+                           timings["serialize"] + encode_time + compress_time)
+        self.profile.count("serialize", extension + "_bytes", zinfo.file_size)
+        self.profile.count("serialize", extension + "_compressed_bytes",
+                           zinfo.compress_size)
+
+    def save_structures(self, writer, structures, max_workers=None):
+        # The structure files read with the snapshot (see take_structures())
+        # are encoded and compressed in a thread pool. At most 2 * max_workers
+        # compressed files are kept in memory and entries are added to the
+        # archive in object order.
+        from concurrent.futures import ThreadPoolExecutor
+        if max_workers is None:
+            max_workers = min(4, os.cpu_count() or 1)
+
+        pending = []
+
+        def add_next_entry():
+            self.write_structure(writer, *pending.pop(0))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for i, structure in enumerate(structures):
+                self.check_cancelled()
+                self.report_progress("serialize", i, len(structures))
+                pending.append((structure["Name"], self.submit_structure(
+                    writer, structure, pool)))
+                if len(pending) >= 2 * max_workers:
+                    add_next_entry()
+                # Near the memory limit, nothing is kept in memory between
+                # two structures
+                while pending and self.memory.near_limit():
+                    add_next_entry()
+                self.memory.check()
+            while pending:
+                add_next_entry()
+        self.report_progress("serialize", len(structures), len(structures))
 
     def get_representations(self, mol_name, name_map):
         if not mol_name in self._pse_molecules:
             return []
+        columns, bond_settings, options = self.extraction_inputs(
+            mol_name, name_map)
+        return self.build_components(
+            columns, bond_settings, options, self.settings.unique_values,
+            self.color_library, self.rep_table() + (self._rep_columns,))
+
+    def extraction_inputs(self, mol_name, name_map):
+        # What the components of an object are built from: its atom columns
+        # (see atom_columns()), the unique setting id of the bonds of each
+        # atom and the options of build_components()
+        import numpy as np
         pse_data = self._pse_molecules[mol_name]
-        enabled = pse_data[2] == 1
-        atom_data = pse_data[5][7]
-        bond_data = pse_data[5][6]
-        flags = pse_data[3]
-        # Not used for now
-        if flags:
-            show_stick = flags[0] == 1 or flags[4] == 1
-            show_sphere = flags[1] == 1
-            show_surface = flags[2] == 1
-            show_label = flags[3] == 1
-            show_nbSphere = flags[4] == 1
-            show_ribbon = flags[5] == 1
-            show_line = flags[7] == 1
-
-        complex_settings = pse_data[5][0][8]
-        complex_custom_colors = {
-            'surface': None,
-            'mesh': None,
-            'cartoon': None,
-            'ribbon': None,
-            'line': None,
-            'sphere': None,
-            'ball-and-stick': None,
-            'stick': None,
-            'label': None,
-        }
-        if complex_settings:
-            for setting in complex_settings:
-                # if setting[0] == 138 and setting[2] >= 0:
-                # complex_custom_colors["surface_transparency"] = setting[2]
-                if setting[0] == 144 and setting[2] >= 0:
-                    complex_custom_colors["surface"] = setting[2]
-                elif setting[0] == 236 and setting[2] >= 0:
-                    complex_custom_colors["cartoon"] = setting[2]
-                elif setting[0] == 235 and setting[2] >= 0:
-                    complex_custom_colors["ribbon"] = setting[2]
-                elif setting[0] == 526 and setting[2] >= 0:
-                    complex_custom_colors["line"] = setting[2]
-                elif setting[0] == 146 and setting[2] >= 0:
-                    complex_custom_colors["mesh"] = setting[2]
-                elif setting[0] == 173 and setting[2] >= 0:
-                    complex_custom_colors["sphere"] = setting[2]
-                elif setting[0] == 376 and setting[2] >= 0:
-                    complex_custom_colors["ball-and-stick"] = setting[2]
-
-        states = set([i[34] for i in atom_data])
-        components = []
+        atom_data, bond_data, columns = self.object_atoms(mol_name)
 
         custom_bonds = {}
         for b in bond_data:
             if b[6] == 1:
                 custom_bonds[b[0]] = b[5]
                 custom_bonds[b[1]] = b[5]
+        # Dense (atom index -> bond unique setting id) lookup, -2 when unset.
+        # Like before, it is indexed with the atom index within the state.
+        bond_settings = np.full(max(custom_bonds, default=-1) + 1, -2, dtype=np.int64)
+        for aId, usetting_id in custom_bonds.items():
+            bond_settings[aId] = usetting_id
+
+        options = {
+            "structure": name_map[mol_name],
+            "enabled": pse_data[2] == 1,
+            "complex_colors": self.settings.object_values(pse_data[5][0][8]),
+            "workspace_colors": self._workspace_settings_colors,
+            "frame_states": self.frame_states(mol_name),
+        }
+        return columns, bond_settings, options
+
+    @staticmethod
+    def build_components(columns, bond_settings, options, unique_values,
+                         color_library, rep_table):
+        # Components of an object from extraction_inputs(), without Pymol:
+        # unique_values(setting_ids, rep_name) and color_library(color_set)
+        # are those of SettingsResolver and PymolToMolz, or ObjectColors in
+        # a worker process. rep_table is rep_table() and its columns.
+        # Representations of a state are in the order they first appear.
+        import numpy as np
+        complex_custom_colors = options["complex_colors"]
+        workspace_colors = options["workspace_colors"]
+        states, state_atoms = PymolToMolz.group_by_state(columns[:, 0])
+        components = []
+        rep_names, rep_mask, rep_columns = rep_table
+        shared = {}
+
+        # Discrete states (states of their own atoms) not picked by
+        # self.frames are left out, the others are the models of the
+        # structure in that order
+        models = None
+        picked = options["frame_states"]
+        if picked is not None and 0 not in states:
+            models = {state: i for i, state in enumerate(picked)}
 
         for state in states:
-            colors = []
-            unique_setting_id = []
-            ribbon_mode = []
-            representations = []
-            for a in atom_data:
-                if a[34] == state:
-                    ribbon_mode.append(a[23])
-                    colors.append(a[21])
-                    unique_setting_id.append(a[32] if a[40] != 0 else -1)
-                    representations.append(a[20])
-
-            rep_types = set(representations)
-            rep_types_s = set([j for i in rep_types for j in self.int2reps(i)])
+            if models is not None and state not in models:
+                continue
+            atoms = columns[state_atoms[state]]
+            representations = atoms[:, 1]
+            colors = atoms[:, 2]
+            unique_setting_id = atoms[:, 3]
+
+            rep_types = PymolToMolz.first_appearance(representations)
+            rep_types_s = dict.fromkeys(
+                j for i in rep_types for j in rep_names[i & 255])
+            rep_bits = rep_mask[representations & 255]
             data_per_rep = {}
             for r in rep_types_s:
-                data_per_rep[r] = []
-
-            for i, r in enumerate(representations):
-                for rs in self.int2reps(r):
-                    data_per_rep[rs].append(i)
+                data_per_rep[r] = np.flatnonzero(rep_bits[:, rep_columns[r]])
 
             for rep_name in data_per_rep:
-                cols = [colors[c] for c in data_per_rep[rep_name]]
+                selection = data_per_rep[rep_name]
+                cols = colors[selection]
 
                 # Use unique settings
-                for i, aId in enumerate(data_per_rep[rep_name]):
-                    has_custom_color = False
-                    if unique_setting_id[aId] >= 0:
-                        settings = self._unique_settings.get(
-                            unique_setting_id[aId], [])
-                        custom_col = self.get_setting_color(settings, rep_name)
-                        if custom_col is not None and custom_col >= 0:
-                            cols[i] = custom_col
-                            has_custom_color = True
-
-                    # Look for bond unique colors
-                    if not has_custom_color and aId in custom_bonds:
-                        usetting_id = custom_bonds[aId]
-                        settings = self._unique_settings.get(usetting_id, [])
-                        custom_col = self.get_setting_color(settings, rep_name)
-                        if custom_col is not None and custom_col >= 0:
-                            cols[i] = custom_col
-                            has_custom_color = True
-
-                    # Try to use complex setting
-                    if not has_custom_color and rep_name in complex_custom_colors and complex_custom_colors[rep_name]:
-                        cols[i] = complex_custom_colors[rep_name]
-                        has_custom_color = True
-
-                    # Try to use workspace setting
-                    if not has_custom_color and self._workspace_settings_colors[rep_name]:
-                        cols[i] = self._workspace_settings_colors[rep_name]
-
-                color_set = list(set(cols))
-                rep = {
-                    "Kind": rep_name.replace("sphere", "spacefill"),
-                    "ColorScheme": {
-                        "Library": [self.color_to_rgb(c) for c in color_set],
-                        "Colors": [color_set.index(c) for c in cols],
-                    },
-                    "SizeScheme": {
-                        "Kind": "uniform",
-                        "Scale": 1.0,
-                        "BFactorFactor": 0.0
-                    },
-                    "Parameters": {}
-                }
-                state_id = state - 1 if len(states) != 1 else 0
+                usettings = unique_setting_id[selection]
+                custom_cols = unique_values(usettings, rep_name)
+                has_custom_color = (usettings >= 0) & (custom_cols >= 0)
+                cols[has_custom_color] = custom_cols[has_custom_color]
+
+                # Look for bond unique colors
+                in_bonds = selection < len(bond_settings)
+                in_bonds[in_bonds] = bond_settings[selection[in_bonds]] != -2
+                custom_cols = np.full(len(selection), -1, dtype=np.int64)
+                custom_cols[in_bonds] = unique_values(
+                    bond_settings[selection[in_bonds]], rep_name)
+                use_bond = ~has_custom_color & (custom_cols >= 0)
+                cols[use_bond] = custom_cols[use_bond]
+                has_custom_color |= use_bond
+
+                # Try to use complex setting, then workspace setting
+                if rep_name in complex_custom_colors and complex_custom_colors[rep_name]:
+                    cols[~has_custom_color] = complex_custom_colors[rep_name]
+                elif workspace_colors[rep_name]:
+                    cols[~has_custom_color] = workspace_colors[rep_name]
+
+                # Palette in the same order as list(set(cols)), and each
+                # atom's index into it through the inverse of np.unique
+                palette, first, inverse = np.unique(
+                    cols, return_index=True, return_inverse=True)
+                color_set = list(set(palette[np.argsort(first)].tolist()))
+                position = {c: i for i, c in enumerate(color_set)}
+                remap = np.array([position[c] for c in palette.tolist()])
+                atom_colors = remap[inverse.ravel()]
+
+                # States with the same atoms and colors share their
+                # selection and representation
+                rep_key = (rep_name, tuple(color_set), atom_colors.tobytes())
+                if rep_key not in shared:
+                    shared[rep_key] = {
+                        "Kind": rep_name.replace("sphere", "spacefill"),
+                        "ColorScheme": {
+                            "Library": color_library(color_set),
+                            "Colors": atom_colors.tolist(),
+                        },
+                        "SizeScheme": {
+                            "Kind": "uniform",
+                            "Scale": 1.0,
+                            "BFactorFactor": 0.0
+                        },
+                        "Parameters": {}
+                    }
+                selection_key = selection.tobytes()
+                if selection_key not in shared:
+                    shared[selection_key] = selection.tolist()
+                if models is not None:
+                    state_id = models[state]
+                else:
+                    state_id = state - 1 if len(states) != 1 else 0
                 component = {
-                    "Structure": name_map[mol_name],
+                    "Structure": options["structure"],
                     "Name": rep_name[0].upper() + rep_name[1:].lower(),
                     "Model": state_id,
-                    "Selection": data_per_rep[rep_name],
-                    "Representations": [rep],
-                    "Hidden": not enabled
+                    "Selection": shared[selection_key],
+                    "Representations": [shared[rep_key]],
+                    "Hidden": not options["enabled"]
                 }
                 components.append(component)
         return components
 
-    def create_state_file(self, main_dir, structures, components):
-        state = {"Version": "0.0.1",
-                 "Structures": structures,
-                 "Components": components
-                 }
-        with open(os.path.join(main_dir, "state.json"), "w") as f:
-            json.dump(state, f)
-
-    def create_molz_archive(self, main_dir):
-        final_path = main_dir + ".molz"
-        shutil.make_archive(main_dir, "zip", main_dir)
-        shutil.rmtree(main_dir)
-        os.rename(main_dir + ".zip", final_path)
-        return final_path
-
-    def prepare_molz_directories(self):
-        main_dir = os.path.splitext(os.path.basename(self._pse_path))[0]
-        assets_dir = os.path.join(main_dir, "assets")
-        os.makedirs(assets_dir)
-        return main_dir, assets_dir
-
-    def export_to_molz(self):
-        main_dir, assets_dir = self.prepare_molz_directories()
-        structures, name_map = self.save_structures(assets_dir)
-
-        # Get the representation per structure
-        components = []
+    def color_library(self, color_set):
+        # RGBA library of a palette, one list per distinct palette
+        key = tuple(color_set)
+        if key not in self._color_libraries:
+            self._color_libraries[key] = [self.color_to_rgb(c) for c in color_set]
+        return self._color_libraries[key]
+
+    def extract_atoms(self, pse_data):
+        # Atom and bond records of a molecule without the CA atoms added by
+        # Pymol for missing residues ("not present and name CA and elem C")
+        import numpy as np
+        atom_data = pse_data[5][7]
+        bond_data = pse_data[5][6]
+        present = np.zeros(len(atom_data), dtype=bool)
+        for coord_set in pse_data[5][4] or []:
+            if coord_set is None:
+                continue
+            idx_to_atm = coord_set[3]
+            if isinstance(idx_to_atm, bytes):
+                idx_to_atm = np.frombuffer(idx_to_atm, dtype=np.int32)
+            present[np.asarray(idx_to_atm, dtype=np.int64)] = True
+        keep = [present[i] or a[6] != "CA" or a[7] != "C"
+                for i, a in enumerate(atom_data)]
+        if all(keep):
+            return atom_data, bond_data
+
+        new_index = np.cumsum(keep) - 1
+        atom_data = [a for a, k in zip(atom_data, keep) if k]
+        bonds = []
+        for b in bond_data:
+            if keep[b[0]] and keep[b[1]]:
+                b = list(b)
+                b[0] = int(new_index[b[0]])
+                b[1] = int(new_index[b[1]])
+                bonds.append(b)
+        return atom_data, bonds
+
+    def atom_columns(self, atom_data):
+        # One pass over the PSE atom records (AtomInfoAsPyList):
+        # discrete state, visRep bitmask, color, unique setting id
+        import numpy as np
+        columns = np.array(
+            [(a[34], a[20], a[21], a[32] if a[40] != 0 else -1)
+             for a in atom_data], dtype=np.int64)
+        return columns.reshape(-1, 4)
+
+    @staticmethod
+    def group_by_state(state_column):
+        # Atom indices of every state, in atom order. States are returned as
+        # the same set the atom list would build, to keep the output order.
+        import numpy as np
+        order = np.argsort(state_column, kind="stable")
+        values, starts = np.unique(state_column[order], return_index=True)
+        ends = list(starts[1:]) + [len(order)]
+        state_atoms = {}
+        for state, start, end in zip(values.tolist(), starts, ends):
+            state_atoms[state] = order[start:end]
+        return PymolToMolz.ordered_set(state_column), state_atoms
+
+    @staticmethod
+    def ordered_set(column):
+        # set(column) built from the distinct values in order of first
+        # appearance, which iterates exactly like set(column.tolist())
+        return set(PymolToMolz.first_appearance(column))
+
+    @staticmethod
+    def first_appearance(column):
+        # Distinct values of column in the order they first appear
+        import numpy as np
+        values, first = np.unique(column, return_index=True)
+        return values[np.argsort(first)].tolist()
+
+    def rep_table(self):
+        # int2reps() decoded once for every value of the low byte of a
+        # visRep bitmask (the only bits int2reps looks at), sorted so that
+        # the representations come in the same order in every process
+        import numpy as np
+        cls = PymolToMolz
+        if cls._rep_names is None:
+            rep_names = [sorted(self.int2reps(i)) for i in range(256)]
+            columns = {}
+            for names in rep_names:
+                for r in names:
+                    columns.setdefault(r, len(columns))
+            rep_mask = np.zeros((256, len(columns)), dtype=bool)
+            for i, names in enumerate(rep_names):
+                for r in names:
+                    rep_mask[i, columns[r]] = True
+            cls._rep_names = rep_names
+            cls._rep_mask = rep_mask
+            cls._rep_columns = columns
+        return cls._rep_names, cls._rep_mask
+
+    def cached_representations(self, mol_name, name_map):
+        if self._cache is None or mol_name not in self._pse_molecules:
+            return self.get_representations(mol_name, name_map)
+        key = ("components", self.object_fingerprint(mol_name),
+               name_map[mol_name])
+        components = self._cache.get(key)
+        if components is not None:
+            self.profile.count("extract", "cached")
+        else:
+            components = self.get_representations(mol_name, name_map)
+            # Approximate size: 8 bytes per selected atom and color index
+            size = sum(512 + 16 * len(c["Selection"]) for c in components)
+            self._cache.put(key, components, size)
+        return components
+
+    def submit_representations(self, pool, mol_name, name_map):
+        # Starts building the components of an object in a worker process
+        # of the pool. Its atom columns and bond settings are copied to
+        # shared memory, with the colors it uses resolved here. Returns the
+        # future of its components and the key to cache them with once
+        # built, None when they came from the cache.
+        import numpy as np
+        from concurrent.futures import Future
+        from multiprocessing import shared_memory
+        key = None
+        if self._cache is not None:
+            key = ("components", self.object_fingerprint(mol_name),
+                   name_map[mol_name])
+            components = self._cache.get(key)
+            if components is not None:
+                self.profile.count("extract", "cached")
+                future = Future()
+                future.set_result(components)
+                return future, None
+        columns, bond_settings, options = self.extraction_inputs(
+            mol_name, name_map)
+        colors = ObjectColors(self.settings, columns, bond_settings, options)
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(1, columns.nbytes + bond_settings.nbytes))
+        try:
+            np.ndarray(columns.shape, np.int64, shm.buf)[:] = columns
+            np.ndarray(bond_settings.shape, np.int64, shm.buf,
+                       columns.nbytes)[:] = bond_settings
+            future = pool.submit(
+                extract_components, shm.name, len(columns), len(bond_settings),
+                options, colors, self.rep_table() + (self._rep_columns,))
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        def release(future):
+            shm.close()
+            shm.unlink()
+        future.add_done_callback(release)
+        self.profile.count("extract", "shared_bytes", shm.size)
+        return future, key
+
+    def take_mesh(self, mol_name):
+        # Mesh of the surface an enabled single-state object shows, read
+        # with its snapshot (the API lock held) so that it matches it: its
+        # cache key and encoded mesh, or cached (ZipInfo, data). None when
+        # there is none. Meshes are cached with the object's fingerprint and
+        # the global surface settings, so the surface is only computed again
+        # when it changes.
+        import time
+        self._meshes[mol_name] = None
+        pse_data = self._pse_molecules[mol_name]
+        if pse_data[2] != 1 or cmd.count_states(f"%{mol_name}") != 1:
+            return
+        if not cmd.count_atoms(f"%{mol_name} and rep surface"):
+            return
+        settings = tuple(cmd.get(name) for name in mesh_settings)
+        key = ("mesh", self.object_fingerprint(mol_name), settings)
+        cached = None
+        if self._cache is not None:
+            cached = self._cache.get(key)
+        if cached is not None:
+            self._meshes[mol_name] = (key, cached)
+            return
+
+        start = time.perf_counter()
+        triangles = surface_triangles(mol_name)
+        self.profile.count("mesh", "pymol_seconds", time.perf_counter() - start)
+        if triangles is None:
+            return
+        alpha = 1.0 - float(cmd.get("transparency", mol_name))
+        self.profile.count("mesh", "triangles", len(triangles[0]) // 3)
+        self._meshes[mol_name] = (key, encode_mesh(*triangles, alpha=alpha))
+
+    def mesh_asset(self, writer, mol_name):
+        # (ZipInfo, compressed data) of the mesh read by take_mesh(), None
+        # when there is none. It is dropped.
+        import zipfile
+        import zlib
+        if mol_name not in self._meshes:
+            # Given a session, there was no snapshot to read it with
+            with cmd.lockcm:
+                self.take_mesh(mol_name)
+        mesh = self._meshes.pop(mol_name)
+        if mesh is None:
+            return None
+        key, data = mesh
+        if isinstance(data, tuple):
+            zinfo, data = data
+            if zinfo.compress_type == writer.compression:
+                self.profile.count("mesh", "cached")
+                return writer.copy_info(zinfo), data
+            # Cached with the other compression
+            if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                data = zlib.decompress(data, -15)
+        identifier = mol_name.replace(' ', '_') + "_surface.mesh"
+        zinfo, data, compress_time = writer.compress_asset(identifier, data)
+        self.profile.count("mesh", "compress_seconds", compress_time)
+        if self._cache is not None:
+            self._cache.put(key, (zinfo, data), len(data))
+        return zinfo, data
+
+    def check_cancelled(self):
+        if self.cancelled is not None and self.cancelled():
+            raise ExportCancelled()
+
+    def report_progress(self, stage, done, total):
+        if self.progress is not None:
+            self.progress(stage, done, total)
+
+    def export_to_molz(self, in_memory=False, compresslevel=6, molz_path=None,
+                       compact=True):
+        # Returns the path of the .molz (molz_path, else in the temp
+        # directory), or a file object holding the archive when in_memory is
+        # set. The archive only appears at its path once complete.
+        # state.json is written without whitespace when compact is set, the
+        # same JSON values otherwise byte for byte as json.dump.
+        # Raises ExportCancelled, without leaving any file behind, as soon as
+        # self.cancelled() returns True.
+        import tempfile
+        from concurrent.futures import Future
+        from concurrent.futures.process import BrokenProcessPool
+        part_path = None
+        if not in_memory:
+            if molz_path is None:
+                molz_path = os.path.join(
+                    tempfile.gettempdir(), self._name + ".molz")
+            part_path = molz_path + ".part"
+
+        profile = self.profile
+        with self.memory, profile.capture(), \
+                MolzWriter(part_path, compresslevel) as writer:
+            with profile.stage("extract"):
+                if self._structures is None:
+                    self._structures = self.structure_formats()
+                structures, name_map = self._structures
+
+            # The components of each structure are written to state.json as
+            # soon as they are extracted, they are never all in memory. The
+            # meshes are added to the archive once it is written. With
+            # worker processes, at most 2 * workers objects are extracted
+            # ahead, their components are written in object order. In object
+            # at a time extraction, state.json goes to a temporary file until
+            # complete, and the structure file and mesh of each object are
+            # added to the archive as soon as they are read.
+            meshes = []
+            pool = None
+            if self.workers:
+                pool = get_extract_pool(self.workers)
+            pending = []
+
+            def write_mesh(zinfo, data):
+                with profile.stage("mesh"):
+                    writer.write_entry(zinfo, data)
+                profile.count("mesh", "meshes")
+                profile.count("mesh", "bytes", zinfo.file_size)
+                profile.count("mesh", "compressed_bytes", zinfo.compress_size)
+
+            def write_next():
+                future, key, mesh = pending.pop(0)
+                with profile.stage("extract"):
+                    components = future.result()
+                    if key is not None:
+                        # Approximate size, see cached_representations()
+                        size = sum(512 + 16 * len(c["Selection"])
+                                   for c in components)
+                        self._cache.put(key, components, size)
+                if mesh is not None:
+                    if self.per_object:
+                        write_mesh(*mesh)
+                    else:
+                        meshes.append(mesh)
+                    identifier = mesh[0].filename[len("assets/"):]
+                    # Copies, the representations are shared and cached
+                    components = [
+                        dict(c, Representations=[
+                            dict(r, Parameters=dict(r["Parameters"],
+                                                    Mesh=identifier))
+                            for r in c["Representations"]])
+                        if c["Name"] == "Surface" else c
+                        for c in components]
+                with profile.stage("archive"):
+                    write_components(components)
+                profile.count("extract", "components", len(components))
+
+            with writer.state_file(structures, compact,
+                                   spool=self.per_object) as write_components:
+                try:
+                    for i, structure in enumerate(list(structures)):
+                        mol_name = structure["Name"]
+                        self.check_cancelled()
+                        self.memory.check()
+                        self.report_progress("extract", i, len(name_map))
+                        if not self.load_object(mol_name):
+                            # Deleted during the export: left out of
+                            # state.json, only written once complete
+                            structures.remove(structure)
+                            continue
+                        if self.per_object:
+                            with profile.stage("serialize"):
+                                self.write_structure(
+                                    writer, mol_name,
+                                    self.submit_structure(writer, structure))
+                        with profile.stage("extract"):
+                            if pool is None:
+                                future = Future()
+                                future.set_result(self.cached_representations(
+                                    mol_name, name_map))
+                                key = None
+                            else:
+                                future, key = self.submit_representations(
+                                    pool, mol_name, name_map)
+                        mesh = None
+                        if self.meshes:
+                            with profile.stage("mesh"):
+                                mesh = self.mesh_asset(writer, mol_name)
+                        pending.append((future, key, mesh))
+                        profile.count("extract", "objects")
+                        profile.count("extract", "atoms",
+                                      len(self._pse_molecules[mol_name][5][7]))
+                        self.unload_object(mol_name)
+                        if len(pending) > (2 * self.workers if pool else 0):
+                            write_next()
+                    while pending:
+                        self.check_cancelled()
+                        write_next()
+                except BrokenProcessPool:
+                    # A worker died: the next export starts new ones
+                    discard_extract_pool()
+                    raise
+                finally:
+                    for future, _, _ in pending:
+                        future.cancel()
+                    del pending[:]
+            profile.count("archive", "state_bytes", writer.state_size)
+            for mesh in meshes:
+                write_mesh(*mesh)
+            del meshes
+            self.report_progress("extract", len(name_map), len(name_map))
+
+            if not self.per_object:
+                with profile.stage("serialize"):
+                    self.save_structures(writer, structures)
+
+            self.check_cancelled()
+            self.report_progress("archive", 0, 1)
+            with profile.stage("archive"):
+                writer.close()
+                profile.count("archive", "bytes", writer.size)
+        if part_path is not None:
+            os.replace(part_path, molz_path)
+            writer.archive = molz_path
+        self.report_progress("archive", 1, 1)
+        return writer.archive
+
+
+class TokenStore():
+    # Nanome token, its expiry (epoch seconds) and the account it belongs
+    # to, kept in the system keyring
+    # when the keyring module is available and has a backend, else in a file
+    # only readable by the user in the plugin's config directory
+    keyring_service = "nanome-pymol-plugin"
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(config_dir(), "token.json")
+
+    def _keyring(self):
+        try:
+            import keyring
+        except ImportError:
+            return None
+        return keyring
+
+    def load(self):
+        data = None
+        keyring = self._keyring()
+        if keyring is not None:
+            try:
+                data = keyring.get_password(self.keyring_service, "token")
+            except Exception:
+                pass
+        try:
+            if not data:
+                with open(self.path) as f:
+                    data = f.read()
+            stored = json.loads(data)
+            return (stored["token"], float(stored["expires_at"]),
+                    stored.get("account"))
+        except Exception:
+            return None, 0.0, None
+
+    def save(self, token, expires_at, account=None):
+        data = json.dumps({"token": token, "expires_at": expires_at,
+                           "account": account})
+        keyring = self._keyring()
+        if keyring is not None:
+            try:
+                keyring.set_password(self.keyring_service, "token", data)
+                return
+            except Exception as e:
+                # e.g. no keyring backend on this system
+                print(f"Could not store the Nanome token in the keyring: {e}")
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode of os.open only applies to new files
+            os.chmod(self.path, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+        except Exception as e:
+            print(f"Could not store the Nanome token: {e}")
+
+    def clear(self):
+        keyring = self._keyring()
+        if keyring is not None:
+            try:
+                keyring.delete_password(self.keyring_service, "token")
+            except Exception:
+                pass
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
 
-        for mol_name in name_map:
-            components.extend(
-                self.get_representations(mol_name, name_map))
 
-        self.create_state_file(main_dir, structures, components)
-        molz_path = self.create_molz_archive(main_dir)
-        cmd.load(self._pse_path)
-        return molz_path
+def token_expiry(token, default_lifetime=24 * 3600):
+    # Expiry of a JWT token from its "exp" claim, or default_lifetime
+    # seconds from now for tokens that are not JWTs
+    import base64
+    import time
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + default_lifetime
 
 
 class WorkspaceAPI():
-    def __init__(self, username, passw):
-        self.token = None
+    def __init__(self, username=None, passw=None, token_store=None):
+        import threading
+        # The password is only kept until the next login, the token is used
+        # after that
         self.username = username
         self.password = passw
+        self.token_store = token_store or TokenStore()
+        self.token, self.expires_at, self.account = self.token_store.load()
+        # Sends log in again this many seconds before the token expires,
+        # when credentials were given since the last login
+        self.refresh_margin = 300.0
+        self._login_lock = threading.Lock()
         self.login_url = "https://api.nanome.ai/user/login"
         self.load_url = "https://workspace-service-api.nanome.ai/load/workspace"
+        # (connect, read) timeouts of the upload, in seconds
+        self.upload_timeout = (10.0, 300.0)
+        # Retries on timeouts, connection errors and 5xx responses
+        self.max_retries = 3
+        self.retry_backoff = 1.0  # seconds, doubled on each retry
+        self._http = None
+
+    def http_session(self):
+        # Pooled connections shared by the login and load requests
+        import requests
+        if self._http is None:
+            self._http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=2, pool_maxsize=4)
+            self._http.mount("https://", adapter)
+            self._http.mount("http://", adapter)
+        return self._http
+
+    def set_credentials(self, username, passw):
+        self.username = username
+        self.password = passw
+
+    def has_token(self, margin=0.0):
+        import time
+        return self.token is not None and time.time() < self.expires_at - margin
+
+    def ensure_token(self, profile=None):
+        # Returns None when a valid token is available, after logging in
+        # again if it is about to expire, else the reason of the failure
+        if self.has_token(self.refresh_margin):
+            return None
+        if self.username is None or self.password is None:
+            if self.has_token():
+                return None
+            self.token = None
+            return "login required"
+        return self.get_nanome_token(profile)
 
-    def get_nanome_token(self):
+    def get_nanome_token(self, profile=None):
         import requests
-        token_request_dict = {"login": self.username,
-                              "pass": self.password, "source": "api:pymol-plugin"}
+        profile = profile or SendProfile()
+        with self._login_lock, profile.stage("login"):
+            if self.username is None or self.password is None:
+                return "login required"
+            profile.count("login", "attempts")
+            token_request_dict = {"login": self.username,
+                                  "pass": self.password, "source": "api:pymol-plugin"}
+            try:
+                r = self.http_session().post(
+                    self.login_url, json=token_request_dict, timeout=5.0)
+            except requests.RequestException as e:
+                print("Error getting Nanome login token:", e)
+                return "connection failed"
+            # Answered: the password is not needed anymore
+            self.password = None
+            if not r.ok:
+                if 400 <= r.status_code < 500:
+                    # Wrong credentials, don't try them again
+                    self.username = None
+                print("Error getting Nanome login token:", r.reason)
+                return r.reason
+            try:
+                token = r.json()["results"]["token"]["value"]
+                if not isinstance(token, str) or not token:
+                    raise ValueError(f"bad token {token!r}")
+            except (ValueError, KeyError, TypeError) as e:
+                print("Unexpected answer to the Nanome login:", e)
+                return "unexpected answer"
+            self.token = token
+            self.expires_at = token_expiry(self.token)
+            self.account = self.username
+            self.token_store.save(self.token, self.expires_at, self.account)
+
+    def logout(self):
+        self.token = None
+        self.expires_at = 0.0
+        self.account = None
         self.username = None
         self.password = None
-        r = requests.post(self.login_url, json=token_request_dict, timeout=5.0)
-        if r.ok:
-            response = r.json()
-            result = response["results"]
-            self.token = result["token"]["value"]
-        else:
-            self.token = 0
-            print("Error getting Nanome login token:", r.reason)
-            return r.reason
-
-    def send_file(self, filepath):
-        import requests
-
-        if self.token is None:
-            r_token = self.get_nanome_token()
+        self.token_store.clear()
+
+    def send_file(self, filepath, name=None, progress=None, profile=None):
+        # filepath is the path of a .molz file, removed once sent and kept
+        # when the upload fails, or a file object holding the archive, closed
+        # once sent. progress is called
+        # with (bytes sent, total bytes, bytes/s) during the upload.
+        # The login and upload times are added to profile.
+        profile = profile or SendProfile(name)
+        reason = self.ensure_token(profile)
+        if reason is not None:
+            print(f"Could not send the session file to Nanome: {reason}")
+            profile.status = reason
+            return reason
 
-        if self.token == 0:
-            self.token = None
-            return r_token
-
-        formData = {'load-in-headset': True, 'format': 'molz'}
-        with open(filepath, 'rb') as f:
-            data = f.read()
-        files = {os.path.splitext(os.path.basename(filepath))[0]: data}
-        headers = {'Authorization': f'Bearer {self.token}'}
-        result = requests.post(
-            self.load_url, headers=headers, data=formData, files=files)
+        if isinstance(filepath, str):
+            name = name or os.path.splitext(os.path.basename(filepath))[0]
+            f = open(filepath, 'rb')
+        else:
+            f = filepath
+        try:
+            formData = {'load-in-headset': True, 'format': 'molz'}
+            body = MultipartUpload(formData, name, f, progress)
+            headers = {'Authorization': f'Bearer {self.token}',
+                       'Content-Type': body.content_type}
+            profile.count("upload", "bytes", len(body))
+            result = self.post_with_retries(self.load_url, headers, body, profile)
+            if result is not None and result.status_code == 401 \
+                    and self.password is not None:
+                # Token revoked before its expiry: log in again, once, with
+                # credentials given since the last login
+                if self.get_nanome_token(profile) is None:
+                    headers['Authorization'] = f'Bearer {self.token}'
+                    result = self.post_with_retries(
+                        self.load_url, headers, body, profile)
+            if result is not None and result.status_code == 401:
+                self.token = None
+                self.token_store.clear()
+        finally:
+            f.close()
+
+        if result is None:
+            profile.status = "connection failed"
+            return "connection failed"
         if not result.ok:
             print(
                 f"Could not send the session file to Nanome: {result.reason}")
+            profile.status = result.reason
+            return result.reason
+        if isinstance(filepath, str):
+            os.remove(filepath)
+        profile.status = "sent"
+        print("Successfully sent the current session to Nanome !")
+
+    def post_with_retries(self, url, headers, body, profile=None):
+        import requests
+        import time
+        profile = profile or SendProfile()
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            body.rewind()
+            profile.count("upload", "attempts")
+            try:
+                with profile.stage("upload"):
+                    result = self.http_session().post(
+                        url, headers=headers, data=body, timeout=self.upload_timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                print(f"Could not reach Nanome: {e}")
+                if last_attempt:
+                    return None
+            else:
+                if result.status_code < 500 or last_attempt:
+                    return result
+                print(f"Nanome answered {result.status_code} {result.reason}")
+            print(f"Retrying in {delay:.0f}s")
+            time.sleep(delay)
+            delay *= 2
+
+
+def convert_init():
+    # Each worker process of the batch converter runs its own headless Pymol
+    import pymol
+    pymol.finish_launching(['pymol', '-cq'])
+
+
+def convert_session(pse_path, molz_path, compresslevel=6, frames=None,
+                    formats=None, selection=None, visible_only=False,
+                    memory_limit=None, meshes=False):
+    # Converts one session file in the worker's Pymol, returns the time taken
+    # and the stages of the export
+    import time
+    start = time.perf_counter()
+    profile = SendProfile()
+    with profile.stage("load"):
+        cmd.reinitialize()
+        cmd.load(pse_path)
+    name = os.path.splitext(os.path.basename(molz_path))[0]
+    objects = scoped_objects(selection, visible_only)
+    # Nothing is shared between the sessions of a batch
+    molz = PymolToMolz(name=name, cache=None, profile=profile, frames=frames,
+                       formats=formats, objects=objects,
+                       memory_limit=memory_limit, meshes=meshes)
+    molz.export_to_molz(compresslevel=compresslevel, molz_path=molz_path)
+    return time.perf_counter() - start, profile.stages
+
+
+def find_sessions(inputs):
+    # Session files of the given files, directories and glob patterns, in a
+    # stable order and without duplicates
+    import glob
+    paths = []
+    for i in inputs:
+        if os.path.isdir(i):
+            paths.extend(sorted(glob.glob(os.path.join(i, "*.pse"))))
+        elif os.path.isfile(i):
+            paths.append(i)
+        else:
+            paths.extend(sorted(glob.glob(i, recursive=True)))
+    seen = set()
+    return [p for p in paths if not (p in seen or seen.add(p))]
+
+
+def read_report(report_path):
+    # Entries of a previous run, by input path
+    entries = {}
+    if report_path is None or not os.path.exists(report_path):
+        return entries
+    with open(report_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                entries.setdefault(entry["input"], []).append(entry)
+            except (ValueError, KeyError):
+                continue
+    return entries
+
+
+def convert(inputs, output_dir=None, jobs=None, upload=False, overwrite=False,
+            report_path=None, compresslevel=6, frames=None, formats=None,
+            selection=None, visible_only=False, memory_limit=None,
+            meshes=False):
+    # Converts session files to .molz in parallel headless Pymol processes.
+    # Outputs already there are skipped, so an interrupted run can be started
+    # again. One JSON line per file is appended to report_path.
+    # Returns the number of files that failed.
+    import concurrent.futures
+    import multiprocessing
+    import time
+
+    sessions = find_sessions(inputs)
+    if not sessions:
+        print("No session file found")
+        return 0
+    previous = read_report(report_path)
+    api = None
+    if upload:
+        api = WorkspaceAPI(os.environ.get("NANOME_USERNAME"),
+                           os.environ.get("NANOME_PASSWORD"))
+        reason = api.ensure_token()
+        if reason is not None:
+            print(f"Could not log in to Nanome: {reason}, set NANOME_USERNAME "
+                  "and NANOME_PASSWORD or log in from the plugin first")
+            return len(sessions)
+
+    report = open(report_path, "a") if report_path else None
+    failed = 0
+
+    def record(entry):
+        nonlocal failed
+        if entry["status"] == "failed":
+            failed += 1
+        print(f"[{entry['status']}] {entry['input']}"
+              + (f": {entry['error']}" if entry.get("error") else ""))
+        if report is not None:
+            report.write(json.dumps(entry) + "\n")
+            report.flush()
+
+    def send(entry):
+        # Uploads from this process, the .molz is kept
+        start = time.perf_counter()
+        profile = SendProfile()
+        reason = api.send_file(open(entry["output"], "rb"),
+                               os.path.splitext(os.path.basename(entry["output"]))[0],
+                               profile=profile)
+        entry["upload_seconds"] = round(time.perf_counter() - start, 3)
+        entry.setdefault("stages", {}).update(profile.stages)
+        if reason is None:
+            entry["status"] = "uploaded"
         else:
-            print("Successfully sent the current session to Nanome !")
-        os.remove(filepath)
+            entry["status"] = "failed"
+            entry["error"] = f"upload: {reason}"
+
+    todo = []
+    for pse_path in sessions:
+        out_dir = output_dir or os.path.dirname(pse_path)
+        molz_path = os.path.join(
+            out_dir, os.path.splitext(os.path.basename(pse_path))[0] + ".molz")
+        if os.path.exists(molz_path) and not overwrite:
+            entry = {"input": pse_path, "output": molz_path, "status": "skipped"}
+            uploaded = any(e.get("status") == "uploaded"
+                           for e in previous.get(pse_path, []))
+            if api is not None and not uploaded:
+                send(entry)
+            record(entry)
+            continue
+        os.makedirs(out_dir or ".", exist_ok=True)
+        todo.append((pse_path, molz_path))
+
+    context = multiprocessing.get_context("spawn")
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs or os.cpu_count(), mp_context=context,
+                initializer=convert_init) as pool:
+            futures = {
+                pool.submit(convert_session, pse_path, molz_path, compresslevel,
+                            frames, formats, selection, visible_only,
+                            memory_limit, meshes):
+                    (pse_path, molz_path)
+                for pse_path, molz_path in todo}
+            for future in concurrent.futures.as_completed(futures):
+                pse_path, molz_path = futures[future]
+                entry = {"input": pse_path, "output": molz_path}
+                try:
+                    seconds, entry["stages"] = future.result()
+                    entry["seconds"] = round(seconds, 3)
+                    entry["status"] = "converted"
+                except Exception as e:
+                    entry["status"] = "failed"
+                    entry["error"] = f"{type(e).__name__}: {e}"
+                if api is not None and entry["status"] == "converted":
+                    send(entry)
+                record(entry)
+    finally:
+        if report is not None:
+            report.close()
+    return failed
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python -m PymolSendToNanome2",
+        description="Pymol to Nanome 2 command line tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_parser = commands.add_parser(
+        "convert", help="convert Pymol session files to .molz files")
+    convert_parser.add_argument(
+        "inputs", nargs="+",
+        help="session files, directories of .pse files or glob patterns")
+    convert_parser.add_argument(
+        "-o", "--output-dir",
+        help="directory of the .molz files, next to the sessions by default")
+    convert_parser.add_argument(
+        "-j", "--jobs", type=int,
+        help="number of Pymol worker processes, the number of CPUs by default")
+    convert_parser.add_argument(
+        "--upload", action="store_true",
+        help="also send each .molz file to Nanome, with the token of the "
+             "plugin or NANOME_USERNAME and NANOME_PASSWORD")
+    convert_parser.add_argument(
+        "--overwrite", action="store_true",
+        help="convert again the sessions that already have a .molz file")
+    convert_parser.add_argument(
+        "--report", help="JSON lines file of per file status, time and error")
+    convert_parser.add_argument(
+        "--compresslevel", type=int, default=6, choices=range(10),
+        help="deflate level of the .molz files, 0 to store them")
+    convert_parser.add_argument(
+        "--frames", type=parse_frames,
+        help="states of multi-state objects to convert, first:last:stride")
+    convert_parser.add_argument(
+        "--bcif-atoms", type=int,
+        help="write the objects of at least this many atoms as BinaryCIF "
+             "instead of mmCIF")
+    convert_parser.add_argument(
+        "--selection",
+        help="only convert the objects with atoms in this Pymol selection")
+    convert_parser.add_argument(
+        "--visible-only", action="store_true",
+        help="only convert the objects enabled in the sessions")
+    convert_parser.add_argument(
+        "--memory-limit", type=int, metavar="MB",
+        help="extract one object at a time and fail the sessions whose "
+             "conversion goes over this resident memory of the worker "
+             "process, the session included (1 MB = 1024 * 1024 bytes)")
+    convert_parser.add_argument(
+        "--meshes", action="store_true",
+        help="also write the surfaces shown in the sessions as meshes")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        failed = convert(args.inputs, args.output_dir, args.jobs, args.upload,
+                         args.overwrite, args.report, args.compresslevel,
+                         args.frames, format_policy(args.bcif_atoms),
+                         args.selection, args.visible_only,
+                         args.memory_limit and args.memory_limit * 1024 * 1024,
+                         args.meshes)
+        return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,389 @@
+# Benchmark of the molz export pipeline on synthetic sessions, run in a
+# headless Pymol:
+#
+#   python benchmarks/bench_molz.py                 # default presets
+#   python benchmarks/bench_molz.py --preset 1m     # or --all
+#   python benchmarks/bench_molz.py --update-golden
+#   python benchmarks/bench_molz.py --workers 1,2,4 # parallel extraction
+#
+# Every stage of PymolToMolz.export_to_molz is timed, then measured again
+# with tracemalloc for its peak Python memory. The state.json of every run is
+# checked against benchmarks/golden.json so an optimization can be shown to
+# leave the output unchanged: the digests are those of the non compact
+# state.json, and the compact one must hold the same JSON values.
+import os
+import sys
+import json
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+golden_path = os.path.join(here, "golden.json")
+# Sizes and memory are reported in MB of 1024 * 1024 bytes, as in the plugin
+MB = 1024 * 1024
+
+# name: (atoms, states, objects, ligands, unique settings density, discrete)
+presets = {
+    "1k": (1000, 1, 1, 5, 0.05, False),
+    "states": (5000, 100, 1, 0, 0.05, False),
+    "trajectory": (1000, 500, 1, 0, 0.0, False),
+    "discrete": (5000, 20, 1, 0, 0.05, True),
+    "objects": (50000, 1, 100, 100, 0.05, False),
+    "settings": (20000, 1, 2, 10, 1.0, False),
+    "100k": (100000, 1, 1, 10, 0.05, False),
+    "1m": (1000000, 1, 1, 10, 0.05, False),
+}
+default_presets = ["1k", "states", "trajectory", "discrete", "objects",
+                   "settings", "100k"]
+
+reps = [1, 2, 4, 8, 16, 32, 128, 1 | 2, 1 | 32, 4 | 128]
+color_names = ["red", "green", "blue", "yellow", "magenta", "cyan", "orange",
+               "white", "grey50", "salmon", "bench_color"]
+atom_color_settings = ["sphere_color", "surface_color", "cartoon_color",
+                       "ribbon_color", "mesh_color"]
+
+
+def make_copies(cmd, name, unit, atoms):
+    # Copies of the unit object laid out along x, merged in one object of
+    # about the requested number of atoms
+    cmd.create(name, unit)
+    copies = 1
+    while cmd.count_atoms(name) < atoms:
+        (x0, _, _), (x1, _, _) = cmd.get_extent(name)
+        cmd.create("bench_copy", name)
+        cmd.translate([x1 - x0 + 4.0, 0, 0], "bench_copy", camera=0)
+        cmd.alter("bench_copy", f"resv += {copies * 1000}")
+        cmd.create("bench_merged", f"{name} or bench_copy")
+        cmd.delete(name)
+        cmd.delete("bench_copy")
+        cmd.set_name("bench_merged", name)
+        copies *= 2
+    # Whole residues only
+    cmd.remove(f"byres ({name} and index {atoms + 1}-{2 * atoms + 10000})")
+
+
+def add_states(cmd, name, states, discrete):
+    if discrete:
+        cmd.create("bench_discrete", name, 1, 1, discrete=1)
+    for state in range(2, states + 1):
+        if discrete:
+            # Discrete states of different sizes
+            cmd.create("bench_discrete", f"{name} and not resi {state}",
+                       1, state, discrete=1)
+        else:
+            cmd.create(name, name, 1, state)
+    if discrete:
+        cmd.delete(name)
+        cmd.set_name("bench_discrete", name)
+    for state in range(2, states + 1):
+        cmd.translate([0, 0, 0.05 * state], name, state=state, camera=0)
+
+
+def style(cmd, rnd, name, density):
+    # Random reps and colors for every atom, and color settings for a
+    # fraction of them
+    indices = [cmd.get_color_index(c) for c in color_names]
+
+    def pick(s):
+        if rnd.random() < density:
+            setattr(s, rnd.choice(atom_color_settings), rnd.choice(indices))
+        return rnd.choice(reps) | rnd.choice(reps), rnd.choice(indices)
+
+    cmd.alter(name, "reps, color = pick(s)", space={"pick": pick})
+    if density:
+        cmd.set_bond("stick_color", "purple", f"{name} and resi 2-4")
+
+
+def build_scene(cmd, preset, seed=0):
+    import random
+    atoms, states, objects, ligands, density, discrete = presets[preset]
+    rnd = random.Random(seed)
+    cmd.reinitialize()
+    cmd.feedback("disable", "all", "everything")
+    # Nothing is rendered, representations are never built
+    cmd.set("defer_builds_mode", 3)
+    cmd.set_color("bench_color", [0.2, 0.7, 0.3])
+    cmd.fab("ACDEFGHIKLMNPQRSTVWY", "bench_unit", ss=1)
+    cmd.fab("GAG", "bench_ligand")
+    for i in range(objects):
+        name = f"protein_{i}"
+        make_copies(cmd, name, "bench_unit", atoms // objects)
+        add_states(cmd, name, states, discrete)
+        style(cmd, rnd, name, density)
+    for i in range(ligands):
+        name = f"ligand_{i}"
+        cmd.create(name, "bench_ligand")
+        cmd.translate([0, 10.0 * (i + 1), 0], name, camera=0)
+        style(cmd, rnd, name, density)
+    cmd.delete("bench_unit")
+    cmd.delete("bench_ligand")
+    cmd.set("surface_color", "white")
+    cmd.set("cartoon_color", "grey50", "protein_0")
+    if ligands:
+        cmd.disable("ligand_0")
+    cmd.frame(1)
+    cmd.feedback("enable", "all", "errors")
+
+
+def export(P, memory=False, compact=True, frames=None, formats=None,
+           per_object=None, memory_limit=None, meshes=False, workers=None):
+    # Runs one export, returns the stages (seconds, peak bytes) and archive.
+    # The times are those of the export's profile, the memory peaks are
+    # taken between the progress reports of two stages.
+    import tracemalloc
+    peaks = {}
+    current = [None]
+
+    def progress(stage, done, total):
+        if memory and stage != current[0]:
+            if current[0] is not None:
+                peaks[current[0]] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.reset_peak()
+            current[0] = stage
+
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        molz = P.PymolToMolz(cache=None, progress=progress, frames=frames,
+                             formats=formats, per_object=per_object,
+                             memory_limit=memory_limit, meshes=meshes,
+                             workers=workers)
+        archive = molz.export_to_molz(in_memory=True, compact=compact)
+        if memory:
+            peaks[current[0]] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if memory:
+            tracemalloc.stop()
+    total = time.perf_counter() - start
+    stages = {}
+    for stage, counters in molz.profile.stages.items():
+        if stage == "memory":
+            continue
+        stages[stage] = {"seconds": counters["seconds"]}
+        if stage in peaks:
+            stages[stage]["peak"] = peaks[stage]
+    stages["total"] = {"seconds": total}
+    return stages, archive, molz
+
+
+def state_digest(archive):
+    import hashlib
+    import zipfile
+    with zipfile.ZipFile(archive) as z:
+        data = z.read("state.json")
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def peak_rss():
+    # Peak resident memory of the process, in bytes
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the molz export on synthetic sessions")
+    parser.add_argument("--preset", action="append", choices=sorted(presets),
+                        help="preset to run, can be repeated")
+    parser.add_argument("--all", action="store_true", help="run every preset")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per preset, the fastest is kept")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc run")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="record the state.json digests as golden")
+    parser.add_argument("--keep", help="directory where the state.json "
+                        "files that differ from the golden ones are written")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--frames", help="first:last:stride states of the "
+                        "multi-state objects to export, the golden digests "
+                        "are then not checked")
+    parser.add_argument("--bcif-atoms", type=int, help="write the objects "
+                        "of at least this many atoms as BinaryCIF, the "
+                        "golden digests are then not checked")
+    parser.add_argument("--per-object", action="store_true",
+                        help="read the sessions one object at a time")
+    parser.add_argument("--memory-limit", type=float, help="memory limit of "
+                        "the exports in MB, read one object at a time")
+    parser.add_argument("--meshes", action="store_true", help="also export "
+                        "the surfaces as meshes, the golden digests are "
+                        "then not checked")
+    parser.add_argument("--workers", type=lambda text: [
+                        int(w) for w in text.split(",")], help="also time "
+                        "the extraction in these numbers of worker processes, "
+                        "e.g. 1,2,4, and check they give the same output")
+    args = parser.parse_args(argv)
+
+    import pymol
+    pymol.finish_launching(['pymol', '-cq'])
+    from pymol import cmd
+    sys.path.insert(0, os.path.dirname(here))
+    import PymolSendToNanome2 as P
+
+    golden = {}
+    if os.path.exists(golden_path):
+        with open(golden_path) as f:
+            golden = json.load(f)
+
+    frames = P.parse_frames(args.frames)
+    formats = P.format_policy(args.bcif_atoms)
+    options = {"frames": frames, "formats": formats,
+               "per_object": args.per_object or None,
+               "memory_limit": args.memory_limit and args.memory_limit * MB,
+               "meshes": args.meshes}
+    names = list(presets) if args.all else args.preset or default_presets
+    results = {"pymol": cmd.get_version()[0], "presets": {}}
+    mismatches = []
+    for name in names:
+        start = time.perf_counter()
+        build_scene(cmd, name)
+        build_time = time.perf_counter() - start
+        runs = [export(P, **options) for _ in range(max(1, args.repeat))]
+        stages, archive, molz = min(
+            runs, key=lambda r: r[0]["total"]["seconds"])
+        structure_timings = molz.structure_timings
+        if not args.no_memory:
+            memory_stages = export(P, memory=True, **options)[0]
+            for stage, values in memory_stages.items():
+                if "peak" in values:
+                    stages[stage]["peak"] = values["peak"]
+
+        digest, state = state_digest(
+            export(P, compact=False, **options)[1])
+        compact_state = state_digest(archive)[1]
+        expected = golden.get(name)
+        if json.loads(compact_state) != json.loads(state):
+            status = "COMPACT DIFFERS"
+            mismatches.append(name)
+        elif (frames is not None or args.bcif_atoms is not None
+              or args.meshes):
+            status = "not checked"
+        elif args.update_golden:
+            golden[name] = digest
+            status = "recorded"
+            with open(golden_path, "w") as f:
+                json.dump(golden, f, indent=2, sort_keys=True)
+                f.write("\n")
+        elif expected is None:
+            status = "no golden"
+        elif expected == digest:
+            status = "ok"
+        else:
+            status = "DIFFERS"
+            mismatches.append(name)
+            if args.keep:
+                os.makedirs(args.keep, exist_ok=True)
+                with open(os.path.join(args.keep, name + ".state.json"), "wb") as f:
+                    f.write(state)
+
+        results["presets"][name] = {
+            "atoms": cmd.count_atoms("all"),
+            "states": cmd.count_states("all"),
+            "objects": len(cmd.get_names("objects")),
+            "build_seconds": build_time,
+            "stages": stages,
+            "counters": molz.profile.stages,
+            "serialize_seconds": sum(
+                t.get("serialize", 0.0) for t in structure_timings.values()),
+            "compress_seconds": sum(
+                t.get("compress", 0.0) for t in structure_timings.values()),
+            "formats": format_results(structure_timings),
+            "archive_bytes": archive.seek(0, os.SEEK_END),
+            "peak_rss": peak_rss(),
+            "export_peak_rss": molz.profile.stages.get("memory", {}).get("peak_rss"),
+            "state_json": digest,
+            "golden": status,
+        }
+        if args.workers:
+            curve = worker_curve(P, args.workers, args.repeat, options,
+                                 stages, state)
+            results["presets"][name]["workers"] = curve
+            if any(not point["same_output"] for point in curve):
+                mismatches.append(name)
+        print_result(name, results["presets"][name])
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if mismatches:
+        print(f"state.json differs from the golden output for: "
+              f"{', '.join(mismatches)}")
+        return 1
+    return 0
+
+
+def worker_curve(P, worker_counts, repeat, options, serial_stages,
+                 serial_state):
+    # Extraction and total time of the export for each number of worker
+    # processes, with its speedup over the export in Pymol's process. The
+    # pool is started before timing, like it is kept between sends.
+    curve = []
+    for workers in worker_counts:
+        export(P, workers=workers, **options)
+        stages = min((export(P, workers=workers, **options)[0]
+                      for _ in range(max(1, repeat))),
+                     key=lambda s: s["total"]["seconds"])
+        state = state_digest(
+            export(P, compact=False, workers=workers, **options)[1])[1]
+        extract = stages["extract"]["seconds"]
+        total = stages["total"]["seconds"]
+        curve.append({
+            "workers": workers,
+            "extract_seconds": extract,
+            "total_seconds": total,
+            "extract_speedup": serial_stages["extract"]["seconds"] / extract,
+            "total_speedup": serial_stages["total"]["seconds"] / total,
+            "same_output": state == serial_state,
+        })
+    return curve
+
+
+def format_results(structure_timings):
+    # Write time (Pymol, conversion and compression), sizes and throughput
+    # of the structure files of each format
+    formats = {}
+    for t in structure_timings.values():
+        f = formats.setdefault(t["format"], {
+            "structures": 0, "atoms": 0, "seconds": 0.0, "bytes": 0,
+            "compressed_bytes": 0})
+        f["structures"] += 1
+        f["atoms"] += t["atoms"]
+        f["seconds"] += t["serialize"] + t["encode"] + t["compress"]
+        f["bytes"] += t["bytes"]
+        f["compressed_bytes"] += t["compressed_bytes"]
+    for f in formats.values():
+        f["bytes_per_second"] = f["bytes"] / f["seconds"] if f["seconds"] else None
+    return formats
+
+
+def print_result(name, result):
+    print(f"{name}: {result['atoms']} atoms, {result['states']} states, "
+          f"{result['objects']} objects, archive "
+          f"{result['archive_bytes'] / MB:.2f} MB, peak RSS "
+          f"{result['peak_rss'] / MB:.0f} MB, golden {result['golden']}")
+    if result["export_peak_rss"]:
+        print(f"  peak RSS of the export {result['export_peak_rss'] / MB:.0f} MB")
+    for stage, values in result["stages"].items():
+        peak = values.get("peak")
+        peak = f"{peak / MB:10.1f} MB" if peak is not None else ""
+        print(f"  {stage:<10} {values['seconds']:9.3f} s {peak}")
+    for extension, f in result["formats"].items():
+        rate = f["bytes_per_second"]
+        rate = f"{rate / MB:8.1f} MB/s" if rate else ""
+        print(f"  {extension:<10} {f['seconds']:9.3f} s {f['structures']:5d} "
+              f"files {f['bytes'] / MB:8.2f} MB, {f['compressed_bytes'] / MB:8.2f} "
+              f"MB compressed {rate}")
+    for point in result.get("workers", []):
+        print(f"  {point['workers']:3d} workers extract "
+              f"{point['extract_seconds']:9.3f} s "
+              f"({point['extract_speedup']:.2f}x), total "
+              f"{point['total_seconds']:9.3f} s "
+              f"({point['total_speedup']:.2f}x)"
+              + ("" if point["same_output"] else ", OUTPUT DIFFERS"))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Shared by the tests: the plugin in a headless Pymol, and a stand-in HTTP
+# server for the Nanome services
+import json
+import os
+import sys
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pymol
+pymol.finish_launching(["pymol", "-cq"])
+from pymol import cmd  # noqa: E402
+
+import PymolSendToNanome2 as plugin  # noqa: E402
+
+
+class StandInServer():
+    # Local HTTP server, handler(path, headers, body) returns the status and
+    # a JSON-able response (or bytes). Every request is kept in requests as
+    # (path, headers, body).
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.dispatch(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def dispatch(self, request):
+        length = int(request.headers.get("Content-Length", 0))
+        body = request.rfile.read(length)
+        self.requests.append((request.path, dict(request.headers), body))
+        status, payload = self.handler(request.path, request.headers, body)
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode("utf-8")
+        try:
+            request.send_response(status)
+            request.send_header("Content-Type", "application/json")
+            request.send_header("Content-Length", str(len(payload)))
+            request.end_headers()
+            request.wfile.write(payload)
+        except OSError:
+            # The client gave up, e.g. on a timeout
+            pass
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def export(molz, tmpdir, name="export", **kwargs):
+    # Entries of the archive the PymolToMolz molz exports to tmpdir, by name
+    path = os.path.join(tmpdir, name + ".molz")
+    molz.export_to_molz(molz_path=path, **kwargs)
+    with zipfile.ZipFile(path) as z:
+        return {entry: z.read(entry) for entry in z.namelist()}
+
+
+def jwt(expires_at):
+    # Unsigned JWT with an "exp" claim, see token_expiry()
+    import base64
+
+    def part(value):
+        data = json.dumps(value).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+    return ".".join([part({"alg": "none"}), part({"exp": expires_at}), "sig"])
+
+
+def login_response(token):
+    return {"success": True, "results": {"token": {"value": token}}}
+
+
+def make_api(server, tmpdir, username="user", password="secret"):
+    # WorkspaceAPI of the stand-in server, with its token in tmpdir
+    store = plugin.TokenStore(os.path.join(tmpdir, "token.json"))
+    store._keyring = lambda: None
+    api = plugin.WorkspaceAPI(username, password, store)
+    api.login_url = server.url + "/user/login"
+    api.load_url = server.url + "/load/workspace"
+    api.retry_backoff = 0.01
+    return api
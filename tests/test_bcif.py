@@ -0,0 +1,217 @@
+import struct
+import unittest
+
+import numpy as np
+
+from support import cmd, plugin
+
+
+def msgpack_loads(data):
+    # MessagePack decoding of the types msgpack_dumps() writes
+    pos = 0
+
+    def take(size):
+        nonlocal pos
+        pos += size
+        return data[pos - size:pos]
+
+    def unpack(fmt):
+        return struct.unpack(fmt, take(struct.calcsize(fmt)))[0]
+
+    def value():
+        code = take(1)[0]
+        if code < 0x80:
+            return code
+        if code >= 0xe0:
+            return code - 0x100
+        if 0x80 <= code <= 0x8f:
+            return mapping(code & 0x0f)
+        if 0x90 <= code <= 0x9f:
+            return array(code & 0x0f)
+        if 0xa0 <= code <= 0xbf:
+            return take(code & 0x1f).decode("utf-8")
+        simple = {0xc0: None, 0xc2: False, 0xc3: True}
+        if code in simple:
+            return simple[code]
+        sized = {0xc4: ">B", 0xc5: ">H", 0xc6: ">I", 0xd9: ">B", 0xda: ">H",
+                 0xdb: ">I", 0xdc: ">H", 0xdd: ">I", 0xde: ">H", 0xdf: ">I"}
+        if code in sized:
+            size = unpack(sized[code])
+            if code <= 0xc6:
+                return take(size)
+            if code <= 0xdb:
+                return take(size).decode("utf-8")
+            return array(size) if code <= 0xdd else mapping(size)
+        numbers = {0xca: ">f", 0xcb: ">d", 0xcc: ">B", 0xcd: ">H", 0xce: ">I",
+                   0xcf: ">Q", 0xd0: ">b", 0xd1: ">h", 0xd2: ">i", 0xd3: ">q"}
+        return unpack(numbers[code])
+
+    def array(size):
+        return [value() for _ in range(size)]
+
+    def mapping(size):
+        return {value(): value() for _ in range(size)}
+
+    result = value()
+    assert pos == len(data), "trailing bytes"
+    return result
+
+
+def decode(data, encodings):
+    # Values of a BinaryCIF encoded array
+    for encoding in reversed(encodings):
+        kind = encoding["kind"]
+        if kind == "ByteArray":
+            types = {v: k for k, v in plugin.bcif_types.items()}
+            data = np.frombuffer(data, dtype="<" + types[encoding["type"]])
+        elif kind == "FixedPoint":
+            data = np.asarray(data, dtype=np.float64) / encoding["factor"]
+        elif kind == "RunLength":
+            runs = np.asarray(data).reshape(-1, 2)
+            data = np.repeat(runs[:, 0], runs[:, 1])
+            assert len(data) == encoding["srcSize"]
+        elif kind == "Delta":
+            data = np.asarray(data, dtype=np.int64)
+            if len(data):
+                data[0] += encoding["origin"]
+            data = np.cumsum(data)
+        elif kind == "IntegerPacking":
+            values, current = [], 0
+            if encoding["isUnsigned"]:
+                limits = (0xff, 0xffff)[encoding["byteCount"] - 1],
+            else:
+                limits = ((0x7f, -0x80), (0x7fff, -0x8000))[
+                    encoding["byteCount"] - 1]
+            for v in np.asarray(data).tolist():
+                current += v
+                if v not in limits:
+                    values.append(current)
+                    current = 0
+            data = np.array(values, dtype=np.int64)
+            assert len(data) == encoding["srcSize"]
+        elif kind == "StringArray":
+            text = encoding["stringData"]
+            offsets = decode(encoding["offsets"], encoding["offsetEncoding"])
+            strings = [text[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+            data = [strings[i] for i in decode(data, encoding["dataEncoding"])]
+        else:
+            raise ValueError(kind)
+    return data
+
+
+def column_values(column):
+    # Python values of a column, None where masked
+    values = decode(column["data"]["data"], column["data"]["encoding"])
+    values = [v.item() if hasattr(v, "item") else v for v in values]
+    if column["mask"] is not None:
+        mask = decode(column["mask"]["data"], column["mask"]["encoding"])
+        values = [None if m else v for v, m in zip(values, mask)]
+    return values
+
+
+class MsgpackTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [None, True, False, 0, 1, 127, 128, 255, 256, 65535, 65536,
+                  2 ** 32, 2 ** 64 - 1, -1, -32, -33, -128, -129, -32768,
+                  -32769, -2 ** 31 - 1, -2 ** 63, 0.5, -1e300, "", "é",
+                  "x" * 31, "x" * 32, "x" * 256, "x" * 65536, b"", b"\0" * 256,
+                  b"\1" * 65536, list(range(15)), list(range(16)),
+                  list(range(65536)), {str(i): i for i in range(15)},
+                  {str(i): [i] for i in range(16)}]
+        self.assertEqual(msgpack_loads(plugin.msgpack_dumps(values)), values)
+
+    def test_unknown_type(self):
+        with self.assertRaises(TypeError):
+            plugin.msgpack_dumps({1, 2})
+
+
+class BinaryCifTest(unittest.TestCase):
+    def column(self, tokens, kind="str"):
+        return column_values(plugin.bcif_column(
+            "name", [t.encode() for t in tokens], kind))
+
+    def test_ints(self):
+        tokens = ["1", "2", "3", "1000", "-5", "70000", "-70000"] + ["7"] * 20
+        self.assertEqual(self.column(tokens, "int"), [int(t) for t in tokens])
+
+    def test_floats(self):
+        tokens = ["1.5", "-0.001", "12.250", "?", "3", "."]
+        self.assertEqual(self.column(tokens, "float"),
+                         [1.5, -0.001, 12.25, None, 3.0, None])
+
+    def test_numeric_looking_strings(self):
+        # e.g. chain "1" and segment "007"
+        tokens = ["1", "007", "1.50", "A"]
+        self.assertEqual(self.column(tokens), tokens)
+        self.assertEqual(self.column(["007", "1"], "str"), ["007", "1"])
+
+    def test_invalid_numbers(self):
+        self.assertEqual(self.column(["1", "x"], "int"), ["1", "x"])
+        self.assertEqual(self.column(["1.5", "2"], "int"), ["1.5", "2"])
+
+    def test_quoted_strings(self):
+        self.assertEqual(self.column(["'P 1 21 1'", '"?"', "?", "."]),
+                         ["P 1 21 1", "?", None, None])
+
+    def test_no_rows(self):
+        for kind in ("int", "float", "str"):
+            self.assertEqual(self.column([], kind), [])
+
+    def test_session(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEF", "peptide")
+        cmd.alter("all", "chain = '1'")
+        cmd.alter("all", "segi = '007'")
+        cmd.alter("resi 2", "q = 0.5")
+        cmd.set_symmetry("peptide", 10, 20, 30, 90, 90, 90, "P 1 21 1")
+        text = cmd.get_str("cif", "peptide")
+        block, = msgpack_loads(plugin.cif_to_bcif(text))["dataBlocks"]
+        self.assertEqual(block["header"], "peptide")
+        categories = {c["name"]: c for c in block["categories"]}
+        atom_site = categories["_atom_site"]
+        columns = {c["name"]: column_values(c) for c in atom_site["columns"]}
+        count = cmd.count_atoms("peptide")
+        self.assertEqual(atom_site["rowCount"], count)
+        self.assertEqual(columns["id"], list(range(1, count + 1)))
+        self.assertEqual(set(columns["auth_asym_id"]), {"1"})
+        self.assertEqual(set(columns["label_asym_id"]), {"007"})
+        self.assertEqual(columns["label_seq_id"][0], 1)
+        coords = []
+        cmd.iterate_state(1, "peptide", "coords.append((x, y, z))",
+                          space={"coords": coords})
+        np.testing.assert_allclose(
+            np.column_stack([columns[f"Cartn_{a}"] for a in "xyz"]),
+            coords, atol=1e-3)
+        atoms = []
+        cmd.iterate("peptide", "atoms.append((resn, name, q))",
+                    space={"atoms": atoms})
+        self.assertEqual(list(zip(columns["label_comp_id"],
+                                  columns["label_atom_id"],
+                                  columns["occupancy"])), atoms)
+        cell = {c["name"]: column_values(c)[0]
+                for c in categories["_cell"]["columns"]}
+        self.assertEqual(cell["length_b"], 20.0)
+        self.assertEqual(cell["entry_id"], "peptide")
+        symmetry = {c["name"]: column_values(c)[0]
+                    for c in categories["_symmetry"]["columns"]}
+        self.assertEqual(symmetry["space_group_name_H-M"], "P 1 21 1")
+
+    def test_empty_loop(self):
+        text = "data_x\nloop_\n_atom_site.id\n_atom_site.label_asym_id\n#\n"
+        block, = msgpack_loads(plugin.cif_to_bcif(text))["dataBlocks"]
+        category, = block["categories"]
+        self.assertEqual(category["rowCount"], 0)
+        self.assertEqual([column_values(c) for c in category["columns"]],
+                         [[], []])
+
+
+class FormatPolicyTest(unittest.TestCase):
+    def test_bcif_atoms(self):
+        self.assertEqual(plugin.format_policy(), plugin.structure_format_policy)
+        sdf_atoms = plugin.structure_format_policy[0][0]
+        self.assertEqual(plugin.format_policy(5000),
+                         [(sdf_atoms, "sdf"), (5000, "cif"), (None, "bcif")])
+
+
+if __name__ == "__main__":
+    unittest.main()
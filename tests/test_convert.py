@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+import unittest
+
+from support import cmd, plugin
+
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sessions = os.path.join(self.tmpdir.name, "sessions")
+        os.makedirs(self.sessions)
+        for name, sequence in (("peptide", "ACD"), ("other", "WY")):
+            cmd.reinitialize()
+            cmd.fab(sequence, name)
+            cmd.show("sticks")
+            cmd.save(self.path(name + ".pse"))
+        with open(self.path("corrupt.pse"), "wb") as f:
+            f.write(b"not a session")
+        self.output = os.path.join(self.tmpdir.name, "molz")
+        self.report = os.path.join(self.tmpdir.name, "report.jsonl")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.sessions, name)
+
+    def statuses(self, entries):
+        return {os.path.basename(e["input"]): e["status"] for e in entries}
+
+    def test_find_sessions(self):
+        found = plugin.find_sessions([
+            self.sessions, self.path("other.pse"),
+            os.path.join(self.tmpdir.name, "**", "p*.pse")])
+        self.assertEqual(found, [self.path(name) for name in
+                                 ("corrupt.pse", "other.pse", "peptide.pse")])
+        self.assertEqual(plugin.find_sessions(
+            [os.path.join(self.tmpdir.name, "missing")]), [])
+
+    def test_read_report(self):
+        self.assertEqual(plugin.read_report(None), {})
+        self.assertEqual(plugin.read_report(self.report), {})
+        with open(self.report, "w") as f:
+            f.write(json.dumps({"input": "a.pse", "status": "failed"}) + "\n")
+            f.write("interrupted {\n")
+            f.write(json.dumps({"status": "converted"}) + "\n")
+            f.write(json.dumps({"input": "a.pse", "status": "converted"}) + "\n")
+        self.assertEqual(plugin.read_report(self.report), {"a.pse": [
+            {"input": "a.pse", "status": "failed"},
+            {"input": "a.pse", "status": "converted"}]})
+
+    def test_convert_again(self):
+        failed = plugin.convert([self.sessions], output_dir=self.output,
+                                jobs=1, report_path=self.report)
+        self.assertEqual(failed, 1)
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ["other.molz", "peptide.molz"])
+        # The converted sessions are skipped on the next run, the corrupt one
+        # is tried again
+        failed = plugin.convert([self.sessions], output_dir=self.output,
+                                jobs=1, report_path=self.report)
+        self.assertEqual(failed, 1)
+        with open(self.report) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEqual(len(entries), 6)
+        self.assertEqual(self.statuses(entries[:3]), {
+            "peptide.pse": "converted", "other.pse": "converted",
+            "corrupt.pse": "failed"})
+        self.assertEqual(self.statuses(entries[3:]), {
+            "peptide.pse": "skipped", "other.pse": "skipped",
+            "corrupt.pse": "failed"})
+        for entry in entries:
+            self.assertEqual(entry["output"], os.path.join(
+                self.output, os.path.basename(entry["input"])[:-4] + ".molz"))
+            if entry["status"] == "converted":
+                self.assertIn("extract", entry["stages"])
+            self.assertEqual("error" in entry, entry["status"] == "failed")
+        self.assertEqual(len(plugin.read_report(self.report)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from support import cmd, plugin
+
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEF", "peptide")
+        cmd.fab("WYV", "other")
+        cmd.create("peptide", "peptide", 1, 2)
+        cmd.set("stick_radius", 0.3, "peptide and resi 2")
+        self.before = self.fingerprints()
+
+    def fingerprints(self):
+        exporter = plugin.PymolToMolz(name="fingerprint", cache=None)
+        return {name: exporter.object_fingerprint(name)
+                for name in ("peptide", "other")}
+
+    def assertChanges(self):
+        after = self.fingerprints()
+        self.assertNotEqual(after["peptide"], self.before["peptide"])
+        self.assertEqual(after["other"], self.before["other"])
+
+    def test_unchanged(self):
+        self.assertEqual(self.fingerprints(), self.before)
+
+    def test_coordinates(self):
+        cmd.translate([0, 0, 0.01], "peptide and resi 3", state=2)
+        self.assertChanges()
+
+    def test_atom_names(self):
+        cmd.alter("peptide and resi 1 and name CB", "name='CX'")
+        self.assertChanges()
+
+    def test_reps_and_colors(self):
+        cmd.show("spheres", "peptide and resi 4")
+        self.assertChanges()
+        self.before = self.fingerprints()
+        cmd.color("red", "peptide and resi 5")
+        self.assertChanges()
+
+    def test_unique_settings(self):
+        cmd.set("stick_radius", 0.2, "peptide and resi 2")
+        self.assertChanges()
+
+
+if __name__ == "__main__":
+    unittest.main()
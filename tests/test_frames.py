@@ -0,0 +1,107 @@
+import json
+import tempfile
+import unittest
+
+from support import cmd, export, plugin
+
+
+class ParseFramesTest(unittest.TestCase):
+    def test_values(self):
+        self.assertIsNone(plugin.parse_frames(""))
+        self.assertIsNone(plugin.parse_frames(" all "))
+        self.assertEqual(plugin.parse_frames("5"), (5, 5, 1))
+        self.assertEqual(plugin.parse_frames("::10"), (1, None, 10))
+        self.assertEqual(plugin.parse_frames("100:200"), (100, 200, 1))
+        self.assertEqual(plugin.parse_frames("2::3"), (2, None, 3))
+        self.assertEqual(plugin.parse_frames("3:3"), (3, 3, 1))
+
+    def test_invalid(self):
+        for text in ("3:2", "a:b", "0", "1:2:0", "1:2:3:4", "-1:"):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    plugin.parse_frames(text)
+
+
+class FramesTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        # 10 states of a non-discrete object of more than 150 atoms (mmCIF)
+        # and of a small one (SDF)
+        cmd.fab("ACDEFGHIKLMN", "large")
+        cmd.fab("AG", "small")
+        for state in range(2, 11):
+            for name in ("large", "small"):
+                cmd.create(name, name, 1, state)
+                cmd.translate([state, 0, 0], name, state=state, camera=0)
+        # 6 states with atoms of their own
+        cmd.fab("GS", "peptide")
+        for state in range(1, 7):
+            cmd.create("discrete", "peptide", 1, state, discrete=1)
+        cmd.delete("peptide")
+        cmd.show("sticks")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def export(self, frames):
+        return export(plugin.PymolToMolz(name="frames", cache=None,
+                                         frames=plugin.parse_frames(frames)),
+                      self.tmpdir.name, compact=False)
+
+    def models(self, archive, name):
+        state = json.loads(archive["state.json"])
+        return sorted({c["Model"] for c in state["Components"]
+                       if c["Structure"].startswith(name + ".")})
+
+    def cif_models(self, text):
+        lines = text.decode().splitlines(True)
+        start, end = plugin.PymolToMolz.atom_site_rows(lines)
+        items = [line.strip() for line in lines[:start]
+                 if line.startswith("_atom_site.")]
+        column = items.index("_atom_site.pdbx_PDB_model_num")
+        rows = [line.split() for line in lines[start:end]]
+        return rows, sorted({int(row[column]) for row in rows})
+
+    def test_pick_frames(self):
+        molz = plugin.PymolToMolz(name="frames", cache=None,
+                                  frames=(1, None, 3))
+        self.assertEqual(molz.pick_frames("large"), [1, 4, 7, 10])
+        # Beyond the last state: the first one
+        molz.frames = (20, None, 1)
+        self.assertEqual(molz.pick_frames("large"), [1])
+        molz.frames = (2, 2, 1)
+        self.assertEqual(molz.pick_frames("discrete"), [2])
+        # Every state
+        molz.frames = (1, 100, 1)
+        self.assertIsNone(molz.pick_frames("large"))
+
+    def test_stride(self):
+        archive = self.export("::3")
+        rows, models = self.cif_models(archive["assets/large.cif"])
+        self.assertEqual(models, [1, 4, 7, 10])
+        self.assertEqual(len(rows), 4 * cmd.count_atoms("large", state=1))
+        self.assertEqual(archive["assets/small.sdf"].count(b"$$$$"), 4)
+        self.assertEqual(archive["assets/discrete.sdf"].count(b"$$$$"), 2)
+        # The states of a non-discrete object share its atoms, the picked
+        # states of a discrete one are its models in order
+        self.assertEqual(self.models(archive, "large"), [0])
+        self.assertEqual(self.models(archive, "discrete"), [0, 1])
+
+    def test_all_states(self):
+        archive = self.export("")
+        rows, models = self.cif_models(archive["assets/large.cif"])
+        self.assertEqual(models, list(range(1, 11)))
+        self.assertEqual(archive["assets/discrete.sdf"].count(b"$$$$"), 6)
+        self.assertEqual(self.models(archive, "discrete"), list(range(6)))
+
+    def test_atom_site_rows(self):
+        lines = ["data_x\n", "loop_\n", "_atom_site.id\n", "_atom_site.x\n",
+                 "ATOM 1\n", "HETATM 2\n", "#\n", "loop_\n", "_other.id\n",
+                 "1\n"]
+        self.assertEqual(plugin.PymolToMolz.atom_site_rows(lines), (4, 6))
+        self.assertIsNone(plugin.PymolToMolz.atom_site_rows(lines[:4]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from support import StandInServer, cmd, jwt, make_api, plugin
+
+
+class LiveSyncTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACD", "peptide")
+        cmd.fab("GG", "other")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # Uploads wait for this while it is cleared
+        self.answer = threading.Event()
+        self.answer.set()
+        self.server = StandInServer(self.handle)
+        api = make_api(self.server, self.tmpdir.name)
+        api.token = jwt(time.time() + 3600)
+        api.expires_at = time.time() + 3600
+        self.queue = plugin.SendQueue(
+            api, spool_dir=os.path.join(self.tmpdir.name, "spool"))
+        self.sync = plugin.LiveSync(self.queue, "peptide", interval=0.05,
+                                    debounce=0.1)
+
+    def tearDown(self):
+        self.sync.stop()
+        self.answer.set()
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def handle(self, path, headers, body):
+        self.answer.wait(30)
+        return 200, {"success": True}
+
+    def wait_for_pushes(self, count, timeout=30):
+        deadline = time.time() + timeout
+        while self.sync.stats()["pushes"] < count and time.time() < deadline:
+            time.sleep(0.05)
+        return self.sync.stats()["pushes"]
+
+    def test_pushes_changes_in_scope(self):
+        self.sync.start()
+        self.assertEqual(self.wait_for_pushes(1), 1)
+        path, headers, body = self.server.requests[0]
+        self.assertEqual(path, "/load/workspace")
+        self.assertIn(f'filename="{self.sync.name}"'.encode(), body)
+
+        # Not in the scope of the sync
+        cmd.color("red", "other")
+        cmd.show("spheres", "other")
+        time.sleep(1.0)
+        self.assertEqual(self.sync.stats()["pushes"], 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+        cmd.color("red", "peptide")
+        self.assertEqual(self.wait_for_pushes(2), 2)
+        self.assertEqual(len(self.server.requests), 2)
+        stats = self.sync.stats()
+        self.assertEqual(stats["failed"], 0)
+        self.assertIsNone(stats["last_error"])
+
+    def test_one_push_in_flight(self):
+        self.answer.clear()
+        self.sync.push()
+        deadline = time.time() + 30
+        while not self.server.requests and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(self.sync.pushing())
+        # From the GUI and the polling thread at once
+        started = []
+        threads = [threading.Thread(
+            target=lambda: started.append(self.sync.start_push()))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(started, [False] * 8)
+        self.answer.set()
+        self.assertEqual(self.wait_for_pushes(1), 1)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+from support import StandInServer, jwt, login_response, make_api, plugin
+
+
+class BrokenKeyring():
+    # keyring without a backend
+    def get_password(self, service, name):
+        raise RuntimeError("no backend")
+
+    set_password = delete_password = get_password
+
+
+class TokenStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "token.json")
+        self.store = plugin.TokenStore(self.path)
+        self.store._keyring = lambda: BrokenKeyring()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_falls_back_to_the_file(self):
+        self.store.save("token", 123.0, "user")
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertEqual(self.store.load(), ("token", 123.0, "user"))
+        self.store.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.store.load(), (None, 0.0, None))
+
+    def test_existing_file_made_private(self):
+        with open(self.path, "w") as f:
+            f.write("{}")
+        os.chmod(self.path, 0o644)
+        self.store.save("token", 123.0, "user")
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+
+class LoginTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.logins = []
+        self.uploads = []
+        self.server = StandInServer(self.handle)
+        self.api = make_api(self.server, self.tmpdir.name)
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def handle(self, path, headers, body):
+        # The next answer of the path: a status and its response
+        answers = self.logins if path == "/user/login" else self.uploads
+        if answers:
+            return answers.pop(0)
+        return 200, {"success": True}
+
+    def login_paths(self):
+        return [p for p, _, _ in self.server.requests if p == "/user/login"]
+
+    def test_login(self):
+        token = jwt(time.time() + 3600)
+        self.logins = [(200, login_response(token))]
+        self.assertIsNone(self.api.ensure_token())
+        self.assertEqual(self.api.token, token)
+        self.assertAlmostEqual(self.api.expires_at, time.time() + 3600, -1)
+        self.assertEqual(self.api.account, "user")
+        # The password is not kept once logged in
+        self.assertIsNone(self.api.password)
+        _, _, body = self.server.requests[0]
+        self.assertEqual(json.loads(body)["pass"], "secret")
+        # and the token is stored for the next session
+        self.assertEqual(self.api.token_store.load()[0], token)
+        self.assertIsNone(self.api.ensure_token())
+        self.assertEqual(len(self.login_paths()), 1)
+
+    def test_refresh(self):
+        # Stored token about to expire, with the credentials given again
+        self.api.token = jwt(time.time() + 60)
+        self.api.expires_at = time.time() + 60
+        new_token = jwt(time.time() + 3600)
+        self.logins = [(200, login_response(new_token))]
+        self.assertIsNone(self.api.send_file(
+            io.BytesIO(b"archive"), "session"))
+        self.assertEqual(self.api.token, new_token)
+        _, headers, _ = self.server.requests[-1]
+        self.assertEqual(headers["Authorization"], "Bearer " + new_token)
+
+    def test_expiring_token_used_without_credentials(self):
+        token = jwt(time.time() + 60)
+        self.api.token, self.api.expires_at = token, time.time() + 60
+        self.api.password = None
+        self.assertIsNone(self.api.ensure_token())
+        self.assertEqual(self.login_paths(), [])
+
+    def test_expired_token(self):
+        self.api.token = jwt(time.time() - 1)
+        self.api.expires_at = time.time() - 1
+        self.api.password = None
+        self.assertEqual(self.api.send_file(
+            io.BytesIO(b"archive"), "session"), "login required")
+        self.assertIsNone(self.api.token)
+        self.assertEqual(self.server.requests, [])
+
+    def test_revoked_token(self):
+        self.api.token = jwt(time.time() + 3600)
+        self.api.expires_at = time.time() + 3600
+        self.api.token_store.save(self.api.token, self.api.expires_at, "user")
+        self.api.password = None
+        self.uploads = [(401, {"success": False})]
+        self.assertEqual(self.api.send_file(
+            io.BytesIO(b"archive"), "session"), "Unauthorized")
+        self.assertIsNone(self.api.token)
+        self.assertFalse(self.api.has_token())
+        self.assertEqual(self.api.token_store.load(), (None, 0.0, None))
+
+    def test_revoked_token_with_credentials(self):
+        self.api.token = jwt(time.time() + 3600)
+        self.api.expires_at = time.time() + 3600
+        new_token = jwt(time.time() + 7200)
+        self.logins = [(200, login_response(new_token))]
+        self.uploads = [(401, {"success": False})]
+        self.assertIsNone(self.api.send_file(
+            io.BytesIO(b"archive"), "session"))
+        _, headers, _ = self.server.requests[-1]
+        self.assertEqual(headers["Authorization"], "Bearer " + new_token)
+
+    def test_wrong_credentials(self):
+        self.logins = [(401, {"success": False})]
+        self.assertEqual(self.api.ensure_token(), "Unauthorized")
+        self.assertIsNone(self.api.token)
+        self.assertIsNone(self.api.username)
+        self.assertIsNone(self.api.password)
+        # Not tried again
+        self.assertEqual(self.api.ensure_token(), "login required")
+        self.assertEqual(len(self.login_paths()), 1)
+
+    def test_unexpected_answer(self):
+        for payload in (b"<html>", {"success": True}, {"results": None},
+                        {"results": {"token": {"value": None}}}):
+            self.api.set_credentials("user", "secret")
+            self.logins = [(200, payload)]
+            self.assertEqual(self.api.get_nanome_token(), "unexpected answer")
+            self.assertIsNone(self.api.token)
+            self.assertIsNone(self.api.password)
+
+    def test_connection_failed(self):
+        self.api.login_url = "http://127.0.0.1:1/user/login"
+        self.assertEqual(self.api.ensure_token(), "connection failed")
+        # Kept to try again
+        self.assertEqual(self.api.password, "secret")
+
+
+if __name__ == "__main__":
+    unittest.main()
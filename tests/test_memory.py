@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from support import cmd, export, plugin
+
+
+class MemoryLimitTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEFGHIKL", "peptide", ss=1)
+        cmd.fab("MNPQ", "other")
+        cmd.set("stick_radius", 0.1, "other and resi 2")
+        cmd.color("red", "peptide and resi 3")
+        cmd.show("sticks")
+        cmd.fab("GG", "small")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def export(self, name, **kwargs):
+        return export(plugin.PymolToMolz(name="memory", cache=None, **kwargs),
+                      self.tmpdir.name, name)
+
+    def test_per_object_same_output(self):
+        self.assertEqual(self.export("per_object", per_object=True),
+                         self.export("default"))
+
+    def test_per_object_structures_written_at_once(self):
+        # Each structure file is in the archive, and out of memory, before
+        # the next object is read
+        exporter = plugin.PymolToMolz(name="memory", cache=None, per_object=True)
+        held = []
+        load_object = exporter.load_object
+
+        def record(mol_name):
+            held.append(len(exporter._structure_texts))
+            return load_object(mol_name)
+        exporter.load_object = record
+        exporter.export_to_molz(
+            molz_path=os.path.join(self.tmpdir.name, "memory.molz"))
+        self.assertEqual(held, [1, 0, 0])
+
+    def test_limit_same_output(self):
+        limit = 64 * 1024 * 1024 * 1024
+        self.assertEqual(self.export("limit", memory_limit=limit),
+                         self.export("default"))
+
+    def test_over_the_limit(self):
+        # The limit is on the whole process, already over 1 MB
+        with self.assertRaises(plugin.MemoryLimitExceeded) as raised:
+            self.export("over", memory_limit=1024 * 1024)
+        self.assertIn("memory limit of 1 MB", str(raised.exception))
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import tempfile
+import unittest
+
+from support import cmd, export, plugin
+
+
+class SurfaceTrianglesTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEFG", "peptide", ss=1)
+        cmd.fab("KL", "a-b")
+        cmd.fab("MN", "or_")
+        cmd.show("surface", "peptide and resi 2-4")
+        cmd.show("sticks")
+        cmd.show("cartoon")
+        cmd.disable("a-b")
+
+    def test_session_unchanged(self):
+        before = cmd.get_session()["names"]
+        positions, normals, colors = plugin.surface_triangles("peptide")
+        self.assertEqual(cmd.get_session()["names"], before)
+        self.assertEqual(cmd.get_names("objects"), ["peptide", "a-b", "or_"])
+        self.assertTrue(len(positions))
+        self.assertEqual(len(positions) % 3, 0)
+        self.assertEqual(positions.shape, normals.shape)
+
+    def test_only_the_surface(self):
+        triangles = plugin.surface_triangles("peptide")
+        cmd.hide("everything", "not rep surface")
+        cmd.show_as("surface", "rep surface")
+        cmd.rebuild()
+        alone = plugin.collada_triangles(cmd.get_collada())
+        self.assertEqual(len(triangles[0]), len(alone[0]))
+
+    def test_no_surface(self):
+        self.assertIsNone(plugin.surface_triangles("or_"))
+
+
+
+class MeshSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEFG", "peptide", ss=1)
+        cmd.show("surface", "peptide and resi 2-4")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def export(self, molz):
+        return export(molz, self.tmpdir.name)
+
+    def check_edits_during_export(self, per_object):
+        # The mesh is that of the snapshot, like the structure files
+        cache = plugin.ExportCache()
+        expected = self.export(plugin.PymolToMolz(
+            name="meshes", cache=None, meshes=True, per_object=per_object))
+        self.assertIn("assets/peptide_surface.mesh", expected)
+        molz = plugin.PymolToMolz(name="meshes", cache=cache, meshes=True,
+                                  per_object=per_object)
+        cmd.show("surface", "peptide")
+        cmd.translate([1, 0, 0], "peptide")
+        self.assertEqual(self.export(molz), expected)
+        # Cached under the fingerprint of the snapshot: the edited object
+        # gets its own mesh
+        edited = self.export(plugin.PymolToMolz(
+            name="meshes", cache=cache, meshes=True))
+        self.assertNotEqual(edited["assets/peptide_surface.mesh"],
+                            expected["assets/peptide_surface.mesh"])
+
+    def test_edits_during_export(self):
+        self.check_edits_during_export(per_object=False)
+
+    def test_edits_during_object_at_a_time_export(self):
+        self.check_edits_during_export(per_object=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
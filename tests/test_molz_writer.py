@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from support import plugin
+
+
+class WriteEntryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, compresslevel, entries):
+        # Archive of the entries compressed first, then added
+        path = os.path.join(self.tmpdir.name, f"{compresslevel}.molz")
+        with plugin.MolzWriter(path, compresslevel) as writer:
+            for name, data in entries.items():
+                zinfo, compressed, _ = writer.compress_asset(name, data)
+                writer.write_entry(zinfo, compressed)
+            writer.write_asset("after.txt", "written after")
+        return path
+
+    def check(self, path, entries):
+        with zipfile.ZipFile(path) as z:
+            self.assertIsNone(z.testzip())
+            for name, data in entries.items():
+                self.assertEqual(z.read("assets/" + name), data)
+            self.assertEqual(z.read("assets/after.txt"), b"written after")
+
+    def test_write_entry(self):
+        entries = {"a.mesh": os.urandom(1000) * 20, "b.sdf": b"x" * 100000}
+        for compresslevel in (0, 6):
+            self.check(self.write(compresslevel, entries), entries)
+
+    def test_without_zipfile_internals(self):
+        entries = {"a.mesh": os.urandom(1000) * 20, "b.sdf": b"x" * 100000}
+        internals = plugin.zip_internals + ("_missing",)
+        with mock.patch.object(plugin, "zip_internals", internals):
+            for compresslevel in (0, 6):
+                self.check(self.write(compresslevel, entries), entries)
+
+
+if __name__ == "__main__":
+    unittest.main()
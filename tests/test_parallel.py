@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from support import cmd, export, plugin
+
+
+class ParallelExtractionTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEFGHIKLMNPQ", "peptide", ss=1)
+        cmd.fab("WYVST", "other")
+        cmd.show("sticks", "peptide and resi 2-5")
+        cmd.show("spheres", "peptide and resi 4-8")
+        cmd.show("cartoon")
+        cmd.show("surface", "other")
+        cmd.label("other and name CA", "resn")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        plugin.discard_extract_pool()
+        self.tmpdir.cleanup()
+
+    def export(self, workers=None):
+        return export(plugin.PymolToMolz(name="parallel", cache=None,
+                                         workers=workers),
+                      self.tmpdir.name, str(workers))
+
+    def test_same_as_serial(self):
+        self.assertEqual(self.export(2), self.export())
+
+    def test_dead_worker(self):
+        pool = plugin.get_extract_pool(1)
+        pool.submit(os.getpid).result()
+        for process in list(pool._processes.values()):
+            process.kill()
+            process.join()
+        with self.assertRaises(BrokenProcessPool):
+            self.export(1)
+        # Started again for the next export
+        self.assertIsNone(plugin.extract_pool)
+        self.assertEqual(self.export(1), self.export())
+
+    def test_old_python(self):
+        # Extracted in Pymol without shared memory or cancel_futures
+        serial = self.export()
+        with mock.patch.object(sys, "version_info", (3, 8, 10)):
+            self.assertIsNone(plugin.get_extract_pool(2))
+            self.assertEqual(self.export(2), serial)
+        self.assertIsNone(plugin.extract_pool)
+
+
+class PythonExecutableTest(unittest.TestCase):
+    def test_bundled_pymol(self):
+        with tempfile.TemporaryDirectory() as prefix:
+            pymol = os.path.join(prefix, "PyMOL")
+            with mock.patch.object(sys, "executable", pymol), \
+                    mock.patch.object(sys, "exec_prefix", prefix):
+                self.assertIsNone(plugin.python_executable())
+                python = os.path.join(prefix, "bin", "python3")
+                os.mkdir(os.path.dirname(python))
+                with open(python, "w"):
+                    pass
+                os.chmod(python, 0o755)
+                self.assertEqual(plugin.python_executable(), python)
+
+    def test_python(self):
+        self.assertEqual(plugin.python_executable(), sys.executable)
+
+    def test_spawn_executable_kept(self):
+        # Only set for bundled builds, it is shared by the whole process
+        from multiprocessing import spawn
+        executable = spawn.get_executable()
+        with mock.patch.object(spawn, "set_executable") as set_executable:
+            try:
+                plugin.get_extract_pool(1).submit(os.getpid).result()
+            finally:
+                plugin.discard_extract_pool()
+        set_executable.assert_not_called()
+        self.assertEqual(spawn.get_executable(), executable)
+
+
+if __name__ == "__main__":
+    unittest.main()
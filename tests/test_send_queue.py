@@ -0,0 +1,138 @@
+import os
+import tempfile
+import unittest
+
+from support import cmd, plugin
+
+
+class StubAPI():
+    # send_file(path) answers with the next of results: None when sent, a
+    # reason, or an exception to raise
+    def __init__(self, results, account="user"):
+        self.results = list(results)
+        self.sent = []
+        self.account = account
+        self.logged_in = True
+
+    def ensure_token(self, profile=None):
+        return None if self.logged_in else "login required"
+
+    def has_token(self, margin=0.0):
+        return self.logged_in
+
+    def send_file(self, filepath, name=None, progress=None, profile=None):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        if result == "login required":
+            # The token was revoked during the upload
+            self.logged_in = False
+        if result is None:
+            self.sent.append(name)
+            os.remove(filepath)
+        return result
+
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACD", "peptide")
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.tmpdir.name, "spool")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_queue(self, results, logged_in=True, **kwargs):
+        api = StubAPI(results)
+        api.logged_in = logged_in
+        return plugin.SendQueue(api, spool_dir=self.spool_dir, **kwargs)
+
+    def test_sent(self):
+        queue = self.make_queue([None])
+        job = queue.submit(plugin.SendJob(name="sent"))
+        self.assertIsNone(job.wait(30))
+        self.assertEqual(queue.api.sent, ["sent"])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_upload_error_finishes_the_job(self):
+        # Errors other than the retried ones do not stop the upload
+        # threads: the next sends still go through
+        queue = self.make_queue(
+            [KeyError("token"), OSError("gone"), None], max_uploads=2,
+            retry_delay=3600)
+        failed = [queue.submit(plugin.SendJob(name=f"failed{i}"))
+                  for i in range(2)]
+        for job in failed:
+            self.assertIn("failed:", job.wait(30))
+        job = queue.submit(plugin.SendJob(name="sent"))
+        self.assertIsNone(job.wait(30))
+        self.assertEqual(queue.stats()["retrying"], 2)
+
+    def test_removed_spool_file_fails(self):
+        queue = self.make_queue([FileNotFoundError("removed")])
+        job = plugin.SendJob(name="removed", retry=False)
+        job = queue.submit(job)
+        self.assertIn("failed:", job.wait(30))
+        self.assertEqual(queue.stats()["failed"], 1)
+
+    def spool(self, name, account="user", attempts=0, age=0.0):
+        # Archive left in the spool by a previous Pymol session
+        import json
+        import time
+        os.makedirs(self.spool_dir, exist_ok=True)
+        path = os.path.join(self.spool_dir, name + ".molz")
+        with open(path, "wb") as f:
+            f.write(b"molz")
+        meta = {"name": name, "attempts": attempts, "due": 0.0}
+        if account is not None:
+            meta["account"] = account
+        with open(os.path.join(self.spool_dir, name + ".json"), "w") as f:
+            json.dump(meta, f)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_load_spool_drops_stale_archives(self):
+        kept = self.spool("kept")
+        dropped = [self.spool("legacy", account=None),
+                   self.spool("old", age=30 * 24 * 3600),
+                   self.spool("failed", attempts=8)]
+        queue = self.make_queue([None], logged_in=False, max_attempts=8)
+        self.assertEqual([job.path for job in queue._retries], [kept])
+        for path in dropped:
+            self.assertFalse(os.path.exists(path))
+
+    def test_spooled_archives_wait_for_their_account(self):
+        import time
+        self.spool("other", account="someone else")
+        self.spool("mine")
+        queue = self.make_queue([None])
+        deadline = time.time() + 30
+        while not queue.api.sent and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)
+        self.assertEqual(queue.api.sent, ["mine"])
+        self.assertEqual(queue.stats()["retrying"], 1)
+
+    def test_logged_out_failures_are_not_counted(self):
+        queue = self.make_queue(["login required"], retry_delay=3600)
+        job = queue.submit(plugin.SendJob(name="logged out"))
+        self.assertEqual(job.wait(30), "login required")
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(queue.stats()["retrying"], 1)
+
+    def test_wait_from_a_command(self):
+        # Commands run with Pymol's API lock held, the export needs it
+        queue = self.make_queue([None])
+        previous, plugin.send_queue = plugin.send_queue, queue
+        try:
+            with cmd.lockcm:
+                self.assertIsNone(plugin.nanome_send(wait=1))
+        finally:
+            plugin.send_queue = previous
+        self.assertEqual(len(queue.api.sent), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
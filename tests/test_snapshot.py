@@ -0,0 +1,76 @@
+import tempfile
+import unittest
+
+from support import cmd, export, plugin
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        cmd.reinitialize()
+        cmd.fab("ACDEF", "peptide")
+        cmd.fab("WY", "other")
+        cmd.show("sticks")
+        cmd.color("red", "peptide")
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def export(self, molz, compresslevel=6):
+        return export(molz, self.tmpdir.name, compresslevel=compresslevel)
+
+    def check_edits_during_export(self, per_object):
+        # The structure files and colors are those of the snapshot, whatever
+        # is done in Pymol while the export runs
+        expected = self.export(plugin.PymolToMolz(
+            name="snapshot", cache=None, per_object=per_object))
+        molz = plugin.PymolToMolz(name="snapshot", cache=None,
+                                  per_object=per_object)
+        cmd.remove("peptide and resi 5")
+        cmd.translate([1, 0, 0], "peptide")
+        cmd.set_color("red", [0, 0, 1])
+        self.assertEqual(self.export(molz), expected)
+
+    def test_edits_during_export(self):
+        self.check_edits_during_export(per_object=False)
+
+    def test_edits_during_object_at_a_time_export(self):
+        # Only the first object is in the first snapshot
+        self.check_edits_during_export(per_object=True)
+
+    def test_deleted_before_export(self):
+        # Deleted between the send and the start of its export
+        expected = self.export(plugin.PymolToMolz(
+            name="snapshot", cache=None, objects=["peptide"]))
+        cmd.create("gone", "other")
+        objects = ["peptide", "gone"]
+        cmd.delete("gone")
+        for per_object in (False, True):
+            with self.subTest(per_object=per_object):
+                self.assertEqual(self.export(plugin.PymolToMolz(
+                    name="snapshot", cache=None, objects=objects,
+                    per_object=per_object)), expected)
+        with self.assertRaises(ValueError):
+            plugin.PymolToMolz(name="snapshot", cache=None, objects=["gone"])
+
+    def test_deleted_during_object_at_a_time_export(self):
+        expected = self.export(plugin.PymolToMolz(
+            name="snapshot", cache=None, objects=["peptide"]))
+        molz = plugin.PymolToMolz(name="snapshot", cache=None, per_object=True)
+        cmd.delete("other")
+        self.assertEqual(self.export(molz), expected)
+
+    def test_cached_with_other_compression(self):
+        cache = plugin.ExportCache()
+        stored = self.export(plugin.PymolToMolz(name="snapshot", cache=cache),
+                             compresslevel=0)
+        hits = cache.hits
+        deflated = self.export(plugin.PymolToMolz(name="snapshot", cache=cache))
+        self.assertGreater(cache.hits, hits)
+        self.assertEqual(deflated, stored)
+        self.assertEqual(deflated, self.export(
+            plugin.PymolToMolz(name="snapshot", cache=None)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from support import StandInServer, jwt, make_api, plugin
+
+
+def parse_multipart(content_type, body):
+    # {name: (filename, data)} of a multipart/form-data body
+    boundary = content_type.split("boundary=")[1].encode("ascii")
+    parts = {}
+    for part in body.split(b"--" + boundary)[1:-1]:
+        headers, data = part[2:-2].split(b"\r\n\r\n", 1)
+        disposition = dict(
+            item.strip().split("=", 1) for item in
+            headers.decode("utf-8").split(";")[1:])
+        name = disposition["name"].strip('"')
+        parts[name] = (disposition.get("filename", "").strip('"') or None, data)
+    return parts
+
+
+class RecordingFile(io.BytesIO):
+    # Keeps the size of every read
+    def __init__(self, data):
+        super().__init__(data)
+        self.reads = []
+
+    def read(self, size=-1):
+        self.reads.append(size)
+        return super().read(size)
+
+
+class MultipartUploadTest(unittest.TestCase):
+    def test_chunks_make_the_whole_body(self):
+        data = os.urandom(100000)
+        body = plugin.MultipartUpload({"format": "molz"}, "name",
+                                      io.BytesIO(data))
+        whole = body.read()
+        self.assertEqual(len(whole), len(body))
+        for size in (1, 7, 4096):
+            body.rewind()
+            chunks = []
+            while True:
+                chunk = body.read(size)
+                if not chunk:
+                    break
+                self.assertLessEqual(len(chunk), size)
+                chunks.append(chunk)
+            self.assertEqual(b"".join(chunks), whole)
+        parts = parse_multipart(body.content_type, whole)
+        self.assertEqual(parts["format"], (None, b"molz"))
+        self.assertEqual(parts["name"], ("name", data))
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.answers = []
+        self.server = StandInServer(self.handle)
+        self.api = make_api(self.server, self.tmpdir.name)
+        self.api.token = jwt(time.time() + 3600)
+        self.api.expires_at = time.time() + 3600
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def handle(self, path, headers, body):
+        # The next answer: a status, or (seconds to wait, status)
+        answer = self.answers.pop(0) if self.answers else 200
+        if isinstance(answer, tuple):
+            time.sleep(answer[0])
+            answer = answer[1]
+        return answer, {"success": answer == 200}
+
+    def archive(self, size=1024 * 1024):
+        path = os.path.join(self.tmpdir.name, "session.molz")
+        data = os.urandom(size)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path, data
+
+    def test_streamed_upload(self):
+        path, data = self.archive()
+        progress = []
+        reason = self.api.send_file(
+            path, "session", progress=lambda *p: progress.append(p))
+        self.assertIsNone(reason)
+        self.assertFalse(os.path.exists(path))
+
+        (url, headers, body), = self.server.requests
+        self.assertEqual(url, "/load/workspace")
+        self.assertEqual(headers["Authorization"], "Bearer " + self.api.token)
+        self.assertEqual(int(headers["Content-Length"]), len(body))
+        parts = parse_multipart(headers["Content-Type"], body)
+        self.assertEqual(parts["session"], ("session", data))
+        self.assertEqual(parts["format"], (None, b"molz"))
+
+        # Progress only goes forward, up to the whole body
+        sent = [p[0] for p in progress]
+        self.assertEqual(sent, sorted(sent))
+        self.assertEqual(progress[-1][:2], (len(body), len(body)))
+
+    def test_file_read_in_chunks(self):
+        data = os.urandom(1024 * 1024)
+        f = RecordingFile(data)
+        self.assertIsNone(self.api.send_file(f, "session"))
+        reads = [size for size in f.reads if size]
+        self.assertGreater(len(reads), 10)
+        self.assertLess(max(reads), len(data))
+
+    def test_5xx_retried(self):
+        path, data = self.archive(10000)
+        self.answers = [503, 502]
+        self.assertIsNone(self.api.send_file(path, "session"))
+        self.assertEqual(len(self.server.requests), 3)
+        # The whole body again on each attempt
+        bodies = set(body for _, _, body in self.server.requests)
+        self.assertEqual(len(bodies), 1)
+
+    def test_5xx_gives_up(self):
+        path, _ = self.archive(10000)
+        self.answers = [503] * (self.api.max_retries + 1)
+        self.assertEqual(self.api.send_file(path, "session"),
+                         "Service Unavailable")
+        self.assertEqual(len(self.server.requests), self.api.max_retries + 1)
+        # Kept for a later retry
+        self.assertTrue(os.path.exists(path))
+
+    def test_4xx_not_retried(self):
+        path, _ = self.archive(10000)
+        self.answers = [400]
+        self.assertEqual(self.api.send_file(path, "session"), "Bad Request")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_timeout_retried(self):
+        path, _ = self.archive(10000)
+        self.api.upload_timeout = (2.0, 0.3)
+        self.answers = [(1.0, 200)]
+        self.assertIsNone(self.api.send_file(path, "session"))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_connection_refused(self):
+        path, _ = self.archive(10000)
+        self.api.load_url = "http://127.0.0.1:1/load/workspace"
+        self.api.max_retries = 1
+        self.assertEqual(self.api.send_file(path, "session"),
+                         "connection failed")
+        self.assertTrue(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()